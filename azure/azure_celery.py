@@ -1,52 +1,170 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 import azure.cognitiveservices.speech as speechsdk
-from mcelery.cos import get_local_path, upload_cos_file
+from celery.signals import worker_process_init
+from mcelery.cos import cos_client, cos_bucket
 from mcelery.infer import celery_app, register_infer_tasks
 
+from affinity import setup_affinity_routing
+from azure_pool import SynthesizerPool
+
 azure_speech_key = os.getenv("AZURE_SPEECH_KEY")
 azure_speech_region = os.getenv("AZURE_SPEECH_REGION")
 
+# azure_batch_infer 的并发数以及每条的重试次数
+azure_batch_concurrency = int(os.getenv("AZURE_BATCH_CONCURRENCY", 8))
+azure_batch_max_attempts = int(os.getenv("AZURE_BATCH_MAX_ATTEMPTS", 3))
+
+# 每个 voice 保留的空闲连接数, 默认与 azure_batch_infer 的并发数一致
+azure_pool_max_idle = int(os.getenv("AZURE_POOL_MAX_IDLE", azure_batch_concurrency))
+synthesizer_pool = SynthesizerPool(azure_speech_key, azure_speech_region, max_idle_per_voice=azure_pool_max_idle)
+
+
+@worker_process_init.connect
+def prewarm_synthesizers(**_):
+    """
+    worker 子进程启动时预先建立常用 voice 的连接
+    例如 AZURE_PREWARM_VOICES=zh-CN-YunxiNeural,zh-CN-XiaoxiaoNeural
+    """
+    for voice in filter(None, os.getenv("AZURE_PREWARM_VOICES", "").split(",")):
+        synthesizer_pool.prewarm(voice.strip())
+
+
+# 字幕每行的最大字符数
+srt_max_chars = int(os.getenv("SRT_MAX_CHARS", 20))
+# 在这些标点之后换行
+_srt_breaks = set("，。！？；：、,.!?;:")
+
+
+def _format_srt_time(t: float) -> str:
+    ms = round(t * 1000)
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+
+def build_srt(text: str, boundaries: List[speechsdk.SpeechSynthesisWordBoundaryEventArgs]) -> str:
+    """
+    根据 word boundary 事件生成字幕, 每行在标点处或超过 srt_max_chars 时结束
+    :param text: 合成的文本, 字幕内容取自原文以保留空格
+    :param boundaries: 合成过程中收集的 word boundary 事件
+    """
+    cues, line = [], []
+
+    def flush():
+        if not line:
+            return
+        # audio_offset 单位为 100ns
+        start = line[0].audio_offset / 10_000_000
+        end = max(evt.audio_offset / 10_000_000 + evt.duration.total_seconds() for evt in line)
+        content = text[line[0].text_offset : line[-1].text_offset + line[-1].word_length].strip(" ，,、")
+        if content:
+            cues.append(f"{_format_srt_time(start)} --> {_format_srt_time(end)}\n{content}")
+        line.clear()
+
+    for evt in boundaries:
+        if evt.boundary_type == speechsdk.SpeechSynthesisBoundaryType.Sentence:
+            continue
+        if evt.boundary_type == speechsdk.SpeechSynthesisBoundaryType.Punctuation:
+            if line:
+                line.append(evt)
+            if evt.text.strip() and evt.text.strip()[-1] in _srt_breaks:
+                flush()
+            continue
+        if line and evt.text_offset + evt.word_length - line[0].text_offset > srt_max_chars:
+            flush()
+        line.append(evt)
+    flush()
+    return "\n\n".join(f"{i}\n{cue}" for i, cue in enumerate(cues, 1)) + "\n"
+
+
+def synthesize(
+    text: str, audio_profile: str, with_boundaries: bool = False
+) -> Tuple[Optional[bytes], List[speechsdk.SpeechSynthesisWordBoundaryEventArgs]]:
+    """
+    使用池中的 synthesizer 合成到内存
+    :return: wav 数据 (合成被取消且没有错误时为 None), word boundary 事件
+    """
+    # remove all (xxx), example: "zh-CN-XiaoxiaoNeural (Female)" to be "zh-CN-XiaoxiaoNeural"
+    voice = audio_profile.split(" (")[0]
+    boundaries = []
+    with synthesizer_pool.acquire(voice) as speech_synthesizer:
+        if with_boundaries:
+            speech_synthesizer.synthesis_word_boundary.connect(boundaries.append)
+        speech_synthesis_result = speech_synthesizer.speak_text_async(text).get()
+
+        if speech_synthesis_result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            return speech_synthesis_result.audio_data, boundaries
+        elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
+            cancellation_details = speech_synthesis_result.cancellation_details
+            print("Speech synthesis canceled: {}".format(cancellation_details.reason))
+            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                raise Exception(f"error details: {cancellation_details.error_details}")
+            return None, boundaries
+        else:
+            raise Exception(f"unknown reason: {speech_synthesis_result.reason}")
+
 
 @celery_app.task(
     lazy=False, name="azure_infer", queue="azure_infer", autoretry_for=(Exception,), default_retry_delay=10
 )
-def azure_infer_task(text: str, audio_profile: str, output_cos: str) -> str:
+def azure_infer_task(text: str, audio_profile: str, output_cos: str, output_srt_cos: Optional[str] = None) -> str:
     """
     微软 TTS 服务
     :param text: 音频文字内容
     :param audio_profile: 配置
     :param output_cos: 合成的音频文件 COS key
+    :param output_srt_cos: 不为空时根据 word boundary 事件生成字幕, 省去 srt 任务
     :return: output_cos
     """
 
-    dest = get_local_path(output_cos)
+    audio_data, boundaries = synthesize(text, audio_profile, with_boundaries=bool(output_srt_cos))
+    if audio_data is None:
+        return None
+    # 直接从内存上传, 不经过本地文件
+    cos_client.put_object(Bucket=cos_bucket, Body=audio_data, Key=output_cos)
+    if output_srt_cos:
+        srt = build_srt(text, boundaries).encode("utf-8")
+        cos_client.put_object(Bucket=cos_bucket, Body=srt, Key=output_srt_cos)
+    return output_cos
 
-    speech_config = speechsdk.SpeechConfig(subscription=azure_speech_key, region=azure_speech_region)
-    # remove all (xxx), example: "zh-CN-XiaoxiaoNeural (Female)" to be "zh-CN-XiaoxiaoNeural"
-    speech_config.speech_synthesis_voice_name = audio_profile.split(" (")[0]
-    audio_config = speechsdk.audio.AudioOutputConfig(use_default_speaker=True, filename=str(dest))
-
-    speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
-
-    speech_synthesis_result = speech_synthesizer.speak_text_async(text).get()
-    if speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
-        cancellation_details = speech_synthesis_result.cancellation_details
-        print("Speech synthesis canceled: {}".format(cancellation_details.reason))
-        if cancellation_details.reason == speechsdk.CancellationReason.Error:
-            raise Exception(f"error details: {cancellation_details.error_details}")
-
-    if speech_synthesis_result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-        upload_cos_file(output_cos)
-        return output_cos
-    elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
-        cancellation_details = speech_synthesis_result.cancellation_details
-        print("Speech synthesis canceled: {}".format(cancellation_details.reason))
-        if cancellation_details.reason == speechsdk.CancellationReason.Error:
-            raise Exception(cancellation_details.error_details)
-    else:
-        raise Exception(f"unknown reason: {speech_synthesis_result.reason}")
+
+def _batch_item(text: str, audio_profile: str, output_cos: str) -> Dict[str, Any]:
+    error = None
+    for attempt in range(1, azure_batch_max_attempts + 1):
+        try:
+            audio_data, _ = synthesize(text, audio_profile)
+            if audio_data is None:
+                return {"output_cos": output_cos, "ok": False, "error": "canceled"}
+            cos_client.put_object(Bucket=cos_bucket, Body=audio_data, Key=output_cos)
+            return {"output_cos": output_cos, "ok": True, "error": None}
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if attempt < azure_batch_max_attempts:
+                time.sleep(attempt)
+    return {"output_cos": output_cos, "ok": False, "error": error}
+
+
+@celery_app.task(lazy=False, name="azure_batch_infer", queue="azure_infer")
+def azure_batch_infer_task(items: List[Tuple[str, str, str]]) -> List[Dict[str, Any]]:
+    """
+    批量微软 TTS. 同一 voice 复用 synthesizer 池中的连接, 并发数为 azure_batch_concurrency.
+    每条单独重试, 失败不会导致整个 batch 重试.
+    :param items: (text, audio_profile, output_cos) 列表
+    :return: 与 items 顺序一致的结果, {"output_cos": str, "ok": bool, "error": Optional[str]}
+    """
+    # 按 voice 排序, 让同一 voice 的请求集中使用池中已打开的连接
+    order = sorted(range(len(items)), key=lambda i: items[i][1])
+    with ThreadPoolExecutor(max_workers=azure_batch_concurrency) as executor:
+        futures = {i: executor.submit(_batch_item, *items[i]) for i in order}
+        results = [futures[i].result() for i in range(len(items))]
+    failed = sum(not r["ok"] for r in results)
+    print(f"azure batch finished, {len(results) - failed} succeeded, {failed} failed")
+    return results
 
 
 # 需要注册其他 task, 否则 chain 之后的任务会发送到错误的 queue
 register_infer_tasks()
+# chain 中之后的 GPU task 由本 worker 发送
+setup_affinity_routing()
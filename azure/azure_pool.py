@@ -0,0 +1,64 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import azure.cognitiveservices.speech as speechsdk
+
+
+class SynthesizerPool:
+    """
+    进程内按 voice 复用的 SpeechSynthesizer 池.
+    新建的 synthesizer 会预先打开连接, 合成结果输出到内存 (result.audio_data 为完整的 wav).
+    """
+
+    def __init__(self, subscription: str, region: str, max_idle_per_voice: int = 4):
+        self.subscription = subscription
+        self.region = region
+        self.max_idle_per_voice = max_idle_per_voice
+        self._idle: Dict[str, List[speechsdk.SpeechSynthesizer]] = defaultdict(list)
+        # 保持 connection 的引用, 否则连接会被关闭
+        self._connections: Dict[int, speechsdk.Connection] = {}
+        self._lock = threading.Lock()
+
+    def _create(self, voice: str) -> speechsdk.SpeechSynthesizer:
+        speech_config = speechsdk.SpeechConfig(subscription=self.subscription, region=self.region)
+        speech_config.speech_synthesis_voice_name = voice
+        speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Riff24Khz16BitMonoPcm)
+        synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+        connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+        connection.open(True)
+        self._connections[id(synthesizer)] = connection
+        return synthesizer
+
+    def _discard(self, synthesizer: speechsdk.SpeechSynthesizer):
+        connection = self._connections.pop(id(synthesizer), None)
+        if connection is not None:
+            connection.close()
+
+    def prewarm(self, voice: str, n: int = 1):
+        synthesizers = [self._create(voice) for _ in range(n)]
+        with self._lock:
+            self._idle[voice].extend(synthesizers)
+
+    @contextmanager
+    def acquire(self, voice: str) -> Iterator[speechsdk.SpeechSynthesizer]:
+        """
+        取出一个 voice 对应的 synthesizer, 使用后归还; 出现异常时丢弃
+        """
+        with self._lock:
+            synthesizer = self._idle[voice].pop() if self._idle[voice] else None
+        if synthesizer is None:
+            synthesizer = self._create(voice)
+        try:
+            yield synthesizer
+        except BaseException:
+            self._discard(synthesizer)
+            raise
+        finally:
+            synthesizer.synthesis_word_boundary.disconnect_all()
+        with self._lock:
+            if len(self._idle[voice]) < self.max_idle_per_voice:
+                self._idle[voice].append(synthesizer)
+                return
+        self._discard(synthesizer)
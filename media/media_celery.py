@@ -0,0 +1,127 @@
+import re
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import soundfile as sf
+from mcelery.cos import download_cos_file, get_local_path, upload_cos_file
+from mcelery.infer import celery_app, register_infer_tasks
+
+from affinity import setup_affinity_routing
+
+_srt_time = re.compile(r"(\d+):(\d+):(\d+)[,.](\d+)")
+
+
+def _parse_srt_time(s: str) -> float:
+    h, m, sec, ms = _srt_time.match(s.strip()).groups()
+    return int(h) * 3600 + int(m) * 60 + int(sec) + int(ms) / 1000
+
+
+def _format_srt_time(t: float) -> str:
+    ms = round(t * 1000)
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+
+def merge_srt(srts: List[str], offsets: List[float]) -> str:
+    """
+    合并多个字幕, 每个字幕的时间轴加上对应的 offset, 并重新编号
+    :param srts: srt 文件内容
+    :param offsets: 每个字幕的起始时间 (秒)
+    """
+    cues = []
+    for srt, offset in zip(srts, offsets):
+        for block in re.split(r"\n\s*\n", srt.strip()):
+            lines = block.strip().splitlines()
+            timing = next((i for i, line in enumerate(lines) if "-->" in line), None)
+            if timing is None:
+                continue
+            start, end = lines[timing].split("-->")
+            start = _format_srt_time(_parse_srt_time(start) + offset)
+            end = _format_srt_time(_parse_srt_time(end) + offset)
+            cues.append(f"{start} --> {end}\n" + "\n".join(lines[timing + 1 :]))
+    return "\n\n".join(f"{i}\n{cue}" for i, cue in enumerate(cues, 1)) + "\n"
+
+
+@celery_app.task(
+    lazy=False, name="stitch_infer", queue="media_infer", autoretry_for=(Exception,), default_retry_delay=10
+)
+def stitch_infer_task(
+    _: list,
+    audio_parts_cos: List[str],
+    output_cos: str,
+    srt_parts_cos: Optional[List[str]] = None,
+    output_srt_cos: Optional[str] = None,
+) -> str:
+    """
+    按顺序拼接分段合成的音频, 并将分段字幕的时间轴平移后合并
+    :param _: chord header 的结果, 不使用
+    :param audio_parts_cos: 分段音频 COS key
+    :param output_cos: 拼接后的音频 COS key
+    :param srt_parts_cos: 分段字幕 COS key
+    :param output_srt_cos: 合并后的字幕 COS key
+    :return: output_cos
+    """
+    datas, offsets = [], []
+    offset, samplerate, subtype = 0.0, None, None
+    for part in audio_parts_cos:
+        path = str(download_cos_file(part))
+        info = sf.info(path)
+        data, sr = sf.read(path, always_2d=True)
+        if samplerate is None:
+            samplerate, subtype = sr, info.subtype
+        elif sr != samplerate or data.shape[1] != datas[0].shape[1]:
+            raise Exception(f"audio part {part} format mismatch: {sr}Hz/{data.shape[1]}ch")
+        datas.append(data)
+        offsets.append(offset)
+        offset += len(data) / sr
+
+    sf.write(str(get_local_path(output_cos)), np.concatenate(datas), samplerate, subtype=subtype)
+    upload_cos_file(output_cos)
+
+    if srt_parts_cos and output_srt_cos:
+        srts = [Path(download_cos_file(part)).read_text(encoding="utf-8") for part in srt_parts_cos]
+        get_local_path(output_srt_cos).write_text(merge_srt(srts, offsets), encoding="utf-8")
+        upload_cos_file(output_srt_cos)
+    return output_cos
+
+
+def concat_list(paths: List[str]) -> str:
+    """
+    ffmpeg concat demuxer 的输入文件列表
+    """
+    lines = []
+    for path in paths:
+        escaped = str(Path(path).resolve()).replace("'", "'\\''")
+        lines.append(f"file '{escaped}'")
+    return "\n".join(lines) + "\n"
+
+
+@celery_app.task(lazy=False, name="mux_infer", queue="media_infer", autoretry_for=(Exception,), default_retry_delay=10)
+def mux_infer_task(_: str, video_parts_cos: List[str], output_cos: str) -> str:
+    """
+    按顺序拼接分段生成的视频. 各段由同一模型生成, 编码参数一致, 直接复制音视频流不重新编码,
+    每段的音频与视频一起拼接, 段内口型同步不受视频帧时长取整的影响
+    :param _: 拼接后的完整音频 COS key (stitch_infer 的结果), 不使用
+    :param video_parts_cos: 分段视频 COS key
+    :param output_cos: 拼接后的视频 COS key
+    :return: output_cos
+    """
+    paths = [str(download_cos_file(part)) for part in video_parts_cos]
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+        f.write(concat_list(paths))
+        f.flush()
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", f.name]
+        cmd += ["-c", "copy", "-movflags", "+faststart", str(get_local_path(output_cos))]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise Exception(f"ffmpeg concat failed: {proc.stderr.strip()}")
+    upload_cos_file(output_cos)
+    return output_cos
+
+
+# 需要注册其他 task, 否则 chain 之后的任务会发送到错误的 queue
+register_infer_tasks()
+# chain 中之后的 GPU task 由本 worker 发送
+setup_affinity_routing()
@@ -0,0 +1,3 @@
+-- [user-002] Task.stages: celery result id -> stage name, 用于 SSE 推送 stage 名称
+-- metadata.create_all 不会给已存在的表添加列, 已部署的数据库需要手动执行
+ALTER TABLE task ADD COLUMN stages JSON NULL COMMENT 'celery result id -> stage name';
@@ -0,0 +1,4 @@
+-- [user-003] Task.callback_url / callback_sent: 任务结束后 POST 结果的地址, 以及是否已处理
+ALTER TABLE task
+    ADD COLUMN callback_url VARCHAR(1024) NULL COMMENT '完成后 POST 结果的地址',
+    ADD COLUMN callback_sent BOOL NULL DEFAULT 0 COMMENT 'callback 是否已处理';
@@ -0,0 +1,4 @@
+-- [user-017] File.sha256: 上传内容的 sha256, 用于去重
+ALTER TABLE file
+    ADD COLUMN sha256 VARCHAR(64) NULL COMMENT 'content sha256',
+    ADD INDEX ix_file_sha256 (sha256);
@@ -0,0 +1,2 @@
+-- [user-018] Task.durations: celery result id -> 排队和执行时间 (秒)
+ALTER TABLE task ADD COLUMN durations JSON NULL COMMENT 'celery result id -> 排队和执行时间 (秒), 由 celery 事件得到';
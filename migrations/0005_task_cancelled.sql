@@ -0,0 +1,2 @@
+-- [user-021] Task.cancelled: 是否已取消
+ALTER TABLE task ADD COLUMN cancelled BOOL NULL DEFAULT 0 COMMENT '是否已取消';
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    进程内的 LRU 缓存, 每个条目有各自的过期时间 (unix 时间戳).
+    只在事件循环中使用, 不加锁
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: K) -> Optional[V]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expire_at = item
+        if expire_at <= time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, expire_at: float):
+        if self.max_size <= 0:
+            return
+        self._data[key] = (value, expire_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> Optional[V]:
+        item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def remove_if(self, predicate: Callable[[V], bool]) -> int:
+        """
+        删除所有满足条件的条目
+        :return: 删除的数量
+        """
+        keys = [key for key, (value, _) in self._data.items() if predicate(value)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
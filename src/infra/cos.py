@@ -0,0 +1,124 @@
+import asyncio
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from infra.disk_cache import Source
+from infra.logger import logger
+
+# 分块上传的块大小 (COS 要求除最后一块外不小于 1MB) 以及同时上传的块数
+COS_UPLOAD_PART_SIZE = int(os.getenv("COS_UPLOAD_PART_SIZE", 8 * 1024 * 1024))
+COS_UPLOAD_CONCURRENCY = int(os.getenv("COS_UPLOAD_CONCURRENCY", 4))
+
+
+async def upload_stream(
+    client: Any,
+    bucket: str,
+    key: str,
+    chunks: AsyncIterator[bytes],
+    part_size: int = COS_UPLOAD_PART_SIZE,
+    concurrency: int = COS_UPLOAD_CONCURRENCY,
+) -> int:
+    """
+    边读边上传到 COS, 不落地. 不超过 part_size 的文件直接 put_object, 否则分块上传.
+    内存中最多保留 concurrency + 1 个块; 失败或取消时中止分块上传
+    :param client: qcloud_cos.CosS3Client 或接口相同的对象, 调用在线程池中执行
+    :return: 文件大小
+    """
+    buf = bytearray()
+    size = 0
+    upload_id: Optional[str] = None
+    etags: Dict[int, str] = {}
+    uploads: List[asyncio.Task] = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def upload_part(number: int, data: bytes):
+        try:
+            resp = await run_in_threadpool(
+                client.upload_part, Bucket=bucket, Key=key, Body=data, PartNumber=number, UploadId=upload_id
+            )
+            etags[number] = resp["ETag"]
+        finally:
+            slots.release()
+
+    async def start_part(data: bytes):
+        await slots.acquire()
+        # 有块失败时尽早结束
+        for t in uploads:
+            if t.done() and t.exception():
+                slots.release()
+                raise t.exception()
+        uploads.append(asyncio.create_task(upload_part(len(uploads) + 1, data)))
+
+    try:
+        async for chunk in chunks:
+            buf += chunk
+            size += len(chunk)
+            while len(buf) > part_size:
+                if upload_id is None:
+                    resp = await run_in_threadpool(client.create_multipart_upload, Bucket=bucket, Key=key)
+                    upload_id = resp["UploadId"]
+                await start_part(bytes(buf[:part_size]))
+                del buf[:part_size]
+
+        if upload_id is None:
+            await run_in_threadpool(client.put_object, Bucket=bucket, Body=bytes(buf), Key=key)
+            return size
+
+        await start_part(bytes(buf))
+        await asyncio.gather(*uploads)
+        await run_in_threadpool(
+            client.complete_multipart_upload,
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Part": [{"PartNumber": n, "ETag": etags[n]} for n in sorted(etags)]},
+        )
+        return size
+    except BaseException:
+        for t in uploads:
+            t.cancel()
+        await asyncio.gather(*uploads, return_exceptions=True)
+        if upload_id is not None:
+            try:
+                await run_in_threadpool(client.abort_multipart_upload, Bucket=bucket, Key=key, UploadId=upload_id)
+            except Exception as e:
+                logger.error(f"abort multipart upload {key} error: {type(e).__name__}: {e}")
+        raise
+
+
+def cos_object_source(client: Any, bucket: str, key: str) -> Source:
+    """
+    用于 DiskCache 下载整个对象
+    """
+
+    def source():
+        resp = client.get_object(Bucket=bucket, Key=key)
+        return int(resp["Content-Length"]), resp["ETag"], resp.get("Content-Type"), resp["Body"].get_raw_stream().read
+
+    return source
+
+
+async def iter_cos_object(
+    client: Any, bucket: str, key: str, range_header: Optional[str] = None, chunk_size: int = 256 * 1024
+) -> Tuple[Dict[str, str], AsyncIterator[bytes]]:
+    """
+    流式读取 COS 对象, range_header 原样传给 COS
+    :return: COS 的响应头, 内容
+    """
+    kwargs = {"Range": range_header} if range_header else {}
+    resp = await run_in_threadpool(client.get_object, Bucket=bucket, Key=key, **kwargs)
+    raw = resp.pop("Body").get_raw_stream()
+
+    async def body():
+        try:
+            while True:
+                data = await run_in_threadpool(raw.read, chunk_size)
+                if not data:
+                    return
+                yield data
+        finally:
+            raw.close()
+
+    return resp, body()
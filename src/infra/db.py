@@ -1,13 +1,43 @@
 import datetime
 import os
+from typing import List, TypeVar
 
 import databases
 import ormar
 import sqlalchemy
 
+from infra.metrics import db_query_duration, observe
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-database = databases.Database(DATABASE_URL)
+
+class Database(databases.Database):
+    """
+    记录每次调用的耗时
+    """
+
+    async def execute(self, *args, **kwargs):
+        with observe(db_query_duration, "execute"):
+            return await super().execute(*args, **kwargs)
+
+    async def execute_many(self, *args, **kwargs):
+        with observe(db_query_duration, "execute_many"):
+            return await super().execute_many(*args, **kwargs)
+
+    async def fetch_all(self, *args, **kwargs):
+        with observe(db_query_duration, "fetch_all"):
+            return await super().fetch_all(*args, **kwargs)
+
+    async def fetch_one(self, *args, **kwargs):
+        with observe(db_query_duration, "fetch_one"):
+            return await super().fetch_one(*args, **kwargs)
+
+    async def fetch_val(self, *args, **kwargs):
+        with observe(db_query_duration, "fetch_val"):
+            return await super().fetch_val(*args, **kwargs)
+
+
+database = Database(DATABASE_URL)
 metadata = sqlalchemy.MetaData()
 engine = sqlalchemy.create_engine(DATABASE_URL)
 
@@ -19,3 +49,22 @@ class BaseModel(ormar.Model):
 
     id: int = ormar.Integer(primary_key=True, autoincrement=True)
     create_time: datetime.datetime = ormar.DateTime(default=datetime.datetime.now)
+
+
+T = TypeVar("T", bound=ormar.Model)
+
+
+async def bulk_create(objects: List[T]) -> List[T]:
+    """
+    与 QuerySet.bulk_create 一样使用一条多行 INSERT, 但会回填自增 id.
+    MySQL innodb_autoinc_lock_mode 为 0 或 1 (5.7 默认为 1) 时, 一条多行 INSERT 分配的 id 连续,
+    且 LAST_INSERT_ID() 为其中第一个
+    """
+    if not objects:
+        return objects
+    rows = [obj.prepare_model_to_save(obj.model_dump()) for obj in objects]
+    first_id = await database.execute(objects[0].ormar_config.table.insert().values(rows))
+    for i, obj in enumerate(objects):
+        obj.id = first_id + i
+        obj.set_save_status(True)
+    return objects
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from infra.logger import logger
+
+_chunk_size = 256 * 1024
+
+# 阻塞调用, 返回 (size, etag, content_type, read), read(n) 返回最多 n 字节, 读完时返回 b""
+Source = Callable[[], Tuple[int, str, Optional[str], Callable[[int], bytes]]]
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    size: int
+    etag: str
+    content_type: Optional[str]
+
+
+@dataclass
+class _Fill:
+    """
+    正在进行的下载, 读取方跟随写入进度读取同一个文件
+    """
+
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+    changed: asyncio.Condition = field(default_factory=asyncio.Condition)
+    entry: Optional[CacheEntry] = None
+    written: int = 0
+    done: bool = False
+    error: Optional[BaseException] = None
+
+
+@dataclass
+class CachedObject:
+    entry: CacheEntry
+    path: Path
+    fill: Optional[_Fill] = None
+
+    async def iter_bytes(self, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """
+        :param start: 起始位置
+        :param end: 结束位置 (包含), 默认到文件末尾
+        """
+        end = self.entry.size - 1 if end is None else end
+        fd = await run_in_threadpool(os.open, self.path, os.O_RDONLY)
+        try:
+            pos = start
+            while pos <= end:
+                fill = self.fill
+                if fill is not None and not fill.done and fill.written <= pos:
+                    async with fill.changed:
+                        await fill.changed.wait_for(lambda: fill.written > pos or fill.done)
+                    continue
+                if fill is not None and fill.error is not None:
+                    raise fill.error
+                available = fill.written if fill is not None and not fill.done else self.entry.size
+                data = await run_in_threadpool(os.pread, fd, min(_chunk_size, available - pos, end + 1 - pos), pos)
+                if not data:
+                    raise Exception(f"cached file {self.entry.key} truncated at {pos}")
+                pos += len(data)
+                yield data
+        finally:
+            os.close(fd)
+
+
+class DiskCache:
+    """
+    本地磁盘上的 LRU 缓存, 总大小不超过 max_bytes.
+    同一个 key 同时只有一个下载, 下载过程中的读取方直接跟随下载进度读取, 不需要等待下载完成
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._total = 0
+        self._fills: Dict[str, _Fill] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._load()
+
+    def _path(self, key: str) -> Path:
+        return self.root / hashlib.sha256(key.encode()).hexdigest()
+
+    def _load(self):
+        """
+        从磁盘恢复索引, 按最后修改时间排序; 删除没有元数据的文件 (未完成的下载)
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        metas = sorted(self.root.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for meta in metas:
+            entry = CacheEntry(**json.loads(meta.read_text()))
+            data = meta.with_suffix("")
+            if data.exists() and data.stat().st_size == entry.size:
+                self._index[entry.key] = entry
+                self._total += entry.size
+            else:
+                meta.unlink()
+        for data in self.root.iterdir():
+            if data.suffix != ".json" and not data.with_suffix(".json").exists():
+                data.unlink()
+        self._evict()
+        logger.info(f"disk cache {self.root} loaded, {len(self._index)} entries, {self._total} bytes")
+
+    def _remove(self, key: str):
+        entry = self._index.pop(key)
+        self._total -= entry.size
+        path = self._path(key)
+        path.with_suffix(".json").unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+
+    def get(self, key: str) -> Optional[CachedObject]:
+        """
+        已缓存或正在下载的对象
+        """
+        entry = self._index.get(key)
+        if entry is not None:
+            self._index.move_to_end(key)
+            return CachedObject(entry, self._path(key))
+        fill = self._fills.get(key)
+        if fill is not None and fill.entry is not None:
+            return CachedObject(fill.entry, self._path(key), fill)
+        return None
+
+    def start_fetch(self, key: str, source: Source) -> _Fill:
+        """
+        在后台下载, 已在下载时复用同一个下载
+        """
+        fill = self._fills.get(key)
+        if fill is None:
+            fill = self._fills[key] = _Fill()
+            task = asyncio.create_task(self._fetch(key, fill, source))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return fill
+
+    async def fetch(self, key: str, source: Source) -> CachedObject:
+        """
+        返回缓存的对象, 未缓存时开始下载, 在得到对象信息后即返回
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        fill = self.start_fetch(key, source)
+        await fill.ready.wait()
+        if fill.error is not None:
+            raise fill.error
+        return CachedObject(fill.entry, self._path(key), fill)
+
+    async def _fetch(self, key: str, fill: _Fill, source: Source):
+        path = self._path(key)
+        try:
+            size, etag, content_type, read = await run_in_threadpool(source)
+            fill.entry = CacheEntry(key=key, size=size, etag=etag, content_type=content_type)
+            # 不缓冲, 写入后其他读取方马上可以读到
+            with open(path, "wb", buffering=0) as f:
+                fill.ready.set()
+                while True:
+                    n = await run_in_threadpool(lambda: f.write(read(_chunk_size)))
+                    if not n:
+                        break
+                    async with fill.changed:
+                        fill.written += n
+                        fill.changed.notify_all()
+            if fill.written != size:
+                raise Exception(f"size mismatch, expected {size}, got {fill.written}")
+            if size > self.max_bytes:
+                # 只用于这一次传输, 已打开的读取方不受删除影响
+                path.unlink()
+                return
+            if key in self._index:
+                self._remove(key)
+            path.with_suffix(".json").write_text(json.dumps(fill.entry.__dict__))
+            self._index[key] = fill.entry
+            self._total += size
+            self._evict()
+        except BaseException as e:
+            logger.error(f"disk cache fetch {key} error: {type(e).__name__}: {e}")
+            fill.error = e
+            path.unlink(missing_ok=True)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self._fills.pop(key, None)
+            fill.ready.set()
+            async with fill.changed:
+                fill.done = True
+                fill.changed.notify_all()
+
+    async def close(self):
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,68 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+http_request_duration = Histogram(
+    "mercury_http_request_duration_seconds", "API 请求耗时", ["method", "route", "status"]
+)
+db_query_duration = Histogram(
+    "mercury_db_query_duration_seconds", "数据库调用耗时", ["operation"]
+)
+redis_command_duration = Histogram(
+    "mercury_redis_command_duration_seconds", "redis 调用耗时", ["command"]
+)
+# 推理 stage 的排队时间 (发送到开始执行) 和执行时间, 由 celery 事件得到
+_stage_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+stage_queue_duration = Histogram(
+    "mercury_stage_queue_duration_seconds", "推理 stage 排队时间", ["stage"], buckets=_stage_buckets
+)
+stage_run_duration = Histogram(
+    "mercury_stage_run_duration_seconds", "推理 stage 执行时间", ["stage", "state"], buckets=_stage_buckets
+)
+
+
+@contextmanager
+def observe(histogram: Histogram, *labels: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """
+    记录 API 请求耗时, 按路由模板统计 (例如 /tasks/{task_id}), 未匹配的路由记为 unmatched
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_duration.labels(
+                scope["method"], route.path if route is not None else "unmatched", str(status)
+            ).observe(time.perf_counter() - start)
+
+
+async def metrics(_: Request) -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,95 @@
+from collections import deque
+from typing import AsyncIterator, Deque, List, Optional
+
+from multipart.multipart import MultipartParser, parse_options_header
+
+
+class MultipartFileReader:
+    """
+    流式读取 multipart/form-data 请求体中的一个文件字段, 不缓存整个文件 (内存中最多保留一个网络分块).
+    先 await open() 得到文件名, 再通过 chunks() 读取文件内容; 文件字段之前的其他字段会被忽略
+    """
+
+    def __init__(self, stream: AsyncIterator[bytes], content_type: str, field: str = "file"):
+        _, params = parse_options_header(content_type)
+        if b"boundary" not in params:
+            raise ValueError("missing multipart boundary")
+        self.field = field
+        self.filename: Optional[str] = None
+        self._stream = stream.__aiter__()
+        self._eof = False
+        self._in_file = False
+        self._file_ended = False
+        self._pending: Deque[bytes] = deque()
+        self._headers: List[List[bytes]] = []
+        self._parser = MultipartParser(
+            params[b"boundary"],
+            callbacks={
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    def _on_part_begin(self):
+        self._headers = []
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        if not self._headers or self._headers[-1][1]:
+            self._headers.append([b"", b""])
+        self._headers[-1][0] += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._headers[-1][1] += data[start:end]
+
+    def _on_headers_finished(self):
+        if self.filename is not None:
+            return
+        for name, value in self._headers:
+            if name.lower() != b"content-disposition":
+                continue
+            _, options = parse_options_header(value)
+            if options.get(b"name", b"").decode() == self.field and b"filename" in options:
+                self.filename = options[b"filename"].decode()
+                self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._pending.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._file_ended = True
+
+    async def _feed(self):
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._eof = True
+            self._parser.finalize()
+            return
+        self._parser.write(chunk)
+
+    async def open(self) -> str:
+        """
+        :return: 文件名
+        """
+        while self.filename is None and not self._eof:
+            await self._feed()
+        if self.filename is None:
+            raise ValueError(f"missing file field {self.field}")
+        return self.filename
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while True:
+            while self._pending:
+                yield self._pending.popleft()
+            if self._file_ended:
+                return
+            if self._eof:
+                raise ValueError("incomplete multipart body")
+            await self._feed()
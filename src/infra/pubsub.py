@@ -0,0 +1,60 @@
+import asyncio
+from typing import Callable, Dict, Optional
+
+from infra.logger import logger
+from infra.redis_ import redis_cli
+
+# channel -> handler, handler 的参数为消息内容
+_handlers: Dict[str, Callable[[bytes], None]] = {}
+_listener: Optional[asyncio.Task] = None
+_retry_interval = 1
+_idle_timeout = 30
+
+
+def subscribe(channel: str, handler: Callable[[bytes], None]):
+    """
+    注册 channel 的处理函数, 需要在 start_pubsub 之前调用.
+    断线期间的消息会丢失, 依赖 pub/sub 失效的缓存需要有过期时间兜底
+    """
+    _handlers[channel] = handler
+
+
+async def publish(channel: str, message: str):
+    await redis_cli.publish(channel, message)
+
+
+async def _listen():
+    while True:
+        pubsub = redis_cli.pubsub()
+        try:
+            await pubsub.subscribe(*_handlers)
+            while True:
+                # 带 timeout 读取, 否则空闲时会触发 socket_timeout
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=_idle_timeout)
+                if message is None:
+                    continue
+                try:
+                    _handlers[message["channel"].decode()](message["data"])
+                except Exception as e:
+                    logger.error(f"pubsub handler of {message['channel']} error: {type(e).__name__}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"pubsub disconnected: {type(e).__name__}: {e}")
+            await asyncio.sleep(_retry_interval)
+        finally:
+            await pubsub.aclose()
+
+
+async def start_pubsub():
+    global _listener
+    if _handlers and _listener is None:
+        _listener = asyncio.create_task(_listen())
+
+
+async def stop_pubsub():
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions=True)
+        _listener = None
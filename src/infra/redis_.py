@@ -1,15 +1,91 @@
 import os
 from urllib.parse import urlparse
 
-from redis import Redis
+from redis.asyncio import BlockingConnectionPool, Redis as _Redis
+from redis.asyncio.client import Pipeline as _Pipeline
+
+from infra.metrics import observe, redis_command_duration
 
 REDIS_URL = os.getenv("REDIS_URL")
+CELERY_BACKEND = os.getenv("CELERY_BACKEND")
+CELERY_BROKER = os.getenv("CELERY_BROKER")
+
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+# 订阅 task 状态只占用一个连接 (task/state.py), 其余用于读取 state
+CELERY_BACKEND_MAX_CONNECTIONS = int(os.getenv("CELERY_BACKEND_MAX_CONNECTIONS", REDIS_MAX_CONNECTIONS))
+# 连接池用满时等待空闲连接的时间
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+
+
+class Pipeline(_Pipeline):
+    async def execute(self, *args, **kwargs):
+        with observe(redis_command_duration, "PIPELINE"):
+            return await super().execute(*args, **kwargs)
+
+
+class Redis(_Redis):
+    """
+    记录每个命令的耗时, pipeline 整体记为 PIPELINE
+    """
+
+    async def execute_command(self, *args, **options):
+        with observe(redis_command_duration, str(args[0])):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> Pipeline:
+        return Pipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+_connection_options = dict(
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    retry_on_timeout=True,
+)
 
 parsed_url = urlparse(REDIS_URL)
 
-redis_cli = Redis(
-    host=parsed_url.hostname or "0.0.0.0",
-    port=int(parsed_url.port or 6345),
-    password=parsed_url.password or "mercury",
-    db=0,
+# 连接在第一次使用时建立, lifespan 中通过 init_redis 检查
+redis_cli = Redis.from_pool(
+    BlockingConnectionPool(
+        host=parsed_url.hostname or "0.0.0.0",
+        port=int(parsed_url.port or 6345),
+        password=parsed_url.password or "mercury",
+        db=0,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        **_connection_options,
+    )
+)
+
+# celery result backend, 用于批量读取 task state
+backend_redis_cli = Redis.from_pool(
+    BlockingConnectionPool.from_url(
+        CELERY_BACKEND or "redis://localhost:6345/2",
+        max_connections=CELERY_BACKEND_MAX_CONNECTIONS,
+        **_connection_options,
+    )
+)
+
+# celery broker, 用于读取队列长度
+broker_redis_cli = Redis.from_pool(
+    BlockingConnectionPool.from_url(
+        CELERY_BROKER or "redis://localhost:6345/1",
+        max_connections=REDIS_MAX_CONNECTIONS,
+        **_connection_options,
+    )
 )
+
+
+async def init_redis():
+    await redis_cli.ping()
+    await backend_redis_cli.ping()
+    await broker_redis_cli.ping()
+
+
+async def close_redis():
+    await redis_cli.aclose()
+    await backend_redis_cli.aclose()
+    await broker_redis_cli.aclose()
@@ -2,10 +2,13 @@ from datetime import datetime, timedelta
 
 import jwt
 
+from infra.pubsub import publish
 from infra.redis_ import redis_cli
 
 _secret_key = "mercurymercury"
 _redis_key = "mercury_token"
+# clear_token 时通知各副本清除已验证 token 的缓存, 消息内容为 user_id
+token_revoke_channel = f"{_redis_key}_revoke"
 _algorithm = "HS256"
 _expire_time = 7 * 24 * 60 * 60
 
@@ -14,8 +17,8 @@ def gen_token_key(user_id: int):
     return f"{_redis_key}_{user_id}"
 
 
-def get_token(user_id: int):
-    return redis_cli.get(gen_token_key(user_id))
+async def get_token(user_id: int):
+    return await redis_cli.get(gen_token_key(user_id))
 
 
 def gen_token(user_id: int, username: str):
@@ -28,12 +31,21 @@ def gen_token(user_id: int, username: str):
     return token
 
 
-def set_token(user_id: int, token: str):
-    return redis_cli.set(gen_token_key(user_id), token, ex=_expire_time)
+async def set_token(user_id: int, token: str):
+    return await redis_cli.set(gen_token_key(user_id), token, ex=_expire_time)
 
 
-def clear_token(user_id: int):
-    return redis_cli.delete(gen_token_key(user_id))
+async def is_token_active(user_id: int, token: str) -> bool:
+    """
+    token 是否仍为该用户当前的 token, clear_token 之后失效
+    """
+    current = await redis_cli.get(gen_token_key(user_id))
+    return current is not None and current.decode() == token
+
+
+async def clear_token(user_id: int):
+    await redis_cli.delete(gen_token_key(user_id))
+    await publish(token_revoke_channel, str(user_id))
 
 
 def check_token(token: str):
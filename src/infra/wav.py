@@ -0,0 +1,49 @@
+import struct
+from typing import Optional, Tuple
+
+# 流式输出时长度未知, RIFF 和 data 的大小使用最大值, 播放器会读到流结束
+_unknown_size = 0xFFFFFFFF
+
+
+def parse_wav_header(head: bytes) -> Optional[Tuple[bytes, int, int]]:
+    """
+    解析 wav 文件头
+    :param head: 文件开头的若干字节
+    :return: None 表示需要更多字节, 否则为 (fmt chunk 内容, data 起始位置, data 大小)
+    """
+    if len(head) < 12:
+        return None
+    if head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        raise ValueError("not a wav file")
+    pos, fmt = 12, None
+    while len(head) >= pos + 8:
+        chunk_id, size = head[pos : pos + 4], struct.unpack("<I", head[pos + 4 : pos + 8])[0]
+        if chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            return fmt, pos + 8, size
+        if len(head) < pos + 8 + size:
+            return None
+        if chunk_id == b"fmt ":
+            fmt = head[pos + 8 : pos + 8 + size]
+        # chunk 按偶数字节对齐
+        pos += 8 + size + (size & 1)
+    return None
+
+
+def streaming_wav_header(fmt: bytes) -> bytes:
+    """
+    长度未知的 wav 文件头
+    :param fmt: fmt chunk 内容, 与之后输出的所有 data 一致
+    """
+    return (
+        b"RIFF"
+        + struct.pack("<I", _unknown_size)
+        + b"WAVE"
+        + b"fmt "
+        + struct.pack("<I", len(fmt))
+        + fmt
+        + (b"\x00" if len(fmt) & 1 else b"")
+        + b"data"
+        + struct.pack("<I", _unknown_size)
+    )
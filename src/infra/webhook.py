@@ -0,0 +1,95 @@
+import asyncio
+import random
+from typing import Any, Dict, List, Optional, Set
+
+import httpx
+
+from infra.logger import logger
+
+
+class WebhookSender:
+    """
+    有界的异步 webhook 发送器: 固定数量的 worker 从有界队列中取出请求并 POST,
+    失败 (网络错误, 5xx, 429) 时按指数退避重试, 其他 4xx 直接放弃.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        max_pending: int = 1000,
+        max_attempts: int = 6,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 10.0,
+    ):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._workers: List[asyncio.Task] = []
+        self._retries: Set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=self.timeout)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for t in [*self._workers, *self._retries]:
+            t.cancel()
+        await asyncio.gather(*self._workers, *self._retries, return_exceptions=True)
+        self._workers, self._retries = [], set()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send(self, url: str, payload: Dict[str, Any]) -> "asyncio.Future[bool]":
+        """
+        提交一次 POST, 队列满时等待 (背压)
+        :return: future, 成功送达为 True, 重试耗尽或被拒绝为 False
+        """
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put((url, payload, 1, done))
+        return done
+
+    async def _work(self):
+        while True:
+            url, payload, attempt, done = await self._queue.get()
+            try:
+                await self._deliver(url, payload, attempt, done)
+            except Exception as e:
+                logger.error(f"webhook {url} unexpected error: {e}")
+                if not done.done():
+                    done.set_result(False)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, url: str, payload: Dict[str, Any], attempt: int, done: asyncio.Future):
+        try:
+            resp = await self._client.post(url, json=payload)
+            if resp.is_success:
+                done.set_result(True)
+                return
+            retryable = resp.status_code >= 500 or resp.status_code == 429
+            reason = f"status {resp.status_code}"
+        except httpx.HTTPError as e:
+            retryable = True
+            reason = f"{type(e).__name__}: {e}"
+
+        if not retryable or attempt >= self.max_attempts:
+            logger.warning(f"webhook {url} failed after {attempt} attempts: {reason}")
+            done.set_result(False)
+            return
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+        logger.info(f"webhook {url} attempt {attempt} failed: {reason}, retry in {delay:.1f}s")
+        # 退避期间不占用 worker
+        t = asyncio.create_task(self._retry_later(url, payload, attempt + 1, done, delay))
+        self._retries.add(t)
+        t.add_done_callback(self._retries.discard)
+
+    async def _retry_later(self, url: str, payload: Dict[str, Any], attempt: int, done: asyncio.Future, delay: float):
+        await asyncio.sleep(delay)
+        await self._queue.put((url, payload, attempt, done))
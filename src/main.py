@@ -5,13 +5,21 @@ from fastapi import FastAPI
 
 from infra.db import database, metadata, engine
 from infra.logger import logger
+from infra.metrics import MetricsMiddleware, metrics
+from infra.pubsub import start_pubsub, stop_pubsub
+from infra.redis_ import init_redis, close_redis
 from middleware.auth import AuthMiddleware
 from middleware.exception import ExceptionMiddleware
-from routes.file import router as file_router
+from routes.file import router as file_router, start_download_cache, stop_download_cache
 from routes.infer import router as infer_router
 from routes.model import router as model_router
 from routes.task import router as task_router
 from routes.user import router as user_router
+from task.affinity import affinity_args, start_affinity, stop_affinity
+from task.callback import start_callbacks, stop_callbacks
+from task.dispatch import start_dispatcher, stop_dispatcher
+from task.monitor import start_monitor, stop_monitor
+from task.state import start_state_listener, stop_state_listener
 
 os.environ["PROJECT_ROOT"] = os.path.dirname(os.path.abspath(__file__))
 
@@ -20,8 +28,24 @@ os.environ["PROJECT_ROOT"] = os.path.dirname(os.path.abspath(__file__))
 async def lifespan(_: FastAPI):
     await database.connect()  # establish connection
     metadata.create_all(engine)  # init tables
+    await init_redis()
+    await start_download_cache()
+    await start_pubsub()
+    await start_state_listener()
+    await start_callbacks()
+    await start_monitor()
+    await start_affinity(list(affinity_args))
+    await start_dispatcher()
 
     yield
+    await stop_dispatcher()
+    await stop_affinity()
+    await stop_monitor()
+    await stop_callbacks()
+    await stop_state_listener()
+    await stop_pubsub()
+    await stop_download_cache()
+    await close_redis()
     await database.disconnect()
 
 
@@ -29,6 +53,9 @@ app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(AuthMiddleware)
 app.add_middleware(ExceptionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+app.add_route("/metrics", metrics, include_in_schema=False)
 
 app.include_router(task_router)
 app.include_router(infer_router)
@@ -1,52 +1,88 @@
+import hashlib
+import os
 import re
+import time
 
 import jwt
 from fastapi import Request, status
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
-from infra.token import check_token, decode_token
+from infra.cache import LRUCache
+from infra.logger import logger
+from infra.pubsub import subscribe
+from infra.token import decode_token, is_token_active, token_revoke_channel
 
 
 def get_user_info(request: Request):
     return getattr(request.state, "user", None)
 
 
-no_auth_path = ["/openapi.json", "/user/login", "/docs", "/flame/*"]
+no_auth_path = ["/openapi.json", "/user/login", "/docs", "/flame/*", "/metrics"]
+_no_auth_pattern = re.compile("|".join(f"(?:{pattern})" for pattern in no_auth_path))
 
+# 已验证 token 的缓存, 命中时跳过 jwt 验签和 redis 查询
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", 10000))
+# 缓存时间不超过 token 的 exp, 也不超过该值, 用于 pub/sub 撤销消息丢失时兜底
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", 60))
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
+# sha256(token) -> user info
+_verified_tokens: LRUCache[bytes, dict] = LRUCache(TOKEN_CACHE_MAX_SIZE)
 
-        if any(re.match(pattern, request.url.path) for pattern in no_auth_path):
-            return await call_next(request)
 
-        token = request.headers.get("Authorization")
+def _revoke(user_id: bytes):
+    user_id = int(user_id)
+    removed = _verified_tokens.remove_if(lambda user: user["user_id"] == user_id)
+    logger.debug(f"tokens of user {user_id} revoked, {removed} cached tokens removed")
 
-        if not token:
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"error": "missing token"},
-                headers={"WWW-Authenticate": "Bearer"},
-            )
 
+subscribe(token_revoke_channel, _revoke)
+
+
+def _unauthorized(error: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        content={"error": error},
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+async def _verify(token: str) -> dict:
+    """
+    :return: token 中的用户信息
+    :raise jwt.InvalidTokenError: token 无效, 过期或已被撤销
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    user = _verified_tokens.get(key)
+    if user is not None:
+        return user
+    user = decode_token(token)
+    if not await is_token_active(user["user_id"], token):
+        raise jwt.InvalidTokenError("token revoked")
+    _verified_tokens.set(key, user, min(user["exp"], time.time() + TOKEN_CACHE_TTL))
+    return user
+
+
+class AuthMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or _no_auth_pattern.match(scope["path"]):
+            return await self.app(scope, receive, send)
+
+        authorization = next((v for k, v in scope["headers"] if k == b"authorization"), None)
+        if not authorization:
+            return await _unauthorized("missing token")(scope, receive, send)
+
+        _, _, token = authorization.decode("latin-1").partition(" ")
         try:
-            token = token.split(" ")[1]
-            res = check_token(token)
-            if not res:
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={"error": "Invalid authentication credentials"},
-                    headers={"WWW-Authenticate": "Bearer"},
-                )
-
-            userInfo = decode_token(token)
-            request.state.user = userInfo
+            user = await _verify(token)
         except jwt.ExpiredSignatureError:
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"error": "token expired"},
-                headers={"WWW-Authenticate": "Bearer"},
-            )
+            return await _unauthorized("token expired")(scope, receive, send)
+        except jwt.InvalidTokenError:
+            return await _unauthorized("Invalid authentication credentials")(scope, receive, send)
 
-        return await call_next(request)
+        # request.state 读取的是 scope["state"]
+        scope.setdefault("state", {})["user"] = user
+        await self.app(scope, receive, send)
@@ -1,9 +1,14 @@
+import json
+import os
+import time
 import uuid
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import ormar
 
-from infra.db import BaseModel, base_ormar_config
+from infra.cache import LRUCache
+from infra.db import BaseModel, base_ormar_config, bulk_create
+from infra.pubsub import publish, subscribe
 
 
 class File(BaseModel):
@@ -12,6 +17,7 @@ class File(BaseModel):
     name: str = ormar.String(max_length=255, nullable=False, comment="raw file name")
     key: str = ormar.String(max_length=255, nullable=True, comment="file key in cos")
     user_id: int = ormar.Integer(foreign_key=True, nullable=False)
+    sha256: Optional[str] = ormar.String(max_length=64, nullable=True, index=True, comment="content sha256")
 
 
 def query_file(file_id: Optional[int], user_id=Optional[int]):
@@ -23,11 +29,76 @@ def query_file(file_id: Optional[int], user_id=Optional[int]):
     return q.first()
 
 
-async def create_file(name: str, key: str, user_id: int) -> File:
-    return await File.objects.create(name=name, key=key, user_id=user_id)
+# 文件创建后不会修改, 用户文件的查询结果在进程内缓存; 删除时通知所有副本清除
+FILE_CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", 300))
+_user_files: LRUCache[Tuple[int, int], File] = LRUCache(int(os.getenv("FILE_CACHE_MAX_SIZE", 10000)))
+_invalidate_channel = "mercury_file_invalidate"
 
 
-async def create_infer_file(user_id: int, suffix: str, uid: str = None) -> File:
+async def get_user_file(file_id: int, user_id: int) -> Optional[File]:
+    """
+    查询属于该用户的文件, 不存在时返回 None (不缓存)
+    """
+    file = _user_files.get((file_id, user_id))
+    if file is None:
+        file = await File.objects.get_or_none(id=file_id, user_id=user_id)
+        if file is not None:
+            _user_files.set((file_id, user_id), file, time.time() + FILE_CACHE_TTL)
+    return file
+
+
+def _evict_files(message: bytes):
+    file_ids = set(json.loads(message))
+    _user_files.remove_if(lambda file: file.id in file_ids)
+
+
+async def delete_files(files: List[File]):
+    """
+    删除文件记录 (不删除 COS 对象), 并清除本进程和其他副本的缓存
+    """
+    if not files:
+        return
+    file_ids = [file.id for file in files]
+    await File.objects.filter(id__in=file_ids).delete()
+    message = json.dumps(file_ids)
+    _evict_files(message.encode())
+    await publish(_invalidate_channel, message)
+
+
+subscribe(_invalidate_channel, _evict_files)
+
+
+async def create_file(name: str, key: str, user_id: int, sha256: Optional[str] = None) -> File:
+    return await File.objects.create(name=name, key=key, user_id=user_id, sha256=sha256)
+
+
+async def query_file_by_sha256(sha256: str, user_id: Optional[int] = None) -> Optional[File]:
+    """
+    内容相同的已有文件, 用于上传去重
+    :param user_id: 不为空时只查询该用户的文件
+    """
+    q = File.objects.filter(sha256=sha256)
+    if user_id is not None:
+        q = q.filter(user_id=user_id)
+    files = await q.order_by("id").limit(1).all()
+    return files[0] if files else None
+
+
+async def create_files(files: List[File]) -> List[File]:
+    """
+    用一条多行 INSERT 创建多个未保存的文件, 并回填 id
+    """
+    return await bulk_create(files)
+
+
+def new_infer_file(user_id: int, suffix: str, uid: str = None) -> File:
+    """
+    未保存的推理输出文件, 用于批量插入
+    """
     name = (uid or uuid.uuid4().hex) + suffix
     key = f"infer/{name}"
-    return await File.objects.create(name=name, key=key, user_id=user_id)
+    return File(name=name, key=key, user_id=user_id)
+
+
+async def create_infer_file(user_id: int, suffix: str, uid: str = None) -> File:
+    return await new_infer_file(user_id, suffix, uid).save()
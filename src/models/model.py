@@ -1,8 +1,13 @@
-from typing import Any, Optional, Dict
+import asyncio
+import os
+import time
+from typing import Any, Optional, Dict, List
 
 import ormar
 
 from infra.db import BaseModel, base_ormar_config
+from infra.pubsub import publish, subscribe
+from task.cache import invalidate_tts_cache
 
 
 class Model(BaseModel):
@@ -15,24 +20,87 @@ class Model(BaseModel):
     video_config: Dict[str, Any] = ormar.JSON(default={}, comment="preview_image_id")
 
 
-def query_model(name: Optional[str] = None, model_id: Optional[int] = None):
-    q = Model.objects
-    if name is not None:
-        q = q.filter(name=name)
-    if model_id is not None:
-        q = q.filter(id=model_id)
-    return q.all()
+# 进程内模型缓存的过期时间, 用于 pub/sub 失效消息丢失时兜底; 为 0 时每次都查询数据库
+MODEL_CACHE_TTL = float(os.getenv("MODEL_CACHE_TTL", 60))
+_invalidate_channel = "mercury_model_invalidate"
+
+# model 表很小, 缓存全表
+_catalog: List[Model] = []
+_catalog_expire_at = 0.0
+# 每次失效加 1, 避免失效前开始的查询把旧数据写回缓存
+_catalog_version = 0
+_catalog_lock = asyncio.Lock()
+
+
+async def _load_catalog() -> List[Model]:
+    global _catalog, _catalog_expire_at
+    if time.monotonic() < _catalog_expire_at:
+        return _catalog
+    async with _catalog_lock:
+        if time.monotonic() < _catalog_expire_at:
+            return _catalog
+        version = _catalog_version
+        models = await Model.objects.all()
+        if version == _catalog_version:
+            _catalog, _catalog_expire_at = models, time.monotonic() + MODEL_CACHE_TTL
+        return models
+
+
+def _clear_catalog(_: Any = None):
+    global _catalog_expire_at, _catalog_version
+    _catalog_expire_at = 0.0
+    _catalog_version += 1
+
+
+async def invalidate_model_cache():
+    """
+    清除本进程的模型缓存, 并通知其他副本
+    """
+    _clear_catalog()
+    await publish(_invalidate_channel, "1")
+
+
+subscribe(_invalidate_channel, _clear_catalog)
+
+
+async def query_model(name: Optional[str] = None, model_id: Optional[int] = None) -> List[Model]:
+    """
+    从进程内缓存查询模型, 返回的对象在请求之间共享, 不要修改
+    """
+    return [
+        model
+        for model in await _load_catalog()
+        if (name is None or model.name == name) and (model_id is None or model.id == model_id)
+    ]
+
+
+async def query_models_by_names(names: List[str]) -> List[Model]:
+    names = set(names)
+    return [model for model in await _load_catalog() if model.name in names]
 
 
 async def create_model(**kwargs: Any):
-    return await Model.objects.create(**kwargs)
+    model = await Model.objects.create(**kwargs)
+    await invalidate_model_cache()
+    return model
 
 
 async def update_model(model_id: int, **kwargs: Any):
     model = await Model.objects.get(id=model_id)
+    old_name = model.name
     model = await model.update(**kwargs)
+    await invalidate_model_cache()
+    # 模型变化后之前的 tts 结果不再有效
+    await invalidate_tts_cache(old_name)
+    if model.name != old_name:
+        await invalidate_tts_cache(model.name)
     return model
 
 
-def delete_model(model_id: int):
-    return Model.objects.delete(id=model_id)
+async def delete_model(model_id: int):
+    model = await Model.objects.get_or_none(id=model_id)
+    if model is not None:
+        await invalidate_tts_cache(model.name)
+    deleted = await Model.objects.delete(id=model_id)
+    await invalidate_model_cache()
+    return deleted
@@ -1,11 +1,12 @@
+import datetime
 from enum import Enum
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 
 import ormar
-from celery.result import ResultBase, AsyncResult, GroupResult
+from celery import Signature
 
-from infra.db import BaseModel, base_ormar_config
-from models.file import File
+from infra.db import BaseModel, base_ormar_config, database
+from models.file import File, create_files
 
 
 class TaskStatus(int, Enum):
@@ -13,6 +14,7 @@ class TaskStatus(int, Enum):
     PENDING = 1
     SUCCEEDED = 2
     FAILED = 3
+    CANCELLED = 4
 
 
 class Task(BaseModel):
@@ -26,6 +28,13 @@ class Task(BaseModel):
     user_id: int = ormar.Integer(foreign_key=True, nullable=False)
     res: Dict[str, Any] = ormar.JSON(default={}, comment="all output files")
     celery_ids: List[str] = ormar.JSON(default={}, comment="all celery result ids in task")
+    stages: Dict[str, str] = ormar.JSON(default={}, nullable=True, comment="celery result id -> stage name")
+    callback_url: Optional[str] = ormar.String(max_length=1024, nullable=True, comment="完成后 POST 结果的地址")
+    callback_sent: bool = ormar.Boolean(default=False, comment="callback 是否已处理")
+    cancelled: bool = ormar.Boolean(default=False, comment="是否已取消")
+    durations: Dict[str, Dict[str, float]] = ormar.JSON(
+        default={}, nullable=True, comment="celery result id -> 排队和执行时间 (秒), 由 celery 事件得到"
+    )
 
 
 def query_task(task_id: Optional[int], user_id=Optional[int]):
@@ -34,12 +43,51 @@ def query_task(task_id: Optional[int], user_id=Optional[int]):
         q = q.filter(id=task_id)
     if user_id is not None:
         q = q.filter(user_id=user_id)
-    return q.first()
+    # first 在没有结果时抛出 NoMatch
+    return q.get_or_none() if task_id is not None else q.first()
 
 
-async def create_task(
-    user_id: int, rst: ResultBase, audio_file: File = None, srt_file: File = None, video_file: File = None
+def query_tasks(task_ids: List[int], user_id: int):
+    return Task.objects.filter(id__in=task_ids, user_id=user_id).all()
+
+
+def query_callback_tasks(since: datetime.datetime):
+    """
+    查询 since 之后创建且 callback 尚未处理的 task
+    """
+    return Task.objects.filter(callback_url__isnull=False, callback_sent=False, create_time__gte=since).all()
+
+
+def mark_callback_sent(task_id: int):
+    return Task.objects.filter(id=task_id).update(callback_sent=True)
+
+
+def mark_task_cancelled(task_id: int):
+    return Task.objects.filter(id=task_id).update(cancelled=True)
+
+
+async def set_stage_durations(task_id: int, celery_id: str, durations: Dict[str, float]):
+    """
+    记录一个 stage 的耗时, 只更新 durations 列
+    """
+    task = await Task.objects.get_or_none(id=task_id)
+    if task is None:
+        return
+    await task.update(_columns=["durations"], durations={**(task.durations or {}), celery_id: durations})
+
+
+def new_task(
+    user_id: int,
+    stages: Dict[str, str],
+    audio_file: File = None,
+    srt_file: File = None,
+    video_file: File = None,
+    callback_url: Optional[str] = None,
 ) -> Task:
+    """
+    未保存的 Task, 用于批量插入
+    :param stages: celery result id -> stage name, 见 all_stages
+    """
     res = {}
     if audio_file:
         res["output_audio_file_id"] = audio_file.id
@@ -50,19 +98,61 @@ async def create_task(
     if video_file:
         res["output_video_file_id"] = video_file.id
         res["output_video_file_key"] = video_file.key
-    return await Task.objects.create(user_id=user_id, res=res, celery_ids=all_res_ids(rst))
+    return Task(user_id=user_id, res=res, celery_ids=list(stages), stages=stages, callback_url=callback_url)
+
+
+async def create_task(
+    user_id: int,
+    stages: Dict[str, str],
+    audio_file: File = None,
+    srt_file: File = None,
+    video_file: File = None,
+    callback_url: Optional[str] = None,
+) -> Task:
+    return await new_task(user_id, stages, audio_file, srt_file, video_file, callback_url).save()
+
+
+async def create_task_with_files(
+    user_id: int, stages: Dict[str, str], files: Dict[str, File], callback_url: Optional[str] = None
+) -> Task:
+    """
+    在同一个事务中用一条多行 INSERT 创建所有未保存的输出文件, 再创建 Task
+    :param files: 输出文件, audio / srt / video 会记录到 Task.res, 其他 (例如中间文件) 只创建
+    """
+    async with database.transaction():
+        await create_files([file for file in files.values() if file.pk is None])
+        return await create_task(
+            user_id,
+            stages,
+            audio_file=files.get("audio"),
+            srt_file=files.get("srt"),
+            video_file=files.get("video"),
+            callback_url=callback_url,
+        )
+
+
+def stage_name(task_name: str) -> str:
+    """
+    celery task name 转换为 stage name, 例如 azure_infer -> azure
+    """
+    return task_name.removesuffix("_infer")
 
 
-def all_res_ids(rst: ResultBase) -> List[str]:
+def all_stages(sig: Union[Signature, List[Signature]]) -> Dict[str, str]:
     """
-    从最终的 rst 中获取所有中间 task rst
+    从已 freeze 的 signature 中按执行顺序获取所有 celery result id 及其 stage
+    :param sig: signature, 或从 json 还原的 chord header (list)
     """
-    ids = []
-    if rst.parent:
-        ids.extend(all_res_ids(rst.parent))
-    if isinstance(rst, AsyncResult):
-        ids.append(rst.id)
-    elif isinstance(rst, GroupResult):
-        for r in rst.results:
-            ids.extend(all_res_ids(r))
-    return ids
+    stages = {}
+    if isinstance(sig, (list, tuple)):
+        for t in sig:
+            stages.update(all_stages(t))
+    elif sig.task in ("celery.chain", "celery.group"):
+        for t in sig.tasks:
+            stages.update(all_stages(t))
+    elif sig.task == "celery.chord":
+        stages.update(all_stages(sig.tasks))
+        stages.update(all_stages(sig.body))
+    else:
+        stages[sig.id] = stage_name(sig.task)
+    return stages
@@ -45,8 +45,8 @@ async def get_user_token(account: str, password: str):
     user = await User.objects.get(account=account, password=password)
     if user is None:
         raise Exception("user not found")
-    token = get_token(user.id)
+    token = await get_token(user.id)
     if token is None:
         token = gen_token(user.id, user.account)
-        set_token(user.id, token)
+        await set_token(user.id, token)
     return token
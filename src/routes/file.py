@@ -1,18 +1,169 @@
+import hashlib
 import os
-import shutil
+import re
+import time
 import uuid
 from mimetypes import guess_type
+from typing import AsyncIterator, Mapping, Optional, Tuple
+from urllib.parse import quote
 
-from fastapi import APIRouter, HTTPException, Request, Response, UploadFile
-from mcelery.cos import get_local_path, upload_cos_file, download_cos_file, cos_client, cos_bucket
-from starlette.responses import RedirectResponse, FileResponse
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from mcelery.cos import cos_client, cos_bucket
+from starlette.responses import RedirectResponse
 
+from infra.cache import LRUCache
+from infra.cos import upload_stream, cos_object_source, iter_cos_object
+from infra.disk_cache import DiskCache, CachedObject
+from infra.logger import logger
+from infra.multipart import MultipartFileReader
 from middleware.auth import get_user_info
-from models.file import File, create_file
+from models.file import File, create_file, get_user_file, query_file_by_sha256
 
+# 下载时的本地缓存, 超过大小后淘汰最久未使用的文件. 默认为 PROJECT_ROOT 下的 download_cache
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024))
 
-async def _download_file(file_id: int, user_id: int, media_type: str = None) -> Response:
-    file = await File.objects.filter(id=file_id, user_id=user_id).first()
+# 在 lifespan 中创建, import 时不创建目录
+download_cache: Optional[DiskCache] = None
+
+# DOWNLOAD_REDIRECT 模式下预签名 URL 的有效期, 各路由可以单独设置
+DOWNLOAD_REDIRECT_EXPIRE = int(os.getenv("DOWNLOAD_REDIRECT_EXPIRE", 300))
+# (key, media_type, disposition, expire) -> 预签名 URL
+_presigned_urls: LRUCache[Tuple[str, str, str, int], str] = LRUCache(int(os.getenv("PRESIGNED_URL_CACHE_SIZE", 10000)))
+
+_range_pattern = re.compile(r"bytes=(\d*)-(\d*)$")
+# 请求的区间超出正在下载的部分这么多时, 直接从 COS 读取而不是等待下载
+_range_passthrough_gap = 4 * 1024 * 1024
+
+
+async def start_download_cache():
+    global download_cache
+    root = DOWNLOAD_CACHE_DIR or os.path.join(os.environ["PROJECT_ROOT"], "download_cache")
+    # 从磁盘恢复索引
+    download_cache = await run_in_threadpool(DiskCache, root, DOWNLOAD_CACHE_MAX_BYTES)
+
+
+async def stop_download_cache():
+    if download_cache is None:
+        return
+    await download_cache.close()
+
+
+def _parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    只支持单个区间, 不支持的格式返回 None (返回完整内容)
+    :return: (start, end), end 包含在内
+    """
+    m = _range_pattern.match(value.strip())
+    if m is None or m.groups() == ("", ""):
+        return None
+    start, end = m.groups()
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end:
+        raise HTTPException(
+            status_code=416, detail="range not satisfiable", headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _cached_response(
+    cached: CachedObject, media_type: str, disposition: str, headers: Mapping[str, str]
+) -> Optional[Response]:
+    """
+    :return: 请求的区间还没有下载到时返回 None
+    """
+    entry = cached.entry
+    common = {"ETag": entry.etag, "Accept-Ranges": "bytes", "Content-Disposition": disposition}
+    if_none_match = headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+
+    byte_range = _parse_range(headers["range"], entry.size) if "range" in headers else None
+    if byte_range is None:
+        return StreamingResponse(
+            cached.iter_bytes(), media_type=media_type, headers={**common, "Content-Length": str(entry.size)}
+        )
+    start, end = byte_range
+    if cached.fill is not None and not cached.fill.done and start > cached.fill.written + _range_passthrough_gap:
+        return None
+    return StreamingResponse(
+        cached.iter_bytes(start, end),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            **common,
+            "Content-Range": f"bytes {start}-{end}/{entry.size}",
+            "Content-Length": str(end - start + 1),
+        },
+    )
+
+
+async def _cos_range_response(key: str, range_header: str, media_type: str, disposition: str) -> Response:
+    """
+    Range 请求未命中缓存时直接转发给 COS
+    """
+    try:
+        resp, body = await iter_cos_object(cos_client, cos_bucket, key, range_header)
+    except Exception as e:
+        if getattr(e, "get_status_code", lambda: None)() == 416:
+            raise HTTPException(status_code=416, detail="range not satisfiable")
+        raise
+    headers = {k: resp[k] for k in ("Content-Length", "Content-Range", "ETag") if k in resp}
+    return StreamingResponse(
+        body,
+        status_code=206 if "Content-Range" in resp else 200,
+        media_type=media_type,
+        headers={**headers, "Accept-Ranges": "bytes", "Content-Disposition": disposition},
+    )
+
+
+def _presigned_url(key: str, media_type: str, disposition: str, expire: int) -> str:
+    cache_key = (key, media_type, disposition, expire)
+    url = _presigned_urls.get(cache_key)
+    if url is None:
+        url = cos_client.get_presigned_url(
+            Bucket=cos_bucket,
+            Key=key,
+            Method="GET",
+            Expired=expire,
+            Params={"response-content-type": media_type, "response-content-disposition": disposition},
+        )
+        # 复用到剩余有效期为 1/5 时, 保证返回的 URL 至少还有 expire / 5 秒
+        _presigned_urls.set(cache_key, url, time.time() + expire * 0.8)
+    return url
+
+
+async def _download_file(
+    file_id: int,
+    user_id: int,
+    media_type: str = None,
+    headers: Optional[Mapping[str, str]] = None,
+    redirect_expire: int = DOWNLOAD_REDIRECT_EXPIRE,
+) -> Response:
+    """
+    从本地缓存流式返回, 未缓存时边从 COS 下载边返回; 支持单个区间的 Range 和 If-None-Match
+    :param headers: 请求头
+    :param redirect_expire: DOWNLOAD_REDIRECT 模式下预签名 URL 的有效期
+    """
+    file = await get_user_file(file_id, user_id)
     if file is None:
         raise HTTPException(status_code=404, detail="file not found")
 
@@ -21,23 +172,21 @@ async def _download_file(file_id: int, user_id: int, media_type: str = None) ->
 
     if os.getenv("DOWNLOAD_REDIRECT"):
         return RedirectResponse(
-            url=cos_client.get_presigned_url(
-                Bucket=cos_bucket,
-                Key=file.key,
-                Method="GET",
-                Expired=300,
-                Params={
-                    "response-content-type": media_type,
-                    "response-content-disposition": f"attachment; filename={file.name}",
-                },
-            )
+            url=_presigned_url(file.key, media_type, f"attachment; filename={file.name}", redirect_expire)
         )
 
-    return FileResponse(
-        path=download_cos_file(file.key),
-        media_type=media_type,
-        filename=file.name,
-    )
+    headers = headers or {}
+    disposition = _content_disposition(file.name)
+    source = cos_object_source(cos_client, cos_bucket, file.key)
+    cached = download_cache.get(file.key)
+    if cached is None and "range" not in headers:
+        cached = await download_cache.fetch(file.key, source)
+    response = _cached_response(cached, media_type, disposition, headers) if cached else None
+    if response is None:
+        # 播放器拖动进度时不等待整个文件下载, 同时在后台缓存, 之后的请求从缓存读取
+        download_cache.start_fetch(file.key, source)
+        response = await _cos_range_response(file.key, headers["range"], media_type, disposition)
+    return response
 
 
 router = APIRouter(
@@ -45,22 +194,73 @@ router = APIRouter(
 )
 
 
-@router.post("/upload", response_model=File)
-async def upload_video(
-    file: UploadFile,
-    req: Request,
-):
+# 请求体由 MultipartFileReader 流式解析, 不使用 UploadFile, 这里补充文档中的请求格式
+_upload_openapi = {
+    "parameters": [
+        {
+            "name": "X-Content-SHA256",
+            "in": "header",
+            "required": False,
+            "schema": {"type": "string"},
+            "description": "文件内容的 sha256 (hex), 该用户已上传过相同内容时不再传输",
+        }
+    ],
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    },
+}
+
+
+async def _hashing(chunks: AsyncIterator[bytes], hasher) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+@router.post("/upload", response_model=File, openapi_extra=_upload_openapi)
+async def upload_video(req: Request):
+    """
+    上传文件, 请求体边读边分块上传到 COS, 不写本地文件. COS 上传完成后才创建 File.
+    相同内容的文件共用一个 COS 对象
+    """
     user = get_user_info(req)
     user_id = user["user_id"]
 
-    key = f"upload/{uuid.uuid4().hex}"
-    # write to local
-    with get_local_path(key).open("wb") as writer:
-        shutil.copyfileobj(file.file, writer)
-    # create and upload
-    file_model = await create_file(name=file.filename, key=key, user_id=user_id)
-    upload_cos_file(key)
-    return file_model
+    try:
+        reader = MultipartFileReader(req.stream(), req.headers.get("content-type", ""))
+        filename = await reader.open()
+
+        # 客户端声明的 hash 未经验证, 只在该用户自己的文件中查找, 避免通过 hash 拿到其他用户的文件
+        declared = req.headers.get("x-content-sha256", "").lower()
+        existing = await query_file_by_sha256(declared, user_id=user_id) if declared else None
+        if existing is not None:
+            logger.info(f"upload of {filename} skipped, same content as file {existing.id}")
+            return await create_file(name=filename, key=existing.key, user_id=user_id, sha256=existing.sha256)
+
+        key = f"upload/{uuid.uuid4().hex}"
+        hasher = hashlib.sha256()
+        size = await upload_stream(cos_client, cos_bucket, key, _hashing(reader.chunks(), hasher))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    sha256 = hasher.hexdigest()
+    logger.info(f"file {key} uploaded, size: {size}, sha256: {sha256}")
+
+    existing = await query_file_by_sha256(sha256)
+    if existing is not None and existing.key != key:
+        # 已有相同内容的对象, 删除刚上传的对象
+        await run_in_threadpool(cos_client.delete_object, Bucket=cos_bucket, Key=key)
+        key = existing.key
+        logger.info(f"file {sha256} deduplicated to {key}")
+    return await create_file(name=filename, key=key, user_id=user_id, sha256=sha256)
 
 
 class DownloadResponse(Response):
@@ -72,4 +272,6 @@ class DownloadResponse(Response):
 async def download_file(file_id: int, req: Request):
     user = get_user_info(req)
     user_id = user["user_id"]
-    return await _download_file(file_id=file_id, user_id=user_id, media_type="application/octet-stream")
+    return await _download_file(
+        file_id=file_id, user_id=user_id, media_type="application/octet-stream", headers=req.headers
+    )
@@ -1,22 +1,56 @@
+import datetime
+import os
 import uuid
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 
+from celery import Signature
 from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import AnyHttpUrl, BaseModel, Field
+from starlette.requests import ClientDisconnect
 
+from infra.db import database, bulk_create
 from infra.logger import logger
 from middleware.auth import get_user_info
-from models.file import query_file, create_infer_file
-from models.model import query_model
-from models.task import create_task
+from models.file import File, query_file, create_files, new_infer_file
+from models.model import Model, query_model, query_models_by_names
+from models.task import Task, TaskStatus, create_task_with_files, new_task, all_stages
 from routes.common import CommonSchemaConfig
-from task.infer import publish_talking_head_infer_task, publish_text_task, AudioModeType
+from task.cache import tts_cache_key, tts_cache_entry, entry_stages, usable_outputs, get_tts_cache, set_tts_cache
+from task.admission import check_admission
+from task.callback import watch_callback
+from task.dispatch import defer
+from task.infer import (
+    publish,
+    publish_many,
+    build_talking_head_infer_task,
+    build_text_task,
+    build_audio_task,
+    AudioModeType,
+    Lane,
+    LONG_TEXT_CHUNK_SIZE,
+    STREAM_TEXT_CHUNK_SIZE,
+    audio_segments,
+    set_deadline,
+)
+from task.monitor import track_tasks
+from task.state import resolve_states, merge_status
+from task.stream import stream_audio
 
 router = APIRouter(
     prefix="/infer",
 )
 
 
+async def _query_model(model_name: str) -> Model:
+    models = await query_model(name=model_name)
+    if len(models) == 0:
+        raise HTTPException(status_code=404, detail=f"model {model_name} not found")
+    return models[0]
+
+
 class InferVideoResponse(BaseModel):
     task_id: int
 
@@ -26,23 +60,29 @@ async def infer_video(
     model_name: str,
     file_id: int,
     req: Request,
+    callback_url: Optional[AnyHttpUrl] = None,
+    lane: Lane = Lane.INTERACTIVE,
+    deadline: Optional[datetime.datetime] = None,
 ):
     user = get_user_info(req)
     user_id = user["user_id"]
 
-    models = await query_model(name=model_name)
-    model = models[0]
-
-    if model is None:
-        raise HTTPException(status_code=404, detail=f"model {model_name} not found")
+    model = await _query_model(model_name)
 
     audio_file = await query_file(file_id=file_id, user_id=user_id)
     if audio_file is None:
         raise HTTPException(status_code=404, detail=f"file {file_id} not found")
 
-    file = await create_infer_file(user_id, ".mp4")
-    rst = publish_talking_head_infer_task(str(audio_file.id), model.video_model, file.key)
-    task = await create_task(user_id, rst, video_file=file)
+    file = new_infer_file(user_id, ".mp4")
+    sig = _with_deadline(build_talking_head_infer_task(str(audio_file.id), model.video_model, file.key), deadline)
+    sig.freeze()
+    await _admit(user_id, all_stages(sig), lane)
+    task = await create_task_with_files(
+        user_id, all_stages(sig), {"video": file}, callback_url=callback_url and str(callback_url)
+    )
+    await track_tasks([task])
+    await _send(user_id, [sig], lane)
+    watch_callback(task)
 
     return JSONResponse({"task_id": task.id})
 
@@ -59,52 +99,32 @@ class Text2VideoRequest(BaseModel):
         False,
         description="是否同步生成字幕文件，默认不生成。若为True,将在任务详情中返回 res.output_srt_file_id",
     )  # 是否同步生成 字幕文件
+    long_text: bool = Field(
+        False,
+        description="长文本模式: 按句子切分为多段并行合成, 再按顺序拼接音频和字幕",
+    )
+    segmented: bool = Field(
+        False,
+        description="分段生成视频: 按句子切分, 每段音频合成后立即生成该段视频, 最后拼接. 长视频的 tts 与视频生成同时进行",
+    )
+    callback_url: Optional[AnyHttpUrl] = Field(
+        None,
+        description="任务结束后将 task 详情 (包括输出文件的 id 和 key) POST 到该地址",
+    )
+    lane: Lane = Field(
+        Lane.INTERACTIVE,
+        description="interactive: 优先执行, 队列积压时返回 429; batch: 按用户公平排队, 在 interactive 任务之后执行",
+    )
+    deadline: Optional[datetime.datetime] = Field(
+        None,
+        description="GPU stage 在该时间之前没有开始执行时自动取消 task, 不带时区时视为 UTC",
+    )
 
 
 class Text2VideoResponse(BaseModel):
     task_id: int
 
 
-@router.post("/text2video", response_model=Text2VideoResponse)
-async def infer_text2video(body: Text2VideoRequest, req: Request):
-    user = get_user_info(req)
-    logger.debug("user: %s", user)
-    user_id = user["user_id"]
-
-    models = await query_model(name=body.model_name)
-    if len(models) == 0:
-        raise HTTPException(status_code=404, detail=f"model {body.model_name} not found")
-    model = models[0]
-    if model is None:
-        raise HTTPException(status_code=404, detail=f"model {body.model_name} not found")
-
-    uid = uuid.uuid4().hex
-    audio_file = await create_infer_file(user_id, ".wav", uid)
-    video_file = await create_infer_file(user_id, ".mp4", uid)
-    if body.mode == AudioModeType.RVC:
-        azure_audio_file = await create_infer_file(user_id, ".azure.wav", uid)
-    else:
-        azure_audio_file = None
-    if body.gen_srt:
-        srt_file = await create_infer_file(user_id, ".srt", uid)
-    else:
-        srt_file = None
-
-    rst = publish_text_task(
-        text=body.text,
-        model_name=body.model_name,
-        output_audio_cos=audio_file.key,
-        azure_audio_profile=body.audio_profile,
-        azure_output_audio_cos=azure_audio_file.key if azure_audio_file else None,
-        pitch=model.audio_config.get("pitch", 0),
-        speaker=model.video_model,
-        output_video_cos=video_file.key,
-        output_srt_cos=srt_file.key if srt_file else None,
-    )
-    task = await create_task(user_id, rst, audio_file=audio_file, video_file=video_file, srt_file=srt_file)
-    return JSONResponse({"task_id": task.id})
-
-
 class Text2AudioRequest(BaseModel):
     class Config(CommonSchemaConfig):
         pass
@@ -117,43 +137,378 @@ class Text2AudioRequest(BaseModel):
         False,
         description="是否同步生成字幕文件，默认不生成。若为True,将在任务详情中返回 res.output_srt_file_id",
     )  # 是否同步生成 字幕文件
+    long_text: bool = Field(
+        False,
+        description="长文本模式: 按句子切分为多段并行合成, 再按顺序拼接音频和字幕",
+    )
+    callback_url: Optional[AnyHttpUrl] = Field(
+        None,
+        description="任务结束后将 task 详情 (包括输出文件的 id 和 key) POST 到该地址",
+    )
+    lane: Lane = Field(
+        Lane.INTERACTIVE,
+        description="interactive: 优先执行, 队列积压时返回 429; batch: 按用户公平排队, 在 interactive 任务之后执行",
+    )
+    deadline: Optional[datetime.datetime] = Field(
+        None,
+        description="GPU stage 在该时间之前没有开始执行时自动取消 task, 不带时区时视为 UTC",
+    )
 
 
 class Text2AudioResponse(BaseModel):
     task_id: int
 
 
-@router.post("/text2audio", response_model=Text2AudioResponse)
-async def infer_text2audio(body: Text2AudioRequest, req: Request):
-    user = get_user_info(req)
-    logger.debug("user: %s", user)
-    user_id = user["user_id"]
+def _with_deadline(sig: Signature, deadline: Optional[datetime.datetime]) -> Signature:
+    """
+    设置 GPU stage 的 deadline, 已经过去时返回 422
+    """
+    if deadline is None:
+        return sig
+    if deadline.tzinfo is None:
+        deadline = deadline.replace(tzinfo=datetime.timezone.utc)
+    if deadline <= datetime.datetime.now(datetime.timezone.utc):
+        raise HTTPException(status_code=422, detail="deadline has passed")
+    return set_deadline(sig, deadline)
 
-    models = await query_model(name=body.model_name)
-    model = models[0]
-    if model is None:
-        raise HTTPException(status_code=404, detail=f"model {body.model_name} not found")
 
-    uid = uuid.uuid4().hex
-    audio_file = await create_infer_file(user_id, ".wav", uid)
+async def _admit(user_id: int, stages: Dict[str, str], lane: Lane):
+    """
+    队列积压或用户未完成的任务过多时返回 429. batch lane 延后发送, 不检查队列
+    """
+    stages = list(stages.values())
+    rejected = await check_admission(user_id, stages, stages if lane == Lane.INTERACTIVE else [])
+    if rejected is not None:
+        raise HTTPException(status_code=429, detail=rejected[0], headers={"Retry-After": str(rejected[1])})
+
+
+async def _send(user_id: int, sigs: List[Signature], lane: Lane):
+    """
+    interactive 直接发送, batch 进入用户的等待队列
+    """
+    if lane == Lane.BATCH:
+        await defer(user_id, sigs)
+        return
+    if len(sigs) == 1:
+        publish(sigs[0])
+    elif sigs:
+        await run_in_threadpool(publish_many, sigs)
+
+
+def _cached_file(user_id: int, key: str) -> File:
+    """
+    未保存的文件, 指向缓存中已有的输出
+    """
+    return File(name=os.path.basename(key), key=key, user_id=user_id)
+
+
+def _new_text_files(
+    user_id: int, body: Union[Text2VideoRequest, Text2AudioRequest], with_video: bool, uid: Optional[str] = None
+) -> Dict[str, File]:
+    """
+    未保存的输出文件: audio, video, srt 以及 RVC 模式下的中间文件 azure_audio
+    """
+    uid = uid or uuid.uuid4().hex
+    files = {"audio": new_infer_file(user_id, ".wav", uid)}
+    if with_video:
+        files["video"] = new_infer_file(user_id, ".mp4", uid)
     if body.mode == AudioModeType.RVC:
-        azure_audio_file = await create_infer_file(user_id, ".azure.wav", uid)
-    else:
-        azure_audio_file = None
+        files["azure_audio"] = new_infer_file(user_id, ".azure.wav", uid)
     if body.gen_srt:
-        srt_file = await create_infer_file(user_id, ".srt", uid)
-    else:
-        srt_file = None
-    rst = publish_text_task(
+        files["srt"] = new_infer_file(user_id, ".srt", uid)
+    return files
+
+
+def _text_task_kwargs(
+    body: Union[Text2VideoRequest, Text2AudioRequest],
+    model: Model,
+    files: Dict[str, File],
+    chunk_size: int = LONG_TEXT_CHUNK_SIZE,
+) -> Dict[str, Any]:
+    """
+    build_text_task 的参数
+    """
+    return dict(
         text=body.text,
         model_name=body.model_name,
-        output_audio_cos=audio_file.key,
+        output_audio_cos=files["audio"].key,
         azure_audio_profile=body.audio_profile,
-        azure_output_audio_cos=azure_audio_file.key if azure_audio_file else None,
+        azure_output_audio_cos=files["azure_audio"].key if "azure_audio" in files else None,
         pitch=model.audio_config.get("pitch", 0),
-        speaker=None,
-        output_video_cos=None,
-        output_srt_cos=srt_file.key if srt_file else None,
+        speaker=model.video_model if "video" in files else None,
+        output_video_cos=files["video"].key if "video" in files else None,
+        output_srt_cos=files["srt"].key if "srt" in files else None,
+        long_text=body.long_text,
+        chunk_size=chunk_size,
+        segmented=isinstance(body, Text2VideoRequest) and body.segmented,
     )
-    task = await create_task(user_id, rst, audio_file=audio_file, srt_file=srt_file)
+
+
+async def _infer_text(
+    body: Union[Text2VideoRequest, Text2AudioRequest],
+    user_id: int,
+    with_video: bool,
+    chunk_size: int = LONG_TEXT_CHUNK_SIZE,
+) -> Tuple[Task, Optional[Signature]]:
+    """
+    tts (+ talking_head, srt).
+    相同输入的 tts 结果命中缓存时直接复用已有的输出, 音频命中时只执行缺少的 stage
+    :param chunk_size: 长文本模式下每段的最大字符数
+    :return: task, 新发送的 signature (全部命中缓存时为 None)
+    """
+    model = await _query_model(body.model_name)
+    pitch = model.audio_config.get("pitch", 0)
+    speaker = model.video_model if with_video else None
+    outputs = ["audio"] + (["video"] if with_video else []) + (["srt"] if body.gen_srt else [])
+
+    cache_key = tts_cache_key(body.text, body.model_name, body.mode, body.audio_profile, pitch)
+    cached, ttl = await get_tts_cache(cache_key) or ({}, None)
+    if cached:
+        celery_states = await resolve_states(entry_stages(cached, list(cached)))
+        cached = usable_outputs(cached, celery_states)
+
+    uid = uuid.uuid4().hex
+    files = {}
+    if all(output in cached for output in outputs):
+        for output in outputs:
+            files[output] = _cached_file(user_id, cached[output]["key"])
+        sig = None
+        stages = entry_stages(cached, outputs)
+        logger.info(f"tts cache {cache_key} hit, outputs: {outputs}")
+    elif cached and merge_status(celery_states[rid] for rid in cached["audio"]["stages"]) == TaskStatus.SUCCEEDED:
+        hit = [output for output in outputs if output in cached]
+        missed = [output for output in outputs if output not in cached]
+        for output in hit:
+            files[output] = _cached_file(user_id, cached[output]["key"])
+        if "video" in missed:
+            files["video"] = new_infer_file(user_id, ".mp4", uid)
+        if "srt" in missed:
+            files["srt"] = new_infer_file(user_id, ".srt", uid)
+
+        sig = build_audio_task(
+            audio_cos=files["audio"].key,
+            text=body.text,
+            speaker=speaker,
+            output_video_cos=files["video"].key if "video" in missed else None,
+            output_srt_cos=files["srt"].key if "srt" in missed else None,
+        )
+        sig = _with_deadline(sig, body.deadline)
+        sig.freeze()
+        new_stages = all_stages(sig)
+        stages = {**entry_stages(cached, hit), **new_stages}
+        cached.update(tts_cache_entry(new_stages, **{output: files[output].key for output in missed}))
+        logger.info(f"tts cache {cache_key} partially hit, outputs: {hit}")
+    else:
+        files = _new_text_files(user_id, body, with_video, uid)
+        sig = _with_deadline(build_text_task(**_text_task_kwargs(body, model, files, chunk_size)), body.deadline)
+        sig.freeze()
+        stages = all_stages(sig)
+        cached, ttl = tts_cache_entry(stages, **{output: files[output].key for output in outputs}), None
+
+    if sig is not None:
+        await _admit(user_id, all_stages(sig), body.lane)
+
+    # 所有输出文件和 Task 在一个事务中写入, 提交后再发送任务
+    task = await create_task_with_files(
+        user_id, stages, files, callback_url=body.callback_url and str(body.callback_url)
+    )
+    # 命中缓存的 stage 已发送过, 只记录引用
+    await track_tasks([task], [all_stages(sig) if sig is not None else {}])
+    if sig is not None:
+        await _send(user_id, [sig], body.lane)
+        await set_tts_cache(cache_key, body.model_name, cached, ttl=ttl)
+    watch_callback(task)
+    return task, sig
+
+
+@router.post("/text2video", response_model=Text2VideoResponse)
+async def infer_text2video(body: Text2VideoRequest, req: Request):
+    user = get_user_info(req)
+    logger.debug("user: %s", user)
+    user_id = user["user_id"]
+
+    task, _ = await _infer_text(body, user_id, with_video=True)
+    return JSONResponse({"task_id": task.id})
+
+
+@router.post("/text2audio", response_model=Text2AudioResponse)
+async def infer_text2audio(body: Text2AudioRequest, req: Request):
+    user = get_user_info(req)
+    logger.debug("user: %s", user)
+    user_id = user["user_id"]
+
+    task, _ = await _infer_text(body, user_id, with_video=False)
     return JSONResponse({"task_id": task.id})
+
+
+@router.post("/text2audio/stream", response_class=StreamingResponse)
+async def infer_text2audio_stream(body: Text2AudioRequest, req: Request):
+    """
+    与 /infer/text2audio 相同, 但直接流式返回音频 (audio/wav, 长度未知):
+    文本按句子切分为多段并行合成, 每段完成后按顺序输出, 不必等待整段音频.
+    task id 在响应头 X-Task-Id 中, 完整的音频和字幕仍作为 task 的输出文件保存.
+    合成失败时响应提前结束, 可通过 task 详情查看原因
+    """
+    user = get_user_info(req)
+    user_id = user["user_id"]
+
+    if body.lane != Lane.INTERACTIVE:
+        raise HTTPException(status_code=422, detail="streaming requires the interactive lane")
+    body.long_text = True
+    task, sig = await _infer_text(body, user_id, with_video=False, chunk_size=STREAM_TEXT_CHUNK_SIZE)
+    segments = audio_segments(sig, task.stages, task.res["output_audio_file_key"])
+    return StreamingResponse(
+        stream_audio(segments),
+        media_type="audio/wav",
+        headers={"X-Task-Id": str(task.id), "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# /infer/batch 每次处理的行数: 一次查询模型, 两条 INSERT, 共用一个 broker 连接
+INFER_BATCH_CHUNK_SIZE = int(os.getenv("INFER_BATCH_CHUNK_SIZE", 200))
+
+batch_request_types = {
+    "text2video": (Text2VideoRequest, True),
+    "text2audio": (Text2AudioRequest, False),
+}
+
+
+class _BatchStreamingResponse(StreamingResponse):
+    """
+    响应的同时仍在读取请求体, 不能像 StreamingResponse 那样在后台通过 receive 监听断开连接,
+    断开由 request.stream() 抛出 ClientDisconnect 感知
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+async def _iter_lines(req: Request) -> AsyncIterator[bytes]:
+    buf = b""
+    async for chunk in req.stream():
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield line
+    if buf:
+        yield buf
+
+
+def _parse_batch_line(line: bytes) -> Tuple[Union[Text2VideoRequest, Text2AudioRequest], bool]:
+    item = json.loads(line)
+    if not isinstance(item, dict):
+        raise ValueError("item must be a json object")
+    request_type = item.pop("type", "text2video")
+    if request_type not in batch_request_types:
+        raise ValueError(f"unknown type {request_type}")
+    cls, with_video = batch_request_types[request_type]
+    # 批量提交默认走 batch lane
+    item.setdefault("lane", Lane.BATCH)
+    return cls.model_validate(item), with_video
+
+
+async def _submit_batch(
+    user_id: int,
+    items: List[Tuple[int, Union[Text2VideoRequest, Text2AudioRequest], bool]],
+    models: Dict[str, Optional[Model]],
+) -> List[Dict[str, Any]]:
+    """
+    批量创建输出文件和 Task 并发送任务. 不经过 tts 缓存
+    :param items: (行号, 请求, 是否生成视频)
+    :param models: 模型名 -> 模型, 在整个请求内复用, 不存在的模型为 None
+    :return: 每行的结果 {"line": int, "task_id": int} 或 {"line": int, "error": str},
+        被准入控制拒绝时还有 "retry_after": int
+    """
+    names = {body.model_name for _, body, _ in items} - models.keys()
+    if names:
+        models.update(dict.fromkeys(names))
+        models.update({model.name: model for model in await query_models_by_names(list(names))})
+
+    results, jobs = [], []
+    for line_no, body, with_video in items:
+        model = models[body.model_name]
+        if model is None:
+            results.append({"line": line_no, "error": f"model {body.model_name} not found"})
+            continue
+        files = _new_text_files(user_id, body, with_video)
+        try:
+            sig = _with_deadline(build_text_task(**_text_task_kwargs(body, model, files)), body.deadline)
+        except HTTPException as e:
+            results.append({"line": line_no, "error": e.detail})
+            continue
+        sig.freeze()
+        jobs.append((line_no, body, files, sig))
+    if not jobs:
+        return results
+
+    stages = {line_no: list(all_stages(sig).values()) for line_no, _, _, sig in jobs}
+    rejected = await check_admission(
+        user_id,
+        [stage for line_stages in stages.values() for stage in line_stages],
+        [stage for line_no, body, _, _ in jobs if body.lane == Lane.INTERACTIVE for stage in stages[line_no]],
+    )
+    if rejected is not None:
+        results.extend({"line": line_no, "error": rejected[0], "retry_after": rejected[1]} for line_no, *_ in jobs)
+        return sorted(results, key=lambda r: r["line"])
+
+    async with database.transaction():
+        await create_files([file for _, _, files, _ in jobs for file in files.values()])
+        tasks = await bulk_create(
+            [
+                new_task(
+                    user_id,
+                    all_stages(sig),
+                    audio_file=files.get("audio"),
+                    video_file=files.get("video"),
+                    srt_file=files.get("srt"),
+                    callback_url=body.callback_url and str(body.callback_url),
+                )
+                for _, body, files, sig in jobs
+            ]
+        )
+    await track_tasks(tasks)
+    # 提交后再发送, 避免 worker 或回调先于 Task 写入
+    for lane in Lane:
+        await _send(user_id, [sig for _, body, _, sig in jobs if body.lane == lane], lane)
+
+    for (line_no, _, _, _), task in zip(jobs, tasks):
+        if task.callback_url:
+            watch_callback(task)
+        results.append({"line": line_no, "task_id": task.id})
+    return sorted(results, key=lambda r: r["line"])
+
+
+@router.post("/batch")
+async def infer_batch(req: Request):
+    """
+    批量提交 text2video / text2audio 任务.
+    请求体为 JSONL, 每行一个 Text2VideoRequest 或 Text2AudioRequest, 通过 "type" 字段区分 (默认 text2video).
+    边读边提交, 以 NDJSON 流式返回每行的结果: {"line": 1, "task_id": 1} 或 {"line": 2, "error": "..."}.
+    队列积压时整块被拒绝, 结果中带有 "retry_after" (秒)
+    """
+    user = get_user_info(req)
+    user_id = user["user_id"]
+
+    async def results() -> AsyncIterator[str]:
+        models, items, line_no = {}, [], 0
+        try:
+            async for line in _iter_lines(req):
+                line_no += 1
+                if not line.strip():
+                    continue
+                try:
+                    body, with_video = _parse_batch_line(line)
+                except ValueError as e:
+                    yield json.dumps({"line": line_no, "error": str(e)}, ensure_ascii=False) + "\n"
+                    continue
+                items.append((line_no, body, with_video))
+                if len(items) >= INFER_BATCH_CHUNK_SIZE:
+                    for r in await _submit_batch(user_id, items, models):
+                        yield json.dumps(r, ensure_ascii=False) + "\n"
+                    items = []
+            for r in await _submit_batch(user_id, items, models):
+                yield json.dumps(r, ensure_ascii=False) + "\n"
+        except ClientDisconnect:
+            logger.warning(f"batch of user {user_id} disconnected at line {line_no}")
+
+    return _BatchStreamingResponse(results(), media_type="application/x-ndjson")
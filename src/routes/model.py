@@ -1,3 +1,4 @@
+import os
 from typing import List, Optional
 
 from fastapi import APIRouter, HTTPException, Response, Request
@@ -12,6 +13,9 @@ router = APIRouter(
     prefix="/models",
 )
 
+# 预览图访问频繁且不会变化, 预签名 URL 的有效期更长, 可以复用更久
+PREVIEW_IMAGE_REDIRECT_EXPIRE = int(os.getenv("PREVIEW_IMAGE_REDIRECT_EXPIRE", 3600))
+
 
 @router.get("", response_model=List[model_model.Model])
 async def get_models(model_id: Optional[int] = None, model_name: Optional[str] = None):
@@ -64,7 +68,7 @@ async def get_preview_image(req: Request, model_id: Optional[int] = None, model_
     user_id = user["user_id"]
 
     res = await model_model.query_model(name=model_name, model_id=model_id)
-    model = res[0]
+    model = res[0] if res else None
     if model is None:
         raise HTTPException(status_code=404, detail="Model not found")
 
@@ -73,4 +77,9 @@ async def get_preview_image(req: Request, model_id: Optional[int] = None, model_
     if "preview_image_id" not in model.video_config:
         raise HTTPException(status_code=404, detail="preview_image_id not found")
 
-    return await _download_file(file_id=model.video_config["preview_image_id"], user_id=user_id)
+    return await _download_file(
+        file_id=model.video_config["preview_image_id"],
+        user_id=user_id,
+        headers=req.headers,
+        redirect_expire=PREVIEW_IMAGE_REDIRECT_EXPIRE,
+    )
@@ -1,11 +1,15 @@
-from typing import Dict
+import json
+from typing import AsyncIterator, Dict, List
 
-from celery.result import AsyncResult
-from fastapi import APIRouter, HTTPException, Request
+from celery import states
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from middleware.auth import get_user_info
-from models.task import query_task, TaskStatus
+from models.task import Task, query_task, query_tasks, TaskStatus
+from task.cancel import cancel_task
+from task.state import resolve_states, merge_status, watch_states
 
 router = APIRouter(
     prefix="/tasks",
@@ -17,10 +21,29 @@ class TaskResponse(BaseModel):
     res: Dict[str, int]
     status: TaskStatus
     res_status: Dict[str, str]
+    durations: Dict[str, Dict[str, float]] = {}
 
 
 res_keys = ["output_audio_file", "output_srt_file", "output_video_file"]
 
+# /tasks/batch 单次最多查询的 task 数量
+max_batch_size = 500
+
+
+def _task_response(task: Task, celery_states: Dict[str, str]) -> TaskResponse:
+    res_status = {rid: celery_states[rid] for rid in task.celery_ids}
+    res = {}
+    for id_k in ["output_audio_file_id", "output_srt_file_id", "output_video_file_id"]:
+        if id_k in task.res:
+            res[id_k] = task.res[id_k]
+    return TaskResponse(
+        id=task.id,
+        res=res,
+        status=TaskStatus.CANCELLED if task.cancelled else merge_status(res_status.values()),
+        res_status=res_status,
+        durations=task.durations or {},
+    )
+
 
 @router.get("", response_model=TaskResponse)
 async def get_task(task_id: int, req: Request):
@@ -31,24 +54,84 @@ async def get_task(task_id: int, req: Request):
     if not task:
         raise HTTPException(status_code=404, detail=f"task {task_id} not found")
 
-    status = TaskStatus.SUCCEEDED
-    res, res_status = {}, {}
-    for rid in task.celery_ids:
-        r = AsyncResult(rid)
-        # set status
-        if status == TaskStatus.SUCCEEDED:
-            if r.state == "FAILURE":
-                status = TaskStatus.FAILED
-            elif r.state == "PENDING":
-                status = TaskStatus.PENDING
-            elif r.state != "SUCCESS":
-                status = TaskStatus.UNKNOWN
-        # set res_status
-        res_status[rid] = r.state
-        
-    # set res
-    for id_k in ["output_audio_file_id", "output_srt_file_id", "output_video_file_id"]:
-        if id_k in task.res:
-            res[id_k] = task.res[id_k]
+    celery_states = await resolve_states(task.celery_ids)
+    return _task_response(task, celery_states)
+
+
+@router.get("/batch", response_model=List[TaskResponse])
+async def get_tasks(req: Request, ids: List[str] = Query(description="task ids, 支持 ids=1,2,3 或 ids=1&ids=2")):
+    user = get_user_info(req)
+    user_id = user["user_id"]
+
+    try:
+        task_ids = list(dict.fromkeys(int(i) for item in ids for i in item.split(",") if i.strip()))
+    except ValueError:
+        raise HTTPException(status_code=422, detail="ids must be integers")
+    if len(task_ids) > max_batch_size:
+        raise HTTPException(status_code=422, detail=f"at most {max_batch_size} task ids per request")
+
+    tasks = await query_tasks(task_ids=task_ids, user_id=user_id)
+    # 所有 task 的 celery ids 通过一次 MGET 获取
+    celery_states = await resolve_states(rid for task in tasks for rid in task.celery_ids)
+    return [_task_response(task, celery_states) for task in tasks]
+
+
+@router.delete("/{task_id}", response_model=TaskResponse)
+async def delete_task(task_id: int, req: Request):
+    """
+    取消 task: 丢弃排队中的 stage, 终止执行中的 stage, 删除尚未写入的输出文件.
+    已取消的 task 重复取消时直接返回, 所有 stage 都已结束时返回 409
+    """
+    user = get_user_info(req)
+    user_id = user["user_id"]
+
+    task = await query_task(task_id=task_id, user_id=user_id)
+    if not task:
+        raise HTTPException(status_code=404, detail=f"task {task_id} not found")
+
+    if not task.cancelled:
+        celery_states = await resolve_states(task.celery_ids)
+        if all(state in states.READY_STATES for state in celery_states.values()):
+            raise HTTPException(status_code=409, detail=f"task {task_id} already finished")
+        await cancel_task(task)
+
+    celery_states = await resolve_states(task.celery_ids)
+    return _task_response(task, celery_states)
+
+
+def _sse(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def _task_events(task: Task) -> AsyncIterator[str]:
+    celery_states = {}
+    async for change in watch_states(task.celery_ids):
+        if change is None:
+            yield ": keepalive\n\n"
+            continue
+        rid, state = change
+        celery_states[rid] = state
+        stage = (task.stages or {}).get(rid)
+        yield _sse("stage", json.dumps({"celery_id": rid, "stage": stage, "state": state}))
+    yield _sse("task", _task_response(task, celery_states).model_dump_json())
+
+
+@router.get("/events", response_class=StreamingResponse)
+async def get_task_events(task_id: int, req: Request):
+    """
+    通过 server-sent events 推送 task 各个 stage 的状态变化, 代替轮询 GET /tasks.
+    连接后先推送所有 stage 的当前状态 (event: stage),
+    结束时推送完整的 task (event: task) 并关闭连接.
+    """
+    user = get_user_info(req)
+    user_id = user["user_id"]
+
+    task = await query_task(task_id=task_id, user_id=user_id)
+    if not task:
+        raise HTTPException(status_code=404, detail=f"task {task_id} not found")
 
-    return TaskResponse(id=task.id, res=res, status=status, res_status=res_status)
+    return StreamingResponse(
+        _task_events(task),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
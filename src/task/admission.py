@@ -0,0 +1,184 @@
+import json
+import math
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from infra.logger import logger
+from infra.redis_ import broker_redis_cli, redis_cli
+
+# 每个队列的默认限制, 为 0 时不限制: 队列长度, 预计等待时间 (秒)
+ADMISSION_MAX_DEPTH = int(os.getenv("ADMISSION_MAX_DEPTH", 0))
+ADMISSION_MAX_WAIT = int(os.getenv("ADMISSION_MAX_WAIT", 30 * 60))
+# 按队列覆盖默认限制, 例如 {"talking_head_infer": {"max_depth": 500, "max_wait": 600}}
+ADMISSION_QUEUE_LIMITS: Dict[str, Dict[str, int]] = json.loads(os.getenv("ADMISSION_QUEUE_LIMITS", "{}"))
+# 每个用户未完成的 stage 数, 为 0 时不限制
+ADMISSION_USER_MAX_PENDING = int(os.getenv("ADMISSION_USER_MAX_PENDING", 0))
+# 按用户 id 覆盖, 例如 {"1": 2000}
+ADMISSION_USER_LIMITS: Dict[int, int] = {
+    int(k): v for k, v in json.loads(os.getenv("ADMISSION_USER_LIMITS", "{}")).items()
+}
+# 统计吞吐量的时间窗口 (分钟)
+ADMISSION_THROUGHPUT_WINDOW = int(os.getenv("ADMISSION_THROUGHPUT_WINDOW", 10))
+# 无法估计时返回的 Retry-After (秒)
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 60))
+# 超过这个时间仍未完成的 stage 不再计入用户的未完成数 (被撤销, 或没有副本开启 TASK_EVENTS_MONITOR)
+ADMISSION_PENDING_EXPIRE = int(os.getenv("ADMISSION_PENDING_EXPIRE", 6 * 60 * 60))
+
+_done_key = "mercury_stage_done"
+_pending_key = "mercury_user_pending"
+
+# kombu redis transport 按优先级把一个队列分为多个 list
+_priority_sep = "\x06\x16"
+_priority_steps = (3, 6, 9)
+
+# 与 celery task name 不同名的队列
+_stage_queues = {
+    "stitch": "media_infer",
+    "mux": "media_infer",
+    "azure_batch": "azure_infer",
+}
+
+
+def stage_queue(stage: str) -> str:
+    """
+    stage 所在的 celery 队列, 例如 talking_head -> talking_head_infer
+    """
+    return _stage_queues.get(stage, f"{stage}_infer")
+
+
+def done_key(queue: str, minute: int) -> str:
+    """
+    每分钟完成的 stage 数, 由 task.monitor 写入
+    """
+    return f"{_done_key}_{queue}_{minute}"
+
+
+def pending_key(user_id: int) -> str:
+    """
+    用户未完成的 stage: celery result id -> 提交时间
+    """
+    return f"{_pending_key}_{user_id}"
+
+
+def throughput(counts: List[int]) -> float:
+    """
+    每秒完成的 stage 数. 只统计有完成的分钟, 避免空闲时段拉低估计值
+    :param counts: 每分钟完成数
+    """
+    busy = [c for c in counts if c > 0]
+    return sum(busy) / (60 * len(busy)) if busy else 0.0
+
+
+def queue_rejection(
+    queue: str, depth: int, n: int, rate: float, max_depth: int, max_wait: int
+) -> Optional[Tuple[str, int]]:
+    """
+    判断在队列中再加入 n 个任务是否超出限制
+    :param depth: 当前队列长度
+    :param rate: 吞吐量 (每秒), 为 0 时无法估计等待时间, 只检查队列长度
+    :return: None 或 (原因, Retry-After 秒)
+    """
+    total = depth + n
+    if max_depth and total > max_depth:
+        retry_after = (total - max_depth) / rate if rate else ADMISSION_RETRY_AFTER
+        return f"queue {queue} is full ({depth} waiting)", max(1, math.ceil(retry_after))
+    if max_wait and rate:
+        wait = total / rate
+        if wait > max_wait:
+            return f"queue {queue} is busy, estimated wait {int(wait)}s", max(1, math.ceil(wait - max_wait))
+    return None
+
+
+def queue_key(queue: str, priority: int = 0) -> str:
+    """
+    broker 中保存队列某个优先级的消息的 list
+    """
+    return f"{queue}{_priority_sep}{priority}" if priority else queue
+
+
+def split_queue_key(key: str) -> Tuple[str, int]:
+    """
+    queue_key 的逆运算
+    :return: 队列, 优先级
+    """
+    queue, _, priority = key.partition(_priority_sep)
+    return queue, int(priority or 0)
+
+
+async def queue_depths(queues: List[str], priorities: Tuple[int, ...] = (0,) + _priority_steps) -> Dict[str, int]:
+    """
+    broker 中的队列长度
+    :param priorities: 统计的优先级, 默认全部
+    """
+    async with broker_redis_cli.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            for step in priorities:
+                pipe.llen(queue_key(queue, step))
+        lengths = await pipe.execute()
+    return {queue: sum(lengths[i * len(priorities) : (i + 1) * len(priorities)]) for i, queue in enumerate(queues)}
+
+
+async def _queue_states(queues: List[str]) -> Dict[str, Tuple[int, float]]:
+    """
+    :return: 队列 -> (队列长度, 吞吐量)
+    """
+    minute = int(time.time() // 60)
+    minutes = range(minute - ADMISSION_THROUGHPUT_WINDOW, minute)
+    depths = await queue_depths(queues)
+    keys = [done_key(queue, m) for queue in queues for m in minutes]
+    counts = await redis_cli.mget(keys) if keys else []
+
+    states = {}
+    for i, queue in enumerate(queues):
+        queue_counts = counts[i * len(minutes) : (i + 1) * len(minutes)]
+        states[queue] = depths[queue], throughput([int(c or 0) for c in queue_counts])
+    return states
+
+
+async def _user_pending(user_id: int) -> int:
+    key = pending_key(user_id)
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        pipe.zremrangebyscore(key, "-inf", time.time() - ADMISSION_PENDING_EXPIRE).zcard(key)
+        return (await pipe.execute())[-1]
+
+
+async def check_admission(
+    user_id: int, stages: List[str], queue_stages: Optional[List[str]] = None
+) -> Optional[Tuple[str, int]]:
+    """
+    根据队列长度, 近期吞吐量和用户未完成的 stage 数判断是否接受新的任务
+    :param stages: 新任务的所有 stage
+    :param queue_stages: 需要检查队列的 stage, 默认为 stages. batch lane 的任务由 dispatcher 延后发送, 不检查
+    :return: None 表示接受, 否则为 (原因, Retry-After 秒)
+    """
+    if not stages:
+        return None
+    rejections = []
+
+    user_limit = ADMISSION_USER_LIMITS.get(user_id, ADMISSION_USER_MAX_PENDING)
+    if user_limit:
+        pending = await _user_pending(user_id)
+        if pending + len(stages) > user_limit:
+            rejections.append((f"too many pending stages ({pending})", ADMISSION_RETRY_AFTER))
+
+    counts = Counter(stage_queue(stage) for stage in (stages if queue_stages is None else queue_stages))
+    for queue, (depth, rate) in (await _queue_states(list(counts))).items():
+        limits = ADMISSION_QUEUE_LIMITS.get(queue, {})
+        rejection = queue_rejection(
+            queue,
+            depth,
+            counts[queue],
+            rate,
+            limits.get("max_depth", ADMISSION_MAX_DEPTH),
+            limits.get("max_wait", ADMISSION_MAX_WAIT),
+        )
+        if rejection is not None:
+            rejections.append(rejection)
+
+    if not rejections:
+        return None
+    reason = "; ".join(r for r, _ in rejections)
+    logger.warning(f"submission of user {user_id} rejected: {reason}")
+    return reason, max(retry_after for _, retry_after in rejections)
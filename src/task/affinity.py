@@ -0,0 +1,155 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+
+from celery.app.routes import Router
+from mcelery.infer import celery_app
+
+from infra.logger import logger
+from infra.redis_ import broker_redis_cli
+from task.admission import queue_depths, queue_key, split_queue_key, stage_queue
+
+# worker 心跳超过这个时间 (秒) 视为下线, 不再路由到它的队列
+AFFINITY_WORKER_TTL = int(os.getenv("AFFINITY_WORKER_TTL", 30))
+AFFINITY_REFRESH_INTERVAL = float(os.getenv("AFFINITY_REFRESH_INTERVAL", 5))
+# worker 队列中的任务数达到该值时使用共享队列, 避免任务都堆在一个 worker 上; 为 0 时关闭亲和路由
+AFFINITY_MAX_DEPTH = int(os.getenv("AFFINITY_MAX_DEPTH", 2))
+
+# 使用亲和路由的 stage -> 模型参数的位置 (从后往前数), 与 worker/affinity.py 一致
+affinity_args = {
+    "cosy": -2,  # prompt_wav_cos
+    "rvc": -3,  # model_cos
+    "talking_head": -2,  # speaker
+}
+# celery task name -> stage
+_affinity_tasks = {f"{stage}_infer": stage for stage in affinity_args}
+
+# 由 worker 写入 (worker/affinity.py), 保存在 broker 所在的 redis:
+# mercury_warm_{stage}: zset, worker 名 -> 最近一次心跳时间
+# mercury_warm_{stage}_{worker}: zset, 该 worker 最近使用 (已加载) 的模型 -> 最近使用时间
+_warm_key = "mercury_warm"
+
+# stage -> 模型 -> 已加载该模型的 worker 队列
+_warm: Dict[str, Dict[str, List[str]]] = {}
+# worker 队列 -> 长度, 两次刷新之间按路由的任务数累加
+_depths: Dict[str, int] = {}
+_refresher: Optional[asyncio.Task] = None
+
+
+def worker_queue(stage: str, worker: str) -> str:
+    """
+    worker 自己的队列, 例如 talking_head_infer.gpu1@host
+    """
+    return f"{stage_queue(stage)}.{worker}"
+
+
+def affinity_queue(stage: str, model: str) -> Optional[str]:
+    """
+    已加载该模型且队列最短的 worker 队列, 没有或都已满时返回 None (使用共享队列)
+    """
+    candidates = _warm.get(stage, {}).get(model)
+    if not candidates or not AFFINITY_MAX_DEPTH:
+        return None
+    queue = min(candidates, key=lambda q: _depths.get(q, 0))
+    if _depths.get(queue, 0) >= AFFINITY_MAX_DEPTH:
+        return None
+    _depths[queue] = _depths.get(queue, 0) + 1
+    return queue
+
+
+class AffinityRouter(Router):
+    """
+    发送时把需要加载模型的 task 路由到已加载该模型的 worker 的队列, 没有时仍使用共享队列.
+    API 发送的 task 使用这里的 router; chain 中之后的 task 由 worker 在前面的 task 完成后发送,
+    使用 worker/affinity.py 中的 router, 两者都按发送时的 worker 状态选择队列
+    """
+
+    def route(self, options, name, args=(), kwargs=None, task_type=None):
+        stage = _affinity_tasks.get(name)
+        if stage is not None:
+            queue = affinity_queue(stage, args[affinity_args[stage]])
+            if queue is not None:
+                # 覆盖 task 注册时的共享队列
+                options = dict(options, queue=queue)
+        return super().route(options, name, args, kwargs, task_type)
+
+
+async def _recover(stages: List[str], workers: Dict[str, List[str]]) -> int:
+    """
+    把不在线的 worker 的队列中的消息移到共享队列, 例如 worker 下线时还没有执行的任务,
+    以及下线后 broker 按 visibility timeout 放回的未确认的任务
+    :param workers: stage -> 在线的 worker
+    :return: 移动的消息数
+    """
+    moved = 0
+    for stage in stages:
+        live = {worker_queue(stage, worker) for worker in workers[stage]}
+        async for key in broker_redis_cli.scan_iter(match=f"{stage_queue(stage)}.*"):
+            queue, priority = split_queue_key(key.decode())
+            if queue in live:
+                continue
+            # 从最新的一端取出, 放到共享队列中最先被消费的一端, 保持原来的顺序
+            target = queue_key(stage_queue(stage), priority)
+            n = 0
+            while await broker_redis_cli.lmove(key, target, "LEFT", "RIGHT") is not None:
+                n += 1
+            if n:
+                logger.warning(f"{n} tasks moved from offline worker queue {queue} to {stage_queue(stage)}")
+            moved += n
+    return moved
+
+
+async def _refresh(stages: List[str]):
+    global _warm, _depths
+    now = time.time()
+    async with broker_redis_cli.pipeline(transaction=False) as pipe:
+        for stage in stages:
+            pipe.zremrangebyscore(f"{_warm_key}_{stage}", "-inf", now - AFFINITY_WORKER_TTL)
+            pipe.zrange(f"{_warm_key}_{stage}", 0, -1)
+        workers = dict(zip(stages, [[w.decode() for w in ws] for ws in (await pipe.execute())[1::2]]))
+
+    async with broker_redis_cli.pipeline(transaction=False) as pipe:
+        for stage in stages:
+            for worker in workers[stage]:
+                pipe.zrange(f"{_warm_key}_{stage}_{worker}", 0, -1)
+        models = iter(await pipe.execute())
+
+    warm = {}
+    for stage in stages:
+        warm[stage] = {}
+        for worker in workers[stage]:
+            for model in next(models):
+                warm[stage].setdefault(model.decode(), []).append(worker_queue(stage, worker))
+    queues = [worker_queue(stage, worker) for stage in stages for worker in workers[stage]]
+    _depths = await queue_depths(queues)
+    _warm = warm
+    await _recover(stages, workers)
+
+
+async def _refresh_loop(stages: List[str]):
+    while True:
+        try:
+            await _refresh(stages)
+        except Exception as e:
+            logger.error(f"affinity refresh error: {type(e).__name__}: {e}")
+        await asyncio.sleep(AFFINITY_REFRESH_INTERVAL)
+
+
+async def start_affinity(stages: List[str]):
+    """
+    :param stages: 使用亲和路由的 stage
+    """
+    global _refresher
+    if not AFFINITY_MAX_DEPTH:
+        return
+    amqp = celery_app.amqp
+    amqp.router = AffinityRouter(amqp.routes, amqp.queues, celery_app.conf.task_create_missing_queues, app=celery_app)
+    _refresher = asyncio.create_task(_refresh_loop(stages))
+
+
+async def stop_affinity():
+    if _refresher is None:
+        return
+    _refresher.cancel()
+    await asyncio.gather(_refresher, return_exceptions=True)
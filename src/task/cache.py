@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from celery import states
+
+from infra.logger import logger
+from infra.redis_ import redis_cli
+
+_redis_key = "mercury_tts_cache"
+_lru_key = f"{_redis_key}_lru"
+_model_key = f"{_redis_key}_model"
+
+# 为 0 时关闭缓存
+TTS_CACHE_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MAX_ENTRIES", 10000))
+# 命中时通过缓存中的 celery ids 获取状态, 所以不能超过 celery result_expires (默认 1 天)
+TTS_CACHE_TTL = int(os.getenv("TTS_CACHE_TTL", 24 * 60 * 60))
+
+# 输出 -> 产生该输出的 stages
+output_stages = {
+    "audio": ("azure", "rvc", "cosy", "stitch"),
+    "srt": ("srt", "azure", "stitch"),
+    "video": ("talking_head", "mux"),
+}
+
+
+def tts_cache_key(text: str, model_name: str, mode: int, audio_profile: str, pitch: int) -> str:
+    raw = json.dumps([text, model_name, int(mode), audio_profile, pitch], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def tts_cache_entry(
+    stages: Dict[str, str], audio: Optional[str] = None, srt: Optional[str] = None, video: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    缓存内容: 各个输出的 COS key 以及产生该输出的 celery stages
+    :param stages: celery result id -> stage name
+    """
+    entry = {}
+    for output, key in (("audio", audio), ("srt", srt), ("video", video)):
+        if key:
+            entry[output] = {
+                "key": key,
+                "stages": {rid: stage for rid, stage in stages.items() if stage in output_stages[output]},
+            }
+    return entry
+
+
+def entry_stages(entry: Dict[str, Any], outputs: List[str]) -> Dict[str, str]:
+    stages = {}
+    for output in outputs:
+        stages.update(entry[output]["stages"])
+    return stages
+
+
+def usable_outputs(entry: Dict[str, Any], celery_states: Dict[str, str]) -> Dict[str, Any]:
+    """
+    去掉失败或被撤销的输出; 音频不可用时其他输出也不可用
+    """
+    usable = {
+        output: v
+        for output, v in entry.items()
+        if not any(celery_states[rid] in states.PROPAGATE_STATES for rid in v["stages"])
+    }
+    return usable if "audio" in usable else {}
+
+
+async def get_tts_cache(key: str) -> Optional[Tuple[Dict[str, Any], int]]:
+    """
+    :return: 缓存内容及剩余的过期时间
+    """
+    if TTS_CACHE_MAX_ENTRIES <= 0:
+        return None
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        raw, ttl = await pipe.get(f"{_redis_key}_{key}").ttl(f"{_redis_key}_{key}").execute()
+    if raw is None:
+        return None
+    await redis_cli.zadd(_lru_key, {key: time.time()})
+    return json.loads(raw)["entry"], ttl
+
+
+async def set_tts_cache(key: str, model_name: str, entry: Dict[str, Any], ttl: Optional[int] = None):
+    if TTS_CACHE_MAX_ENTRIES <= 0:
+        return
+    value = json.dumps({"model_name": model_name, "entry": entry})
+    model_key = f"{_model_key}_{model_name}"
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        # 部分命中后补充输出时保留原有的过期时间
+        pipe.set(f"{_redis_key}_{key}", value, ex=ttl if ttl and ttl > 0 else TTS_CACHE_TTL)
+        pipe.zadd(_lru_key, {key: time.time()})
+        pipe.sadd(model_key, key).expire(model_key, TTS_CACHE_TTL)
+        pipe.zcard(_lru_key)
+        size = (await pipe.execute())[-1]
+    if size > TTS_CACHE_MAX_ENTRIES:
+        await _evict(size - TTS_CACHE_MAX_ENTRIES)
+
+
+async def _evict(count: int):
+    """
+    淘汰最久未使用的 count 个缓存
+    """
+    evicted = [k.decode() for k, _ in await redis_cli.zpopmin(_lru_key, count)]
+    values = await redis_cli.mget([f"{_redis_key}_{k}" for k in evicted])
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        for k, value in zip(evicted, values):
+            pipe.delete(f"{_redis_key}_{k}")
+            if value is not None:
+                pipe.srem(f"{_model_key}_{json.loads(value)['model_name']}", k)
+        await pipe.execute()
+
+
+async def invalidate_tts_cache(model_name: str):
+    """
+    模型更新或删除后, 清除该模型的所有缓存
+    """
+    model_key = f"{_model_key}_{model_name}"
+    keys = [k.decode() for k in await redis_cli.smembers(model_key)]
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        for k in keys:
+            pipe.delete(f"{_redis_key}_{k}")
+        if keys:
+            pipe.zrem(_lru_key, *keys)
+        pipe.delete(model_key)
+        await pipe.execute()
+    logger.info(f"tts cache of model {model_name} invalidated, {len(keys)} entries removed")
@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+from typing import Any, Dict, Set
+
+from pydantic import BaseModel
+
+from infra.logger import logger
+from infra.redis_ import redis_cli
+from infra.webhook import WebhookSender
+from models.task import Task, TaskStatus, query_callback_tasks, mark_callback_sent
+from task.state import watch_states, merge_status
+
+webhook_sender = WebhookSender()
+
+_lock_key = "mercury_callback_lock"
+# 多副本时只由一个副本负责某个 task 的 callback
+_lock_expire_time = 24 * 60 * 60
+# 启动时恢复多久之内创建的 task 的 callback
+_recover_window = datetime.timedelta(days=1)
+_retry_interval = 5
+
+_watchers: Set[asyncio.Task] = set()
+
+
+class TaskCallbackPayload(BaseModel):
+    id: int
+    res: Dict[str, Any]
+    status: TaskStatus
+    res_status: Dict[str, str]
+
+
+async def _wait_finished(task: Task) -> Dict[str, str]:
+    """
+    等待 task 结束, 读取 state 出错 (例如 redis 暂时不可用) 时重试, 不丢弃 callback
+    :return: celery id -> state
+    """
+    while True:
+        try:
+            res_status = {}
+            async for change in watch_states(task.celery_ids):
+                if change is not None:
+                    res_status[change[0]] = change[1]
+            return res_status
+        except Exception as e:
+            logger.warning(f"task {task.id} callback watch error, retrying: {type(e).__name__}: {e}")
+            await asyncio.sleep(_retry_interval)
+
+
+async def _watch(task: Task):
+    lock = f"{_lock_key}_{task.id}"
+    if not await redis_cli.set(lock, 1, nx=True, ex=_lock_expire_time):
+        return
+    try:
+        res_status = await _wait_finished(task)
+        payload = TaskCallbackPayload(
+            id=task.id, res=task.res, status=merge_status(res_status.values()), res_status=res_status
+        )
+        delivered = await (await webhook_sender.send(task.callback_url, payload.model_dump(mode="json")))
+        logger.info(f"task {task.id} callback to {task.callback_url} delivered: {delivered}")
+        await mark_callback_sent(task.id)
+    except Exception as e:
+        logger.error(f"task {task.id} callback error: {type(e).__name__}: {e}")
+    finally:
+        await redis_cli.delete(lock)
+
+
+def watch_callback(task: Task):
+    """
+    后台等待 task 结束, 然后 POST 结果到 task.callback_url
+    """
+    if not task.callback_url:
+        return
+    t = asyncio.create_task(_watch(task))
+    _watchers.add(t)
+    t.add_done_callback(_watchers.discard)
+
+
+async def start_callbacks():
+    await webhook_sender.start()
+    tasks = await query_callback_tasks(since=datetime.datetime.now() - _recover_window)
+    for task in tasks:
+        watch_callback(task)
+    logger.info(f"{len(tasks)} pending task callbacks recovered")
+
+
+async def stop_callbacks():
+    for t in list(_watchers):
+        t.cancel()
+    await asyncio.gather(*_watchers, return_exceptions=True)
+    await webhook_sender.stop()
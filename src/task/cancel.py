@@ -0,0 +1,94 @@
+from typing import Dict, List
+
+from celery import states
+from fastapi.concurrency import run_in_threadpool
+from mcelery.cos import cos_bucket, cos_client
+from mcelery.infer import celery_app
+
+from infra.logger import logger
+from infra.redis_ import Pipeline, redis_cli
+from models.file import File, delete_files
+from models.task import Task, mark_task_cancelled
+from task.admission import pending_key
+from task.state import resolve_states
+
+# 引用某个 stage 的 task (set), 命中 tts 缓存时多个 task 共享同一个 stage
+_refs_key = "mercury_stage_refs"
+# 与 tts 缓存的有效期以及 celery result_expires 一致
+_refs_expire_time = 24 * 60 * 60
+
+
+def _stage_refs_key(celery_id: str) -> str:
+    return f"{_refs_key}_{celery_id}"
+
+
+def add_stage_refs(pipe: Pipeline, task: Task):
+    """
+    在 pipeline 中记录 task 引用的所有 stage, 包括命中 tts 缓存复用的其他 task 的 stage
+    """
+    for rid in task.celery_ids:
+        pipe.sadd(_stage_refs_key(rid), task.id).expire(_stage_refs_key(rid), _refs_expire_time)
+
+
+async def _release_stages(task: Task, celery_ids: List[str]) -> Dict[str, int]:
+    """
+    解除 task 对 stages 的引用
+    :return: celery id -> 仍然引用该 stage 的其他 task 数量
+    """
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        for rid in celery_ids:
+            pipe.srem(_stage_refs_key(rid), task.id).scard(_stage_refs_key(rid))
+        results = await pipe.execute()
+    return dict(zip(celery_ids, results[1::2]))
+
+
+def _revoke(celery_ids: List[str], reason: str):
+    """
+    通知 worker 丢弃排队中的 task, 终止执行中的 task; 同时在 result backend 中标记为 REVOKED,
+    订阅状态的 SSE / callback 随即结束, batch lane 中尚未发送的任务也不会再发送
+    """
+    celery_app.control.revoke(celery_ids, terminate=True, signal="SIGTERM")
+    for rid in celery_ids:
+        celery_app.backend.mark_as_revoked(rid, reason)
+
+
+async def _unwritten_outputs(task: Task) -> List[File]:
+    """
+    COS 对象尚未写入的输出文件
+    """
+    res = task.res or {}
+    files = []
+    for output in ("audio", "srt", "video"):
+        file_id, key = res.get(f"output_{output}_file_id"), res.get(f"output_{output}_file_key")
+        if file_id is None or not key:
+            continue
+        if not await run_in_threadpool(cos_client.object_exists, Bucket=cos_bucket, Key=key):
+            files.append(File(id=file_id, key=key, name="", user_id=task.user_id))
+    return files
+
+
+async def cancel_task(task: Task, reason: str = "cancelled") -> List[str]:
+    """
+    撤销 task 中未结束的 stage, 标记 task 为已取消, 删除没有写入的输出文件.
+    命中 tts 缓存时 stage 可能被其他 task (包括其他用户的) 共享, 仍被其他 task 引用的 stage 继续执行,
+    只解除本 task 的引用
+    :return: 被撤销的 celery result ids
+    """
+    celery_states = await resolve_states(task.celery_ids)
+    unfinished = [rid for rid in task.celery_ids if celery_states[rid] not in states.READY_STATES]
+    refs = await _release_stages(task, unfinished) if unfinished else {}
+    revoked = [rid for rid in unfinished if not refs[rid]]
+    if revoked:
+        await run_in_threadpool(_revoke, revoked, reason)
+    if unfinished:
+        await redis_cli.zrem(pending_key(task.user_id), *unfinished)
+    await mark_task_cancelled(task.id)
+    task.cancelled = True
+
+    files = await _unwritten_outputs(task)
+    await delete_files(files)
+    logger.info(
+        f"task {task.id} {reason}, {len(revoked)} stages revoked, {len(unfinished) - len(revoked)} shared stages kept, "
+        f"{len(files)} output files removed"
+    )
+    return revoked
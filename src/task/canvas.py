@@ -0,0 +1,37 @@
+from typing import Iterator, List, Union
+
+from celery import Signature
+
+# 未 freeze 或从 json 还原的 chord header 是 list
+Canvas = Union[Signature, List[Signature]]
+
+
+def leaves(sig: Canvas) -> Iterator[Signature]:
+    """
+    chain / group / chord 中的每个 task
+    """
+    if isinstance(sig, (list, tuple)):
+        for t in sig:
+            yield from leaves(t)
+    elif sig.task in ("celery.chain", "celery.group"):
+        yield from leaves(sig.tasks)
+    elif sig.task == "celery.chord":
+        yield from leaves(sig.tasks)
+        yield from leaves(sig.body)
+    else:
+        yield sig
+
+
+def entry_tasks(sig: Canvas) -> Iterator[Signature]:
+    """
+    发送时直接进入队列的 task. chain 中之后的 task 以及 chord body 由 worker 在前面的 task 完成后发送
+    """
+    if isinstance(sig, (list, tuple)):
+        for t in sig:
+            yield from entry_tasks(t)
+    elif sig.task == "celery.chain":
+        yield from entry_tasks(sig.tasks[0])
+    elif sig.task in ("celery.group", "celery.chord"):
+        yield from entry_tasks(sig.tasks)
+    else:
+        yield sig
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from celery import Signature, states
+from fastapi.concurrency import run_in_threadpool
+
+from infra.logger import logger
+from infra.redis_ import redis_cli
+from models.task import all_stages, stage_name
+from task.admission import queue_depths, stage_queue
+from task.canvas import entry_tasks
+from task.fair import fair_share
+from task.infer import Lane, celery_app, gpu_stages, lane_priority, publish_many, set_priority
+from task.state import resolve_states
+
+# broker 中每个 GPU 队列 batch 优先级的任务数低于该值时, 从各用户的等待任务中补充
+BATCH_DISPATCH_MAX_QUEUED = int(os.getenv("BATCH_DISPATCH_MAX_QUEUED", 16))
+BATCH_DISPATCH_INTERVAL = float(os.getenv("BATCH_DISPATCH_INTERVAL", 1))
+# 用户权重, 每轮按权重分配发送数量, 默认为 1, 例如 {"1": 4}
+BATCH_USER_WEIGHTS: Dict[int, int] = {
+    int(k): int(v) for k, v in json.loads(os.getenv("BATCH_USER_WEIGHTS", "{}")).items()
+}
+
+_batch_key = "mercury_batch"
+# 有等待任务的队列组 (set), 见 queue_group
+_groups_key = f"{_batch_key}_groups"
+# 多副本时每个周期只有一个副本发送
+_lock_key = f"{_batch_key}_lock"
+_group_sep = "+"
+
+_dispatcher: Optional[asyncio.Task] = None
+# 队列组 -> 轮次, 用于轮换先分配的用户; 空字符串对应轮换先分配的队列组
+_rounds: Dict[str, int] = {}
+
+
+def _users_key(group: str) -> str:
+    """
+    在该队列组有等待任务的用户 (set)
+    """
+    return f"{_batch_key}_users_{group}"
+
+
+def _user_key(group: str, user_id: int) -> str:
+    return f"{_batch_key}_{group}_{user_id}"
+
+
+def queue_group(sig: Signature) -> str:
+    """
+    任务的各 stage 会进入的 GPU 队列, 按这些队列的积压情况发送. 例如 RVC 模式的视频任务为
+    rvc_infer+talking_head_infer: azure_infer 很快被消费, 只看最先进入的队列会让后面的 GPU 队列堆积.
+    没有 GPU stage 时为最先进入的队列
+    """
+    queues = {stage_queue(stage) for stage in all_stages(sig).values() if stage in gpu_stages}
+    return _group_sep.join(sorted(queues)) or stage_queue(stage_name(next(entry_tasks(sig)).task))
+
+
+async def defer(user_id: int, sigs: List[Signature]):
+    """
+    batch lane 的任务先按队列组进入用户自己的等待队列, 由 dispatcher 按用户公平发送
+    :param sigs: 已 freeze 的 signature, 发送时保持 celery result id 不变
+    """
+    if not sigs:
+        return
+    groups: Dict[str, List[str]] = {}
+    for sig in sigs:
+        set_priority(sig, lane_priority[Lane.BATCH])
+        groups.setdefault(queue_group(sig), []).append(json.dumps(sig))
+    async with redis_cli.pipeline(transaction=True) as pipe:
+        for group, items in groups.items():
+            pipe.rpush(_user_key(group, user_id), *items).sadd(_users_key(group), user_id).sadd(_groups_key, group)
+        await pipe.execute()
+
+
+async def _take(group: str, budget: int, taken: Dict[Tuple[str, int], List[bytes]]) -> int:
+    """
+    从各用户在该队列组的等待任务中按权重公平取出最多 budget 个
+    :param taken: (队列组, 用户) -> 取出的任务 (json), 取出后立即写入, 出错时由调用方放回
+    :return: 取出的数量
+    """
+    users = [int(u) for u in await redis_cli.smembers(_users_key(group))]
+    if not users:
+        # 删除后再检查一次, 避免删除时刚好有新的任务
+        await redis_cli.srem(_groups_key, group)
+        if await redis_cli.scard(_users_key(group)):
+            await redis_cli.sadd(_groups_key, group)
+        return 0
+
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        for user_id in users:
+            pipe.llen(_user_key(group, user_id))
+        backlogs = dict(zip(users, await pipe.execute()))
+    share = fair_share(backlogs, BATCH_USER_WEIGHTS, budget, _rounds.get(group, 0))
+    _rounds[group] = _rounds.get(group, 0) + 1
+
+    n = 0
+    for user_id, user_share in share.items():
+        if user_share:
+            taken[(group, user_id)] = await redis_cli.lpop(_user_key(group, user_id), user_share) or []
+            n += len(taken[(group, user_id)])
+    for user_id, backlog in backlogs.items():
+        if backlog <= share[user_id]:
+            await redis_cli.srem(_users_key(group), user_id)
+            if await redis_cli.llen(_user_key(group, user_id)):
+                await redis_cli.sadd(_users_key(group), user_id)
+    return n
+
+
+def _not_revoked(sigs: List[Signature], celery_states: Dict[str, str]) -> List[Signature]:
+    return [sig for sig in sigs if states.REVOKED not in {celery_states[rid] for rid in all_stages(sig)}]
+
+
+async def _dispatch_once() -> int:
+    if not await redis_cli.set(_lock_key, 1, nx=True, px=int(BATCH_DISPATCH_INTERVAL * 1000)):
+        return 0
+    groups = sorted(g.decode() for g in await redis_cli.smembers(_groups_key))
+    if not groups:
+        return 0
+    # 每个队列单独计算可以发送的数量, 任务受其经过的所有 GPU 队列中剩余最少的限制:
+    # talking_head_infer 积压时不再发送视频任务, 但不影响只需要 rvc_infer 的音频任务
+    queues = sorted({queue for group in groups for queue in group.split(_group_sep)})
+    depths = await queue_depths(queues, priorities=(lane_priority[Lane.BATCH],))
+    remaining = {queue: BATCH_DISPATCH_MAX_QUEUED - depths[queue] for queue in queues}
+    # 轮换先分配的队列组, 避免共享队列的剩余数量总是被同一组用完
+    start = _rounds.get("", 0) % len(groups)
+    _rounds[""] = _rounds.get("", 0) + 1
+    taken: Dict[Tuple[str, int], List[bytes]] = {}
+    try:
+        for group in groups[start:] + groups[:start]:
+            budget = min(remaining[queue] for queue in group.split(_group_sep))
+            if budget > 0:
+                n = await _take(group, budget, taken)
+                for queue in group.split(_group_sep):
+                    remaining[queue] -= n
+        sigs = [celery_app.signature(json.loads(s)) for items in taken.values() for s in items]
+        if not sigs:
+            return 0
+        # 等待期间被取消的任务不再发送
+        sigs = _not_revoked(sigs, await resolve_states(rid for sig in sigs for rid in all_stages(sig)))
+        await run_in_threadpool(publish_many, sigs)
+    except Exception:
+        # 已从等待队列中取出的任务在任何错误时都放回队首, 否则 task 会一直处于 PENDING
+        for (group, user_id), items in taken.items():
+            if not items:
+                continue
+            await redis_cli.lpush(_user_key(group, user_id), *reversed(items))
+            await redis_cli.sadd(_users_key(group), user_id)
+            await redis_cli.sadd(_groups_key, group)
+        raise
+    return len(sigs)
+
+
+async def _dispatch():
+    while True:
+        try:
+            n = await _dispatch_once()
+            if n:
+                logger.info(f"{n} batch tasks dispatched")
+        except Exception as e:
+            logger.error(f"batch dispatch error: {type(e).__name__}: {e}")
+        await asyncio.sleep(BATCH_DISPATCH_INTERVAL)
+
+
+async def start_dispatcher():
+    global _dispatcher
+    _dispatcher = asyncio.create_task(_dispatch())
+
+
+async def stop_dispatcher():
+    if _dispatcher is None:
+        return
+    _dispatcher.cancel()
+    await asyncio.gather(_dispatcher, return_exceptions=True)
@@ -0,0 +1,27 @@
+from typing import Dict
+
+
+def fair_share(backlogs: Dict[int, int], weights: Dict[int, int], budget: int, start: int = 0) -> Dict[int, int]:
+    """
+    加权轮询分配本次发送的数量
+    :param backlogs: 用户 -> 等待的任务数
+    :param weights: 用户 -> 权重, 默认为 1
+    :param budget: 本次最多发送的任务数
+    :param start: 从第几个用户开始, 每次轮换, 避免总是同一个用户先分配
+    :return: 用户 -> 发送数量
+    """
+    users = sorted(backlogs)
+    if users:
+        users = users[start % len(users) :] + users[: start % len(users)]
+    share = dict.fromkeys(users, 0)
+    while budget > 0:
+        progressed = False
+        for user in users:
+            n = min(weights.get(user, 1), backlogs[user] - share[user], budget)
+            if n > 0:
+                share[user] += n
+                budget -= n
+                progressed = True
+        if not progressed:
+            break
+    return share
@@ -1,11 +1,26 @@
+import datetime
+import os
 from enum import Enum
-from typing import Tuple, Optional
+from itertools import count, takewhile
+from typing import Dict, List, Tuple, Optional
 
-from celery import group
-from celery.result import AsyncResult, GroupResult
-from mcelery.infer import register_infer_tasks
+from celery import chord, group, Signature
+from kombu import Producer
+from mcelery.infer import celery_app, register_infer_tasks
 
 from infra.logger import logger
+from models.task import stage_name
+from task.cache import output_stages
+from task.canvas import leaves
+from task.text import chunk_text
+
+# 长文本模式下每段文本的最大字符数
+LONG_TEXT_CHUNK_SIZE = int(os.getenv("LONG_TEXT_CHUNK_SIZE", 200))
+# 流式合成时每段文本的最大字符数, 越小首段音频越快返回
+STREAM_TEXT_CHUNK_SIZE = int(os.getenv("STREAM_TEXT_CHUNK_SIZE", 60))
+
+# 发送任务时产生 task-sent 事件, 用于统计排队时间
+celery_app.conf.task_send_sent_event = True
 
 
 class AudioModeType(int, Enum):
@@ -13,6 +28,22 @@ class AudioModeType(int, Enum):
     COSYVOICE = 2
 
 
+# 在 GPU worker 上执行的 stage
+gpu_stages = ("cosy", "rvc", "talking_head", "srt")
+
+
+class Lane(str, Enum):
+    INTERACTIVE = "interactive"
+    BATCH = "batch"
+
+
+# redis broker 中数字越小越先执行; 需要 worker_prefetch_multiplier=1, 否则预取的任务不受优先级影响
+lane_priority = {
+    Lane.INTERACTIVE: 0,
+    Lane.BATCH: 9,
+}
+
+
 def cosy_cos_helper(model_name: str) -> Tuple[str, str]:
     """
     根据模型名称找到 cosy 对应的参考文本 & 参考视频 COS key
@@ -34,29 +65,147 @@ def rvc_cos_helper(model_name: str) -> Tuple[str, str]:
 cosy_infer_task, azure_infer_task, rvc_infer_task, srt_infer_task, talking_head_infer_task = register_infer_tasks()
 
 
-def publish_cosy_infer_task(text: str, model_name: str, output_cos: str, mode: int = 1) -> AsyncResult:
+def _stitch_task(
+    audio_parts_cos: List[str],
+    output_cos: str,
+    srt_parts_cos: Optional[List[str]] = None,
+    output_srt_cos: Optional[str] = None,
+) -> Signature:
+    """
+    media worker 中的分段音频 / 字幕拼接任务 (media/media_celery.py), 作为 chord body 使用
+    """
+    return celery_app.signature(
+        "stitch_infer", args=(audio_parts_cos, output_cos, srt_parts_cos, output_srt_cos), queue="media_infer"
+    )
+
+
+def _mux_task(video_parts_cos: List[str], output_cos: str) -> Signature:
+    """
+    media worker 中的分段视频拼接任务 (media/media_celery.py), 在音频拼接之后执行
+    """
+    return celery_app.signature("mux_infer", args=(video_parts_cos, output_cos), queue="media_infer")
+
+
+def part_cos(cos: str, i: int) -> str:
+    """
+    分段输出的 COS key, 例如 infer/xxx.azure.wav -> infer/xxx.part0.azure.wav
+    """
+    prefix, _, name = cos.rpartition("/")
+    stem, _, suffix = name.partition(".")
+    return f"{prefix}/{stem}.part{i}.{suffix}"
+
+
+def audio_segments(sig: Optional[Signature], stages: Dict[str, str], audio_cos: str) -> List[Tuple[List[str], str]]:
+    """
+    按播放顺序排列的音频段, 用于边合成边返回
+    :param sig: 新发送的 signature, 命中缓存时为 None
+    :param stages: task 的所有 stage, celery result id -> stage name
+    :param audio_cos: 完整音频的 COS key
+    :return: (该段完成前需要等待的 celery ids, 该段的 COS key) 列表. 没有分段时只有完整音频一段
+    """
+    outputs = {}
+    if sig is not None:
+        # 每段音频由 rvc 或 cosy 写入, 输出 COS key 是最后一个参数
+        outputs = {t.args[-1]: t.id for t in leaves(sig) if stage_name(t.task) in ("rvc", "cosy")}
+    parts = list(takewhile(outputs.__contains__, (part_cos(audio_cos, i) for i in count())))
+    if parts:
+        return [([outputs[key]], key) for key in parts]
+    return [([rid for rid, stage in stages.items() if stage in output_stages["audio"]], audio_cos)]
+
+
+def set_priority(sig: Signature, priority: int) -> Signature:
+    """
+    设置 chain / chord 中每个 task 的优先级. 后续 task 由 worker 发送, 只设置在外层不会生效
+    """
+    for t in leaves(sig):
+        t.set(priority=priority)
+    return sig
+
+
+def set_deadline(sig: Signature, deadline: datetime.datetime) -> Signature:
+    """
+    GPU stage 在 deadline 之前没有开始执行时由 worker 撤销 (celery expires), 之后的 stage 也不再执行
+    :param deadline: 不带时区时视为 UTC
+    """
+    if deadline.tzinfo is None:
+        deadline = deadline.replace(tzinfo=datetime.timezone.utc)
+    for t in leaves(sig):
+        if stage_name(t.task) in gpu_stages:
+            # 使用字符串, batch lane 的 signature 需要 json 序列化
+            t.set(expires=deadline.isoformat())
+    return sig
+
+
+def publish(task: Signature) -> Signature:
+    """
+    先 freeze 以确定所有 celery result id (用于记录 Task.stages), 再发送
+    :return: 已发送的 signature
+    """
+    task.freeze()
+    rst = task.apply_async()
+    logger.info(f"task id: {rst.id}, task: {task}")
+    return task
+
+
+def _apply_async(task: Signature, producer: Producer):
+    """
+    使用 producer 发送已 freeze 的 signature. chain.apply_async 不会把 producer 传给第一个 task (celery _chain.run),
+    这里按 _chain.run 的方式展开 chain, 由第一个 task 携带之后的 task 发送.
+    chord header 中的 chain 仍由 celery 发送, 每个 chain 单独获取 producer
+    """
+    if task.task != "celery.chain":
+        return task.apply_async(producer=producer)
+    options = {k: v for k, v in task.options.items() if k != "task_id"}
+    # 按执行顺序的逆序, 与 celery 一致
+    steps, _ = task.prepare_steps(task.args, task.kwargs, task.tasks, app=task.app)
+    first = steps.pop()
+    return first.apply_async(producer=producer, **{**options, "chain": steps})
+
+
+def publish_many(tasks: List[Signature]):
+    """
+    使用同一个 broker 连接发送多个已 freeze 的 signature
+    """
+    with celery_app.producer_or_acquire() as producer:
+        for task in tasks:
+            _apply_async(task, producer)
+    logger.info(f"{len(tasks)} tasks published")
+
+
+def publish_cosy_infer_task(text: str, model_name: str, output_cos: str, mode: int = 1) -> Signature:
     prompt_text_cos, prompt_wav_cos = cosy_cos_helper(model_name)
-    return cosy_infer_task.delay(text, prompt_text_cos, prompt_wav_cos, output_cos, mode)
+    return publish(cosy_infer_task.s(text, prompt_text_cos, prompt_wav_cos, output_cos, mode))
+
 
+def publish_azure_infer_task(text: str, audio_profile: str, output_cos: str) -> Signature:
+    return publish(azure_infer_task.s(text, audio_profile, output_cos))
 
-def publish_azure_infer_task(text: str, audio_profile: str, output_cos: str) -> AsyncResult:
-    return azure_infer_task.delay(text, audio_profile, output_cos)
+
+def publish_azure_batch_infer_task(items: List[Tuple[str, str, str]]) -> Signature:
+    """
+    :param items: (text, audio_profile, output_cos) 列表, 见 azure/azure_celery.py azure_batch_infer_task
+    """
+    return publish(celery_app.signature("azure_batch_infer", args=(items,), queue="azure_infer"))
 
 
-def publish_rvc_infer_task(audio_cos: str, model_name: str, pitch: int, output_cos: str) -> AsyncResult:
+def publish_rvc_infer_task(audio_cos: str, model_name: str, pitch: int, output_cos: str) -> Signature:
     index_cos, model_cos = rvc_cos_helper(model_name)
-    return rvc_infer_task.delay(audio_cos, index_cos, model_cos, pitch, output_cos)
+    return publish(rvc_infer_task.s(audio_cos, index_cos, model_cos, pitch, output_cos))
 
 
-def publish_srt_infer_task(audio_cos: str, text: str, output_cos: str) -> AsyncResult:
-    return srt_infer_task.delay(audio_cos, text, output_cos)
+def publish_srt_infer_task(audio_cos: str, text: str, output_cos: str) -> Signature:
+    return publish(srt_infer_task.s(audio_cos, text, output_cos))
 
 
-def publish_talking_head_infer_task(audio_cos: str, speaker: str, output_cos: str) -> AsyncResult:
-    return talking_head_infer_task.delay(audio_cos, speaker, output_cos)
+def build_talking_head_infer_task(audio_cos: str, speaker: str, output_cos: str) -> Signature:
+    return talking_head_infer_task.s(audio_cos, speaker, output_cos)
 
 
-def publish_text_task(
+def publish_talking_head_infer_task(audio_cos: str, speaker: str, output_cos: str) -> Signature:
+    return publish(build_talking_head_infer_task(audio_cos, speaker, output_cos))
+
+
+def build_text_task(
     text: str,
     model_name: str,
     output_audio_cos: str,
@@ -66,30 +215,120 @@ def publish_text_task(
     speaker: Optional[str],
     output_video_cos: Optional[str],
     output_srt_cos: Optional[str],
-) -> GroupResult | AsyncResult:
+    long_text: bool = False,
+    chunk_size: int = LONG_TEXT_CHUNK_SIZE,
+    segmented: bool = False,
+) -> Signature:
+    """
+    tts (azure + rvc 或 cosy), 之后按需生成视频 / 字幕
+    :param long_text: 长文本模式, 按句子切分为多段并行合成后拼接
+    :param chunk_size: 长文本模式下每段的最大字符数
+    :param segmented: 分段生成视频, 每段音频完成后立即生成该段视频, 最后拼接. 隐含长文本模式
+    """
+    segmented = segmented and output_video_cos is not None
+    chunks = chunk_text(text, chunk_size) if long_text or segmented else [text]
+    # azure 合成时根据 word boundary 直接生成字幕 (rvc 不改变时长), 不需要 srt 任务
+    azure_srt = azure_output_audio_cos is not None
+    if len(chunks) > 1:
+        # 长文本: 各段 tts (+talking_head, srt) 并行, 再按顺序拼接音频, 字幕和视频
+        audio_parts = [part_cos(output_audio_cos, i) for i in range(len(chunks))]
+        srt_parts = [part_cos(output_srt_cos, i) for i in range(len(chunks))] if output_srt_cos else None
+        video_parts = [part_cos(output_video_cos, i) for i in range(len(chunks))] if segmented else None
+        parts = []
+        for i, chunk in enumerate(chunks):
+            part = _tts_task(
+                chunk,
+                model_name,
+                audio_parts[i],
+                azure_audio_profile,
+                part_cos(azure_output_audio_cos, i) if azure_output_audio_cos else None,
+                pitch,
+                output_srt_cos=srt_parts[i] if srt_parts else None,
+            )
+            if video_parts:
+                # 各段的视频与后续段的 tts 同时生成
+                part = part | talking_head_infer_task.s(speaker, video_parts[i])
+            if srt_parts and not azure_srt:
+                if video_parts:
+                    # 上一个任务的结果是视频, 显式传入该段音频
+                    part = part | srt_infer_task.si(audio_parts[i], chunk, srt_parts[i])
+                else:
+                    part = part | srt_infer_task.s(chunk, srt_parts[i])
+            parts.append(part)
+        stitch = _stitch_task(audio_parts, output_audio_cos, srt_parts, output_srt_cos)
+        tts = chord(parts, stitch | _mux_task(video_parts, output_video_cos) if video_parts else stitch)
+        # 字幕已在拼接时生成, 分段模式下视频已在拼接时生成
+        output_srt_cos = None
+        if video_parts:
+            output_video_cos = None
+    else:
+        tts = _tts_task(
+            text,
+            model_name,
+            output_audio_cos,
+            azure_audio_profile,
+            azure_output_audio_cos,
+            pitch,
+            output_srt_cos=output_srt_cos,
+        )
+        if azure_srt:
+            output_srt_cos = None
+    after_tts = _after_audio_task(text, speaker, output_video_cos, output_srt_cos)
+    return tts | after_tts if after_tts else tts
+
+
+def _tts_task(
+    text: str,
+    model_name: str,
+    output_audio_cos: str,
+    azure_audio_profile: str,
+    azure_output_audio_cos: Optional[str],
+    pitch: int,
+    output_srt_cos: Optional[str] = None,
+) -> Signature:
+    """
+    :param output_srt_cos: azure 合成时同时生成的字幕 COS key, cosy 不使用
+    """
     if azure_output_audio_cos:
-        azure = azure_infer_task.s(text, azure_audio_profile, azure_output_audio_cos)
+        azure = azure_infer_task.s(text, azure_audio_profile, azure_output_audio_cos, output_srt_cos)
         index_cos, model_cos = rvc_cos_helper(model_name)
         rvc = rvc_infer_task.s(index_cos, model_cos, pitch, output_audio_cos)
-        tts = azure | rvc
-    else:
-        prompt_text_cos, prompt_wav_cos = cosy_cos_helper(model_name)
-        tts = cosy_infer_task.s(text, prompt_text_cos, prompt_wav_cos, output_audio_cos, mode=1)
-    if output_video_cos and output_srt_cos:
-        assert speaker is not None
-        talking_head = talking_head_infer_task.s(speaker, output_video_cos)
-        srt = srt_infer_task.s(text, output_srt_cos)
-        task = tts | group(talking_head, srt)
-    elif output_video_cos:
-        assert speaker is not None
-        talking_head = talking_head_infer_task.s(speaker, output_video_cos)
-        task = tts | talking_head
-    elif output_srt_cos:
-        srt = srt_infer_task.s(text, output_srt_cos)
-        task = tts | srt
-    else:
-        task = tts
+        return azure | rvc
+    prompt_text_cos, prompt_wav_cos = cosy_cos_helper(model_name)
+    return cosy_infer_task.s(text, prompt_text_cos, prompt_wav_cos, output_audio_cos, mode=1)
 
-    rst = task.delay()
-    logger.info(f"task id: {rst.id}, task: {task}")
-    return rst
+
+def build_audio_task(
+    audio_cos: str,
+    text: str,
+    speaker: Optional[str],
+    output_video_cos: Optional[str],
+    output_srt_cos: Optional[str],
+) -> Signature:
+    """
+    基于已有的音频生成视频 / 字幕, 用于 tts 结果命中缓存时跳过 tts
+    """
+    return _after_audio_task(text, speaker, output_video_cos, output_srt_cos, audio_cos=audio_cos)
+
+
+def _after_audio_task(
+    text: str,
+    speaker: Optional[str],
+    output_video_cos: Optional[str],
+    output_srt_cos: Optional[str],
+    audio_cos: Optional[str] = None,
+) -> Optional[Signature]:
+    """
+    音频生成之后的 talking_head / srt 任务
+    :param audio_cos: 为 None 时音频 COS key 由 chain 中的上一个任务传入
+    """
+    args = (audio_cos,) if audio_cos else ()
+    tasks = []
+    if output_video_cos:
+        assert speaker is not None
+        tasks.append(talking_head_infer_task.s(*args, speaker, output_video_cos))
+    if output_srt_cos:
+        tasks.append(srt_infer_task.s(*args, text, output_srt_cos))
+    if len(tasks) > 1:
+        return group(*tasks)
+    return tasks[0] if tasks else None
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from mcelery.infer import celery_app
+
+from infra.logger import logger
+from infra.metrics import stage_queue_duration, stage_run_duration
+from infra.redis_ import redis_cli
+from models.task import Task, set_stage_durations, stage_name
+from task.admission import ADMISSION_PENDING_EXPIRE, ADMISSION_THROUGHPUT_WINDOW, done_key, pending_key, stage_queue
+from task.cancel import add_stage_refs, cancel_task
+
+# 订阅 celery 事件统计 stage 耗时, 多副本时只在一个副本上开启
+TASK_EVENTS_MONITOR = bool(os.getenv("TASK_EVENTS_MONITOR"))
+
+_timing_key = "mercury_task_timing"
+_timing_expire_time = 24 * 60 * 60
+_retry_interval = 5
+
+# celery 事件 -> 记录的时间戳字段
+_event_fields = {
+    "task-sent": "sent",
+    "task-received": "received",
+    "task-started": "started",
+    "task-succeeded": "finished",
+    "task-failed": "finished",
+}
+
+_stop = threading.Event()
+_receiver: Optional[Any] = None
+_thread: Optional[threading.Thread] = None
+_consumer: Optional[asyncio.Task] = None
+
+
+async def track_tasks(tasks: List[Task], stages: Optional[List[Dict[str, str]]] = None):
+    """
+    记录新发送的 stage 对应的 task, 用于把事件中的耗时写回 Task, 并计入用户未完成的 stage.
+    同时记录 task 引用的所有 stage, 取消时不撤销其他 task 仍在使用的 stage
+    :param stages: 每个 task 新发送的 stages (celery result id -> stage), 默认为 task.stages
+    """
+    now = time.time()
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        for task, task_stages in zip(tasks, stages or [task.stages or {} for task in tasks]):
+            add_stage_refs(pipe, task)
+            for celery_id, stage in task_stages.items():
+                key = f"{_timing_key}_{celery_id}"
+                pipe.hset(key, mapping={"task_id": task.id, "user_id": task.user_id, "stage": stage})
+                pipe.expire(key, _timing_expire_time)
+            if task_stages:
+                pipe.zadd(pending_key(task.user_id), dict.fromkeys(task_stages, now))
+                pipe.expire(pending_key(task.user_id), ADMISSION_PENDING_EXPIRE)
+        await pipe.execute()
+
+
+async def _release_pending(task_id: int):
+    """
+    stage 失败后 chain 中之后的 stage 不会再发送, 也不会有完成事件, 不再计入用户未完成的 stage
+    """
+    task = await Task.objects.get_or_none(id=task_id)
+    if task is not None and task.stages:
+        await redis_cli.zrem(pending_key(task.user_id), *task.stages)
+
+
+async def _revoked(event: Dict[str, Any]):
+    """
+    超过 deadline 被 worker 撤销时取消整个 task
+    """
+    key = f"{_timing_key}_{event['uuid']}"
+    timing = {k.decode(): v.decode() for k, v in (await redis_cli.hgetall(key)).items()}
+    if "user_id" in timing:
+        await redis_cli.zrem(pending_key(int(timing["user_id"])), event["uuid"])
+    if not event.get("expired") or "task_id" not in timing:
+        return
+    task = await Task.objects.get_or_none(id=int(timing["task_id"]))
+    if task is not None and not task.cancelled:
+        await cancel_task(task, reason="deadline exceeded")
+
+
+async def _handle(event: Dict[str, Any]):
+    if event["type"] == "task-revoked":
+        return await _revoked(event)
+    field = _event_fields.get(event["type"])
+    if field is None:
+        return
+    celery_id = event["uuid"]
+    key = f"{_timing_key}_{celery_id}"
+    mapping = {field: event["timestamp"]}
+    if event.get("name"):
+        mapping["name"] = event["name"]
+    if field == "finished":
+        mapping["state"] = "SUCCESS" if event["type"] == "task-succeeded" else "FAILURE"
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping=mapping).expire(key, _timing_expire_time).hgetall(key)
+        timing = {k.decode(): v.decode() for k, v in (await pipe.execute())[-1].items()}
+
+    stage = timing.get("stage") or stage_name(timing.get("name", "unknown"))
+    # 子任务由 worker 发送时没有 task-sent, 以 task-received 作为开始排队的时间
+    queued = timing.get("sent") or timing.get("received")
+    if field == "started" and queued:
+        stage_queue_duration.labels(stage).observe(max(0.0, float(timing["started"]) - float(queued)))
+    if field != "finished":
+        return
+    # 用于准入控制估计吞吐量
+    async with redis_cli.pipeline(transaction=False) as pipe:
+        done = done_key(stage_queue(stage), int(float(timing["finished"]) // 60))
+        pipe.incr(done).expire(done, (ADMISSION_THROUGHPUT_WINDOW + 1) * 60)
+        if "user_id" in timing:
+            pipe.zrem(pending_key(int(timing["user_id"])), celery_id)
+        await pipe.execute()
+    if timing["state"] == "FAILURE" and "task_id" in timing:
+        await _release_pending(int(timing["task_id"]))
+    if "started" not in timing:
+        return
+    run = max(0.0, float(timing["finished"]) - float(timing["started"]))
+    stage_run_duration.labels(stage, timing["state"]).observe(run)
+    if "task_id" in timing:
+        durations = {"run": run}
+        if queued:
+            durations["queue"] = max(0.0, float(timing["started"]) - float(queued))
+        await set_stage_durations(int(timing["task_id"]), celery_id, durations)
+
+
+async def _consume(queue: asyncio.Queue):
+    while True:
+        event = await queue.get()
+        try:
+            await _handle(event)
+        except Exception as e:
+            logger.error(f"task event {event.get('type')} {event.get('uuid')} error: {type(e).__name__}: {e}")
+
+
+def _capture(loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+    """
+    在线程中接收 celery 事件, 转发到事件循环; 连接断开时重连
+    """
+    global _receiver
+
+    def forward(event: Dict[str, Any]):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    while not _stop.is_set():
+        try:
+            # worker 默认不发送事件 (flower 也会开启)
+            celery_app.control.enable_events()
+            with celery_app.connection() as conn:
+                handlers = {t: forward for t in [*_event_fields, "task-revoked"]}
+                _receiver = celery_app.events.Receiver(conn, handlers=handlers)
+                _receiver.capture(limit=None, timeout=None, wakeup=True)
+        except Exception as e:
+            logger.error(f"task event receiver error: {type(e).__name__}: {e}")
+            _stop.wait(_retry_interval)
+
+
+async def start_monitor():
+    global _thread, _consumer
+    if not TASK_EVENTS_MONITOR:
+        return
+    queue = asyncio.Queue()
+    _stop.clear()
+    _consumer = asyncio.create_task(_consume(queue))
+    _thread = threading.Thread(target=_capture, args=(asyncio.get_running_loop(), queue), daemon=True)
+    _thread.start()
+    logger.info("task event monitor started")
+
+
+async def stop_monitor():
+    if _thread is None:
+        return
+    _stop.set()
+    if _receiver is not None:
+        # capture 每秒检查一次 should_stop
+        _receiver.should_stop = True
+    start = time.monotonic()
+    while _thread.is_alive() and time.monotonic() - start < _retry_interval:
+        await asyncio.sleep(0.1)
+    _consumer.cancel()
+    await asyncio.gather(_consumer, return_exceptions=True)
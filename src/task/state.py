@@ -0,0 +1,132 @@
+import asyncio
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from celery import states
+from mcelery.infer import celery_app
+
+from infra.logger import logger
+from infra.redis_ import backend_redis_cli
+from models.task import TaskStatus
+
+# 单次 MGET 的最大 key 数量
+_mget_batch_size = 1000
+
+# Task 处于这些状态时不会再变化
+finished_statuses = (TaskStatus.SUCCEEDED, TaskStatus.FAILED, TaskStatus.CANCELLED)
+
+_retry_interval = 1
+
+# result key -> 等待该 key 变化的 watch_states 的队列
+_waiters: Dict[bytes, Set[asyncio.Queue]] = {}
+_listener: Optional[asyncio.Task] = None
+
+
+async def resolve_states(celery_ids: Iterable[str]) -> Dict[str, str]:
+    """
+    通过 MGET 批量读取 celery result backend, 代替逐个 AsyncResult(rid).state
+    :param celery_ids: celery result ids
+    :return: celery id -> state, backend 中不存在的 id 视为 PENDING (与 AsyncResult 一致)
+    """
+    ids: List[str] = list(dict.fromkeys(celery_ids))
+    backend = celery_app.backend
+    res = {}
+    for i in range(0, len(ids), _mget_batch_size):
+        batch = ids[i : i + _mget_batch_size]
+        values = await backend_redis_cli.mget([backend.get_key_for_task(rid) for rid in batch])
+        for rid, value in zip(batch, values):
+            res[rid] = backend.decode_result(value)["status"] if value else states.PENDING
+    return res
+
+
+def merge_status(celery_states: Iterable[str]) -> TaskStatus:
+    """
+    根据所有 celery task state 计算 Task 的整体状态
+    """
+    for state in celery_states:
+        if state == states.FAILURE:
+            return TaskStatus.FAILED
+        elif state == states.REVOKED:
+            return TaskStatus.CANCELLED
+        elif state == states.PENDING:
+            return TaskStatus.PENDING
+        elif state != states.SUCCESS:
+            return TaskStatus.UNKNOWN
+    return TaskStatus.SUCCEEDED
+
+
+async def _listen():
+    """
+    每个进程只用一个连接订阅所有 result key (psubscribe), 按 key 分发给 watch_states
+    """
+    pattern = celery_app.backend.get_key_for_task("*")
+    while True:
+        pubsub = backend_redis_cli.pubsub()
+        try:
+            await pubsub.psubscribe(pattern)
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+                if message is None:
+                    continue
+                for queue in _waiters.get(message["channel"], ()):
+                    queue.put_nowait((message["channel"], message["data"]))
+        except Exception as e:
+            # 重连期间丢失的变化由 watch_states 空闲时重新读取
+            logger.error(f"result subscriber error: {type(e).__name__}: {e}")
+            await asyncio.sleep(_retry_interval)
+        finally:
+            await pubsub.aclose()
+
+
+async def start_state_listener():
+    global _listener
+    _listener = asyncio.create_task(_listen())
+
+
+async def stop_state_listener():
+    if _listener is None:
+        return
+    _listener.cancel()
+    await asyncio.gather(_listener, return_exceptions=True)
+
+
+async def watch_states(
+    celery_ids: List[str], idle_interval: float = 15
+) -> AsyncIterator[Optional[Tuple[str, str]]]:
+    """
+    通过 celery redis backend 在写入 result 时 publish 的消息 (channel 即 result key) 推送 state 变化,
+    所有 watch_states 共用 start_state_listener 中的一个订阅连接.
+    先 yield 所有 id 的当前 state, 之后每次变化 yield (celery id, state), 整体状态结束后退出.
+    :param celery_ids: celery result ids
+    :param idle_interval: 超过该时间没有变化时重新读取一次 state (避免订阅重连期间丢失变化),
+        仍没有变化时 yield None, 调用方可以借此发送心跳
+    """
+    backend = celery_app.backend
+    channels = {backend.get_key_for_task(rid): rid for rid in celery_ids}
+    queue = asyncio.Queue()
+    # 先注册再读取当前 state, 避免丢失两者之间的变化
+    for channel in channels:
+        _waiters.setdefault(channel, set()).add(queue)
+    try:
+        current = await resolve_states(celery_ids)
+        for rid in celery_ids:
+            yield rid, current[rid]
+        while merge_status(current[rid] for rid in celery_ids) not in finished_statuses:
+            try:
+                channel, data = await asyncio.wait_for(queue.get(), idle_interval)
+                changes = {channels[channel]: backend.decode_result(data)["status"]}
+            except asyncio.TimeoutError:
+                changes = await resolve_states(celery_ids)
+                if changes == current:
+                    yield None
+                    continue
+            for rid, state in changes.items():
+                if current[rid] != state:
+                    current[rid] = state
+                    yield rid, state
+    finally:
+        for channel in channels:
+            waiters = _waiters.get(channel)
+            if waiters is not None:
+                waiters.discard(queue)
+                if not waiters:
+                    del _waiters[channel]
@@ -0,0 +1,76 @@
+from typing import AsyncIterator, List, Optional, Tuple
+
+from celery import states
+from mcelery.cos import cos_bucket, cos_client
+
+from infra.cos import iter_cos_object
+from infra.logger import logger
+from infra.wav import parse_wav_header, streaming_wav_header
+from models.task import TaskStatus
+from task.state import finished_statuses, merge_status, watch_states
+
+
+async def _wav_data(key: str) -> AsyncIterator[Tuple[bytes, bytes]]:
+    """
+    读取 COS 中的 wav 文件
+    :return: (fmt chunk 内容, data 中的一块) 的序列
+    """
+    _, body = await iter_cos_object(cos_client, cos_bucket, key)
+    head, fmt, remaining = b"", None, 0
+    try:
+        async for data in body:
+            if fmt is None:
+                head += data
+                parsed = parse_wav_header(head)
+                if parsed is None:
+                    continue
+                fmt, offset, remaining = parsed
+                data = head[offset:]
+            # 忽略 data 之后的其他 chunk
+            data = data[:remaining]
+            remaining -= len(data)
+            if data:
+                yield fmt, data
+            if remaining <= 0:
+                return
+    finally:
+        await body.aclose()
+
+
+async def stream_audio(segments: List[Tuple[List[str], str]]) -> AsyncIterator[bytes]:
+    """
+    按顺序等待每段音频合成完成并输出, 所有段拼接为一个长度未知的 wav.
+    某段失败或被取消时提前结束, 已输出的部分无法撤回
+    :param segments: (该段完成前需要等待的 celery ids, 该段的 COS key), 见 task.infer.audio_segments
+    """
+    changes = watch_states([rid for rids, _ in segments for rid in rids])
+    current = {}
+    header: Optional[bytes] = None
+    try:
+        for rids, key in segments:
+            while True:
+                status = merge_status(current.get(rid, states.PENDING) for rid in rids)
+                if status == TaskStatus.SUCCEEDED:
+                    break
+                if status in finished_statuses:
+                    logger.warning(f"audio stream stopped at {key}: {status.name}")
+                    return
+                change = await anext(changes, False)
+                if change is False:
+                    logger.warning(f"audio stream stopped at {key}: states not available")
+                    return
+                if change is not None:
+                    current[change[0]] = change[1]
+
+            async for fmt, data in _wav_data(key):
+                if header is None:
+                    header = fmt
+                    yield streaming_wav_header(fmt)
+                elif fmt != header:
+                    # 各段由同一模型合成, 格式应一致
+                    raise ValueError(f"{key} format differs from the first segment")
+                yield data
+    except Exception as e:
+        logger.error(f"audio stream error: {type(e).__name__}: {e}")
+    finally:
+        await changes.aclose()
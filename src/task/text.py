@@ -0,0 +1,60 @@
+import re
+from typing import List
+
+# 句末标点 (英文句号后需跟空白, 避免切开小数和缩写)
+_sentence_end = re.compile(r"(?<=[。！？!?；;…\n])|(?<=\.)(?=\s)")
+# 句子过长时的次级切分点
+_clause_end = re.compile(r"(?<=[，,、：:\s])")
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    按句末标点切分文本, 标点保留在句子末尾, 丢弃空白句子
+    """
+    return [s for s in (s.strip() for s in _sentence_end.split(text)) if s]
+
+
+def _split_long(sentence: str, max_chars: int) -> List[str]:
+    if len(sentence) <= max_chars:
+        return [sentence]
+    parts = []
+    for clause in (c for c in _clause_end.split(sentence) if c):
+        if len(clause) <= max_chars:
+            parts.append(clause)
+        else:
+            # 没有可用的标点时只能硬切
+            parts.extend(clause[i : i + max_chars] for i in range(0, len(clause), max_chars))
+    return [p.strip() for p in _pack(parts, max_chars, join=str.__add__)]
+
+
+def _join_sentences(a: str, b: str) -> str:
+    # 西文句子之间补一个空格
+    return f"{a} {b}" if a[-1].isascii() and b[0].isascii() else a + b
+
+
+def _pack(pieces: List[str], max_chars: int, join=_join_sentences) -> List[str]:
+    chunks, current = [], ""
+    for piece in pieces:
+        candidate = join(current, piece) if current else piece
+        if len(candidate) <= max_chars:
+            current = candidate
+        else:
+            if current:
+                chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_text(text: str, max_chars: int) -> List[str]:
+    """
+    将长文本按句子边界切分为不超过 max_chars 的若干段, 尽量让每段包含多个完整的句子
+    :param text: 文本
+    :param max_chars: 每段最大字符数
+    :return: 按顺序排列的文本段
+    """
+    sentences = []
+    for sentence in split_sentences(text):
+        sentences.extend(_split_long(sentence, max_chars))
+    return _pack(sentences, max_chars)
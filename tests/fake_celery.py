@@ -0,0 +1,29 @@
+"""
+测试用的 mcelery, 在导入 task.infer 等模块前导入: 使用内存 broker 的 celery app, 注册与 worker 同名同队列的 task
+"""
+import os
+import sys
+import types
+from unittest import mock
+
+from celery import Celery
+
+celery_app = Celery("test", broker="memory://", backend="cache+memory://")
+cos_client = mock.Mock()
+
+
+def _infer(*args, **kwargs):
+    pass
+
+
+def register_infer_tasks():
+    stages = ("cosy", "azure", "rvc", "srt", "talking_head")
+    return [celery_app.task(name=f"{stage}_infer", queue=f"{stage}_infer")(_infer) for stage in stages]
+
+
+_mcelery = types.ModuleType("mcelery")
+_mcelery.infer = types.SimpleNamespace(celery_app=celery_app, register_infer_tasks=register_infer_tasks)
+_mcelery.cos = types.SimpleNamespace(cos_client=cos_client, cos_bucket="bucket")
+sys.modules.update({"mcelery": _mcelery, "mcelery.infer": _mcelery.infer, "mcelery.cos": _mcelery.cos})
+# models 导入时创建 Database, 不会连接
+os.environ.setdefault("DATABASE_URL", "sqlite://")
@@ -0,0 +1,140 @@
+"""
+测试用的内存 redis, 只实现用到的命令, 返回值与 redis.asyncio (decode_responses=False) 一致
+"""
+from typing import Any, Dict, List
+
+
+def _b(value: Any) -> bytes:
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.data: Dict[bytes, Any] = {}
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    def __getattr__(self, name: str):
+        command = getattr(self, f"_{name}")
+
+        async def execute(*args, **kwargs):
+            return command(*args, **kwargs)
+
+        return execute
+
+    def _get(self, key, default_type):
+        return self.data.setdefault(_b(key), default_type())
+
+    def _clean(self, key):
+        if not self.data.get(_b(key)):
+            self.data.pop(_b(key), None)
+
+    def _set(self, key, value, nx=False, px=None):
+        if nx and _b(key) in self.data:
+            return None
+        self.data[_b(key)] = _b(value)
+        return True
+
+    def _expire(self, key, seconds):
+        return _b(key) in self.data
+
+    def _incr(self, key):
+        self.data[_b(key)] = _b(int(self.data.get(_b(key), 0)) + 1)
+        return int(self.data[_b(key)])
+
+    def _rpush(self, key, *values):
+        lst = self._get(key, list)
+        lst.extend(_b(v) for v in values)
+        return len(lst)
+
+    def _lpush(self, key, *values):
+        lst = self._get(key, list)
+        for v in values:
+            lst.insert(0, _b(v))
+        return len(lst)
+
+    def _lpop(self, key, count=None):
+        lst = self.data.get(_b(key), [])
+        n = 1 if count is None else count
+        popped, lst[:] = lst[:n], lst[n:]
+        self._clean(key)
+        if count is None:
+            return popped[0] if popped else None
+        return popped or None
+
+    def _llen(self, key):
+        return len(self.data.get(_b(key), []))
+
+    def _sadd(self, key, *members):
+        s = self._get(key, set)
+        n = len(s)
+        s.update(_b(m) for m in members)
+        return len(s) - n
+
+    def _srem(self, key, *members):
+        s = self.data.get(_b(key), set())
+        n = len(s)
+        s.difference_update(_b(m) for m in members)
+        self._clean(key)
+        return n - len(s)
+
+    def _smembers(self, key):
+        return set(self.data.get(_b(key), set()))
+
+    def _scard(self, key):
+        return len(self.data.get(_b(key), set()))
+
+    def _hset(self, key, mapping):
+        h = self._get(key, dict)
+        n = len(h)
+        h.update({_b(k): _b(v) for k, v in mapping.items()})
+        return len(h) - n
+
+    def _hgetall(self, key):
+        return dict(self.data.get(_b(key), {}))
+
+    def _zadd(self, key, mapping):
+        z = self._get(key, dict)
+        n = len(z)
+        z.update({_b(k): float(v) for k, v in mapping.items()})
+        return len(z) - n
+
+    def _zrem(self, key, *members):
+        z = self.data.get(_b(key), {})
+        n = len(z)
+        for m in members:
+            z.pop(_b(m), None)
+        self._clean(key)
+        return n - len(z)
+
+    def _zrange(self, key, start, end):
+        members = sorted(self.data.get(_b(key), {}).items(), key=lambda kv: kv[1])
+        return [m for m, _ in members[start : None if end == -1 else end + 1]]
+
+
+class FakePipeline:
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.commands: List[tuple] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        command = getattr(self.redis, f"_{name}")
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
@@ -0,0 +1,33 @@
+import unittest
+
+from task.admission import queue_rejection, stage_queue, throughput
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_throughput(self):
+        self.assertEqual(throughput([]), 0)
+        self.assertEqual(throughput([0, 0]), 0)
+        # 空闲的分钟不计入
+        self.assertEqual(throughput([0, 60, 0, 120]), 1.5)
+
+    def test_queue_rejection(self):
+        self.assertIsNone(queue_rejection("q", 10, 1, 0, 0, 600))
+        self.assertIsNone(queue_rejection("q", 10, 1, 1, 20, 600))
+        # 超过队列长度
+        reason, retry_after = queue_rejection("q", 20, 5, 1, 20, 0)
+        self.assertIn("full", reason)
+        self.assertEqual(retry_after, 5)
+        # 预计等待 1200s, 超过 600s
+        reason, retry_after = queue_rejection("q", 1199, 1, 1, 0, 600)
+        self.assertIn("busy", reason)
+        self.assertEqual(retry_after, 600)
+
+    def test_stage_queue(self):
+        self.assertEqual(stage_queue("talking_head"), "talking_head_infer")
+        self.assertEqual(stage_queue("stitch"), "media_infer")
+        self.assertEqual(stage_queue("mux"), "media_infer")
+
+
+if __name__ == "__main__":
+    unittest.main()
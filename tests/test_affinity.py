@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+from celery import Signature
+from celery.signals import before_task_publish
+
+import fake_celery
+from task import affinity
+from task.affinity import AffinityRouter, affinity_queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "worker"))
+
+import affinity as worker_affinity  # noqa: E402
+
+
+def _cosy(output: str) -> Signature:
+    return fake_celery.celery_app.signature(
+        "cosy_infer", args=("text", "model/cosy/m.lab", "model/cosy/m.wav", output), kwargs={"mode": 1}
+    )
+
+
+def _talking_head(output: str) -> Signature:
+    return fake_celery.celery_app.signature("talking_head_infer", args=("spk", output))
+
+
+def _api_router() -> AffinityRouter:
+    app = fake_celery.celery_app
+    return AffinityRouter(app.amqp.routes, app.amqp.queues, True, app=app)
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fake_celery.register_infer_tasks()
+        affinity._warm = {
+            "cosy": {"model/cosy/m.wav": ["cosy_infer.w1", "cosy_infer.w2"]},
+            "talking_head": {"spk": ["talking_head_infer.w1"]},
+        }
+        affinity._depths = {"cosy_infer.w1": 1}
+
+    def test_affinity_queue(self):
+        # 选择队列最短的 worker, 并计入刚路由的任务
+        self.assertEqual(affinity_queue("cosy", "model/cosy/m.wav"), "cosy_infer.w2")
+        self.assertEqual(affinity._depths["cosy_infer.w2"], 1)
+        self.assertIsNone(affinity_queue("cosy", "model/cosy/other.wav"))
+        self.assertIsNone(affinity_queue("rvc", "model/rvc/m.pth"))
+
+    def test_affinity_queue_full(self):
+        affinity._depths = {"talking_head_infer.w1": affinity.AFFINITY_MAX_DEPTH}
+        self.assertIsNone(affinity_queue("talking_head", "spk"))
+
+    def test_router(self):
+        router = _api_router()
+        task = fake_celery.celery_app.tasks["cosy_infer"]
+        # 覆盖 task 注册时的共享队列
+        options = router.route(dict(task._get_exec_options()), "cosy_infer", _cosy("a.wav").args)
+        self.assertEqual(options["queue"].name, "cosy_infer.w2")
+        options = router.route(dict(task._get_exec_options()), "cosy_infer", ("t", "x.lab", "x.wav", "a.wav"))
+        self.assertEqual(options["queue"].name, "cosy_infer")
+        options = router.route({}, "azure_infer", ("t", "v", "a.wav"))
+        self.assertNotIn("w", options["queue"].name)
+
+    def test_publish_chain(self):
+        app = fake_celery.celery_app
+        sent = []
+
+        def record(sender=None, routing_key=None, **_):
+            sent.append((sender, routing_key))
+
+        before_task_publish.connect(record, weak=False)
+        self.addCleanup(before_task_publish.disconnect, record)
+        self.addCleanup(app.amqp.__dict__.pop, "router", None)
+        app.amqp.router = _api_router()
+        (_cosy("a.wav") | _talking_head("a.mp4")).apply_async()
+        # 之后的 talking_head 由 worker 发送
+        self.assertEqual(sent, [("cosy_infer", "cosy_infer.w2")])
+
+        # worker 发送 chain 中之后的 task 时使用 worker 中的 router, 参数包含上一个 task 的结果
+        router = worker_affinity.AffinityRouter(app, None)
+        router.warm = {"talking_head": {"spk": ["talking_head_infer.w1@gpu"]}}
+        router.expires = float("inf")
+        options = router.route({"queue": "talking_head_infer"}, "talking_head_infer", ("a.wav", "spk", "a.mp4"))
+        self.assertEqual(options["queue"].name, "talking_head_infer.w1@gpu")
+        self.assertEqual(router.depths, {"talking_head_infer.w1@gpu": 1})
+        options = router.route({"queue": "talking_head_infer"}, "talking_head_infer", ("a.wav", "other", "a.mp4"))
+        self.assertEqual(options["queue"].name, "talking_head_infer")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+
+def _fake_modules(cos_client: mock.Mock):
+    celery_app = types.SimpleNamespace(task=lambda **_: lambda f: f)
+    return {
+        "azure": types.ModuleType("azure"),
+        "azure.cognitiveservices": types.ModuleType("azure.cognitiveservices"),
+        "azure.cognitiveservices.speech": mock.MagicMock(),
+        "mcelery": types.ModuleType("mcelery"),
+        "mcelery.cos": types.SimpleNamespace(cos_client=cos_client, cos_bucket="bucket"),
+        "mcelery.infer": types.SimpleNamespace(celery_app=celery_app, register_infer_tasks=lambda: None),
+    }
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cos_client = mock.Mock()
+        patcher = mock.patch.dict(sys.modules, _fake_modules(self.cos_client))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for directory in ("worker", "azure"):
+            sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", directory))
+            self.addCleanup(sys.path.pop, 0)
+        for name in ("azure_celery", "azure_pool", "affinity"):
+            sys.modules.pop(name, None)
+        import azure_celery
+
+        self.azure_celery = azure_celery
+        self.sleep = self._patch("time.sleep")
+        self._patch("azure_celery.azure_batch_max_attempts", 3)
+        self._patch("azure_celery.azure_batch_concurrency", 2)
+
+    def _patch(self, target, *args, **kwargs):
+        patcher = mock.patch(target, *args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_retry_item(self):
+        synthesize = self._patch(
+            "azure_celery.synthesize", side_effect=[RuntimeError("timeout"), RuntimeError("timeout"), (b"RIFF", [])]
+        )
+        result = self.azure_celery._batch_item("你好", "v", "a.wav")
+        self.assertEqual(result, {"output_cos": "a.wav", "ok": True, "error": None})
+        self.assertEqual(synthesize.call_count, 3)
+        self.assertEqual([c.args for c in self.sleep.call_args_list], [(1,), (2,)])
+        self.cos_client.put_object.assert_called_once_with(Bucket="bucket", Body=b"RIFF", Key="a.wav")
+
+    def test_item_fails_after_max_attempts(self):
+        self._patch("azure_celery.synthesize", side_effect=RuntimeError("quota"))
+        result = self.azure_celery._batch_item("你好", "v", "a.wav")
+        self.assertEqual(result, {"output_cos": "a.wav", "ok": False, "error": "RuntimeError: quota"})
+        # 最后一次失败后不再等待
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_batch_isolates_failures(self):
+        def synthesize(text, audio_profile):
+            if text == "bad":
+                raise RuntimeError("invalid ssml")
+            if text == "canceled":
+                return None, []
+            return text.encode(), []
+
+        self._patch("azure_celery.synthesize", side_effect=synthesize)
+        items = [("a", "v2", "a.wav"), ("bad", "v1", "bad.wav"), ("canceled", "v1", "c.wav"), ("b", "v1", "b.wav")]
+        results = self.azure_celery.azure_batch_infer_task(items)
+        # 结果与输入顺序一致, 失败的条目不影响其他条目
+        self.assertEqual([r["output_cos"] for r in results], ["a.wav", "bad.wav", "c.wav", "b.wav"])
+        self.assertEqual([r["ok"] for r in results], [True, False, False, True])
+        self.assertEqual(results[1]["error"], "RuntimeError: invalid ssml")
+        self.assertEqual(results[2]["error"], "canceled")
+        self.assertEqual(self.cos_client.put_object.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+
+class FakeSignal:
+    def __init__(self):
+        self.handlers = []
+
+    def connect(self, handler):
+        self.handlers.append(handler)
+
+    def disconnect_all(self):
+        self.handlers.clear()
+
+
+class FakeConnection:
+    opened = 0
+    closed = 0
+
+    @classmethod
+    def from_speech_synthesizer(cls, synthesizer):
+        return cls()
+
+    def open(self, for_continuous_recognition):
+        FakeConnection.opened += 1
+
+    def close(self):
+        FakeConnection.closed += 1
+
+
+class FakeSynthesizer:
+    def __init__(self, speech_config, audio_config):
+        assert audio_config is None
+        self.voice = speech_config.speech_synthesis_voice_name
+        self.synthesis_word_boundary = FakeSignal()
+
+    def speak_text_async(self, text):
+        for handler in self.synthesis_word_boundary.handlers:
+            handler(text)
+        result = types.SimpleNamespace(reason="completed", audio_data=f"RIFF{self.voice}:{text}".encode())
+        return types.SimpleNamespace(get=lambda: result)
+
+
+class FakeSpeechConfig:
+    def __init__(self, subscription, region):
+        self.speech_synthesis_voice_name = None
+
+    def set_speech_synthesis_output_format(self, fmt):
+        self.output_format = fmt
+
+
+fake_sdk = types.ModuleType("azure.cognitiveservices.speech")
+fake_sdk.SpeechConfig = FakeSpeechConfig
+fake_sdk.SpeechSynthesizer = FakeSynthesizer
+fake_sdk.Connection = FakeConnection
+fake_sdk.SpeechSynthesisOutputFormat = types.SimpleNamespace(Riff24Khz16BitMonoPcm="riff-24khz-16bit-mono-pcm")
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FakeConnection.opened = FakeConnection.closed = 0
+        modules = {
+            "azure": types.ModuleType("azure"),
+            "azure.cognitiveservices": types.ModuleType("azure.cognitiveservices"),
+            "azure.cognitiveservices.speech": fake_sdk,
+        }
+        patcher = mock.patch.dict(sys.modules, modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "azure"))
+        self.addCleanup(sys.path.pop, 0)
+        sys.modules.pop("azure_pool", None)
+        import azure_pool
+
+        self.pool = azure_pool.SynthesizerPool("key", "region", max_idle_per_voice=1)
+
+    def test_reuse_per_voice(self):
+        with self.pool.acquire("zh-CN-YunxiNeural") as s1:
+            data = s1.speak_text_async("你好").get().audio_data
+        with self.pool.acquire("zh-CN-YunxiNeural") as s2:
+            pass
+        with self.pool.acquire("zh-CN-XiaoxiaoNeural") as s3:
+            pass
+        self.assertEqual(data, "RIFFzh-CN-YunxiNeural:你好".encode())
+        self.assertIs(s1, s2)
+        self.assertIsNot(s1, s3)
+        self.assertEqual(FakeConnection.opened, 2)
+
+    def test_max_idle(self):
+        with self.pool.acquire("v") as s1:
+            with self.pool.acquire("v") as s2:
+                self.assertIsNot(s1, s2)
+        # 超过 max_idle_per_voice 的 synthesizer 被关闭
+        self.assertEqual(FakeConnection.closed, 1)
+
+    def test_discard_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.acquire("v") as s1:
+                raise RuntimeError("canceled")
+        with self.pool.acquire("v") as s2:
+            pass
+        self.assertIsNot(s1, s2)
+        self.assertEqual(FakeConnection.closed, 1)
+
+    def test_handlers_cleared(self):
+        events = []
+        with self.pool.acquire("v") as s1:
+            s1.synthesis_word_boundary.connect(events.append)
+            s1.speak_text_async("a").get()
+        with self.pool.acquire("v") as s2:
+            s2.speak_text_async("b").get()
+        self.assertIs(s1, s2)
+        self.assertEqual(events, ["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import fake_celery  # noqa: F401
+from fake_redis import FakeRedis
+from models.task import Task
+from task import cancel
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.revoke = mock.Mock()
+        for target, value in [
+            ("redis_cli", self.redis),
+            ("resolve_states", mock.AsyncMock(side_effect=self._states)),
+            ("_revoke", self.revoke),
+            ("mark_task_cancelled", mock.AsyncMock()),
+            ("_unwritten_outputs", mock.AsyncMock(return_value=[])),
+            ("delete_files", mock.AsyncMock()),
+        ]:
+            patcher = mock.patch.object(cancel, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.celery_states = {}
+
+    def _states(self, rids):
+        return {rid: self.celery_states.get(rid, "PENDING") for rid in rids}
+
+    def _track(self, *tasks: Task):
+        async def track():
+            async with self.redis.pipeline() as pipe:
+                for task in tasks:
+                    cancel.add_stage_refs(pipe, task)
+                await pipe.execute()
+
+        asyncio.run(track())
+
+    def test_keep_shared_stages(self):
+        # b 命中 a 的 tts 缓存, 共享 azure 和 rvc
+        a = Task(id=1, user_id=1, celery_ids=["azure", "rvc", "th1"])
+        b = Task(id=2, user_id=2, celery_ids=["azure", "rvc", "th2"])
+        self._track(a, b)
+        self.celery_states = {"azure": "SUCCESS"}
+
+        self.assertEqual(asyncio.run(cancel.cancel_task(a)), ["th1"])
+        self.revoke.assert_called_once_with(["th1"], "cancelled")
+        # a 取消后不再引用, 取消 b 时撤销共享的 stage
+        self.assertEqual(asyncio.run(cancel.cancel_task(b)), ["rvc", "th2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
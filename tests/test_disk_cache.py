@@ -0,0 +1,88 @@
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from infra.disk_cache import DiskCache
+
+
+class StubSource:
+    """
+    按 step 字节返回数据, 每次 read 前等待 gate, 用于控制下载进度
+    """
+
+    def __init__(self, data: bytes, step: int = 4):
+        self.data = data
+        self.step = step
+        self.calls = 0
+        self.gate = threading.Semaphore(0)
+
+    def __call__(self):
+        self.calls += 1
+        pos = 0
+
+        def read(_: int) -> bytes:
+            nonlocal pos
+            self.gate.acquire()
+            chunk = self.data[pos : pos + self.step]
+            pos += len(chunk)
+            return chunk
+
+        return len(self.data), '"etag"', "text/plain", read
+
+
+async def _read(cached, start=0, end=None) -> bytes:
+    return b"".join([chunk async for chunk in cached.iter_bytes(start, end)])
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_single_flight_and_follow(self):
+        async def run():
+            cache = DiskCache(self.dir.name, 1024)
+            source = StubSource(b"0123456789abcdef")
+            first = await cache.fetch("k", source)
+            second = await cache.fetch("k", source)
+            readers = asyncio.gather(_read(first), _read(second, 2, 5))
+            for _ in range(5):
+                source.gate.release()
+            data = await readers
+            await cache.close()
+            return source.calls, data, cache.get("k").fill
+
+        calls, data, fill = asyncio.run(run())
+        self.assertEqual(calls, 1)
+        self.assertEqual(data, [b"0123456789abcdef", b"2345"])
+        self.assertIsNone(fill)
+
+    def test_evict_and_reload(self):
+        async def fetch(cache, key, data):
+            source = StubSource(data, step=len(data))
+            source.gate.release()
+            source.gate.release()
+            return await _read(await cache.fetch(key, source))
+
+        async def run():
+            cache = DiskCache(self.dir.name, 10)
+            await fetch(cache, "a", b"aaaa")
+            await fetch(cache, "b", b"bbbb")
+            cache.get("a")
+            await fetch(cache, "c", b"cccc")
+            return cache
+
+        cache = asyncio.run(run())
+        self.assertIsNone(cache.get("b"))
+        reloaded = DiskCache(self.dir.name, 10)
+        self.assertEqual(asyncio.run(_read(reloaded.get("a"))), b"aaaa")
+        self.assertIsNotNone(reloaded.get("c"))
+        self.assertIsNone(reloaded.get("b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
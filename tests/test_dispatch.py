@@ -0,0 +1,102 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import fake_celery  # noqa: F401
+from fake_redis import FakeRedis
+from task import dispatch
+from task.infer import build_text_task
+from models.task import all_stages
+
+
+def _job(text: str, long_text: bool = False, video: bool = False):
+    video_args = ("spk", "infer/a.mp4") if video else (None, None)
+    sig = build_text_task(
+        text, "m", "infer/a.wav", "zh-CN-YunxiNeural", "infer/a.azure.wav", 0, *video_args, None, long_text, 10
+    )
+    sig.freeze()
+    return sig
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.published = []
+        for target, value in [
+            ("redis_cli", self.redis),
+            ("queue_depths", mock.AsyncMock(side_effect=lambda queues, **_: dict.fromkeys(queues, 0))),
+            ("resolve_states", mock.AsyncMock(side_effect=lambda rids: dict.fromkeys(rids, "PENDING"))),
+            ("publish_many", mock.Mock(side_effect=self.published.extend)),
+        ]:
+            patcher = mock.patch.object(dispatch, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_all_stages_after_json(self):
+        sig = _job("今天天气很好。我们去散步吧！", long_text=True)
+        restored = fake_celery.celery_app.signature(json.loads(json.dumps(sig)))
+        # chord header 还原为 list
+        self.assertIsInstance(restored.tasks[0].tasks, list)
+        self.assertEqual(all_stages(restored), all_stages(sig))
+
+    def test_dispatch_chord(self):
+        long_job, short_job = _job("今天天气很好。我们去散步吧！", long_text=True), _job("你好")
+        asyncio.run(dispatch.defer(1, [long_job]))
+        asyncio.run(dispatch.defer(2, [short_job]))
+        self.assertEqual(asyncio.run(dispatch._dispatch_once()), 2)
+        # 发送时保持 celery result id 不变
+        self.assertEqual(
+            sorted(tuple(all_stages(sig)) for sig in self.published),
+            sorted(tuple(all_stages(sig)) for sig in [long_job, short_job]),
+        )
+        self.assertFalse([key for key in self.redis.data if key.startswith(b"mercury_batch_rvc_infer_")])
+
+    def test_queue_group(self):
+        # azure_infer 不是 GPU 队列, 视频任务受 rvc_infer 和 talking_head_infer 限制
+        self.assertEqual(dispatch.queue_group(_job("你好")), "rvc_infer")
+        self.assertEqual(dispatch.queue_group(_job("你好", video=True)), "rvc_infer+talking_head_infer")
+
+    def test_gpu_queue_backlog(self):
+        depths = {"rvc_infer": 0, "talking_head_infer": dispatch.BATCH_DISPATCH_MAX_QUEUED - 1}
+        dispatch.queue_depths.side_effect = lambda queues, **_: {q: depths[q] for q in queues}
+        # 用户 1 的大量视频任务在 talking_head_infer 积压时不再发送, 不影响用户 2 的音频任务
+        videos, audios = [_job(str(i), video=True) for i in range(5)], [_job(str(i)) for i in range(3)]
+        asyncio.run(dispatch.defer(1, videos))
+        asyncio.run(dispatch.defer(2, audios))
+        self.assertEqual(asyncio.run(dispatch._dispatch_once()), 4)
+        self.assertEqual({sig.id for sig in self.published}, {videos[0].id, *(sig.id for sig in audios)})
+
+        # 已发送的视频任务计入 rvc_infer 的剩余数量
+        depths["rvc_infer"] = dispatch.BATCH_DISPATCH_MAX_QUEUED - 2
+        depths["talking_head_infer"] = 0
+        self.published.clear()
+        self.redis.data.pop(dispatch._lock_key.encode())
+        self.assertEqual(asyncio.run(dispatch._dispatch_once()), 2)
+        self.assertEqual([sig.id for sig in self.published], [sig.id for sig in videos[1:3]])
+
+    def test_put_back_on_error(self):
+        jobs = [_job("你好"), _job("再见")]
+        asyncio.run(dispatch.defer(1, jobs))
+        dispatch.publish_many.side_effect = ConnectionError("broker")
+        with self.assertRaises(ConnectionError):
+            asyncio.run(dispatch._dispatch_once())
+        # 放回原来的位置, 下一轮仍可发送
+        pending = self.redis.data[dispatch._user_key("rvc_infer", 1).encode()]
+        self.assertEqual([json.loads(s)["options"]["task_id"] for s in pending], [job.id for job in jobs])
+        self.assertIn(b"rvc_infer", self.redis.data[dispatch._groups_key.encode()])
+
+    def test_skip_revoked(self):
+        jobs = [_job("你好"), _job("再见")]
+        asyncio.run(dispatch.defer(1, jobs))
+        revoked = next(iter(all_stages(jobs[0])))
+        dispatch.resolve_states.side_effect = lambda rids: {
+            rid: "REVOKED" if rid == revoked else "PENDING" for rid in rids
+        }
+        self.assertEqual(asyncio.run(dispatch._dispatch_once()), 1)
+        self.assertEqual([sig.id for sig in self.published], [jobs[1].id])
+
+
+if __name__ == "__main__":
+    unittest.main()
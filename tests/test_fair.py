@@ -0,0 +1,29 @@
+import unittest
+
+from task.fair import fair_share
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_equal_share(self):
+        self.assertEqual(fair_share({1: 10, 2: 10, 3: 10}, {}, 6), {1: 2, 2: 2, 3: 2})
+
+    def test_weights(self):
+        self.assertEqual(fair_share({1: 10, 2: 10}, {1: 3}, 8), {1: 6, 2: 2})
+        # 权重大的用户任务不够时, 剩余的分给其他用户
+        self.assertEqual(fair_share({1: 1, 2: 10}, {1: 3}, 8), {1: 1, 2: 7})
+
+    def test_rotation(self):
+        backlogs = {1: 10, 2: 10, 3: 10}
+        self.assertEqual(fair_share(backlogs, {}, 2, start=0), {1: 1, 2: 1, 3: 0})
+        self.assertEqual(fair_share(backlogs, {}, 2, start=1), {1: 0, 2: 1, 3: 1})
+        self.assertEqual(fair_share(backlogs, {}, 2, start=5), {1: 1, 2: 0, 3: 1})
+
+    def test_budget_exceeds_backlog(self):
+        self.assertEqual(fair_share({1: 2, 2: 1}, {2: 4}, 100), {1: 2, 2: 1})
+        self.assertEqual(fair_share({}, {}, 10), {})
+        self.assertEqual(fair_share({1: 5}, {}, 0), {1: 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import unittest
+from unittest import mock
+
+from celery.signals import before_task_publish
+
+import fake_celery
+from task.infer import build_text_task, publish_many
+
+
+def _text_task(text: str, **kwargs):
+    return build_text_task(text, "m", "infer/a.wav", "v", "infer/a.azure.wav", 0, "spk", "infer/a.mp4", None, **kwargs)
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        before_task_publish.connect(self._record, weak=False)
+        self.addCleanup(before_task_publish.disconnect, self._record)
+
+    def _record(self, sender=None, headers=None, body=None, **_):
+        self.sent.append((sender, headers["id"], [t["task"] for t in body[2]["chain"] or []]))
+
+    def test_publish_many_one_producer(self):
+        sigs = [_text_task("你好"), _text_task("再见")]
+        for sig in sigs:
+            sig.freeze()
+        # batch lane 的 signature 经过 json 序列化
+        sigs[1] = fake_celery.celery_app.signature(json.loads(json.dumps(sigs[1])))
+        pool = fake_celery.celery_app.producer_pool
+        with mock.patch.object(pool, "acquire", wraps=pool.acquire) as acquire:
+            publish_many(sigs)
+        self.assertEqual(acquire.call_count, 1)
+        # 第一个 task 携带之后的 task (逆序), celery result id 不变
+        self.assertEqual(
+            self.sent,
+            [("azure_infer", sig.tasks[0].id, ["talking_head_infer", "rvc_infer"]) for sig in sigs],
+        )
+
+    def test_segmented(self):
+        text = "今天天气很好。我们去散步吧！"
+        # cosy 合成, 需要单独的 srt 任务
+        sig = build_text_task(
+            text, "m", "infer/a.wav", "v", None, 0, "spk", "infer/a.mp4", "infer/a.srt", chunk_size=10, segmented=True
+        )
+        self.assertEqual(sig.task, "celery.chord")
+        parts = sig.tasks
+        self.assertEqual(len(parts), 2)
+        for i, (part, chunk) in enumerate(zip(parts, ["今天天气很好。", "我们去散步吧！"])):
+            cosy, talking_head, srt = part.tasks
+            self.assertEqual(cosy.args[-1], f"infer/a.part{i}.wav")
+            # 各段音频完成后立即生成该段视频
+            self.assertEqual(talking_head.task, "talking_head_infer")
+            self.assertEqual(talking_head.args, ("spk", f"infer/a.part{i}.mp4"))
+            # 上一个任务的结果是视频, srt 显式使用该段音频
+            self.assertTrue(srt.immutable)
+            self.assertEqual(srt.args, (f"infer/a.part{i}.wav", chunk, f"infer/a.part{i}.srt"))
+
+        stitch, mux = sig.body.tasks
+        self.assertEqual(stitch.task, "stitch_infer")
+        audio_parts, srt_parts = ["infer/a.part0.wav", "infer/a.part1.wav"], ["infer/a.part0.srt", "infer/a.part1.srt"]
+        self.assertEqual(stitch.args, (audio_parts, "infer/a.wav", srt_parts, "infer/a.srt"))
+        self.assertEqual(mux.task, "mux_infer")
+        self.assertEqual(mux.args, (["infer/a.part0.mp4", "infer/a.part1.mp4"], "infer/a.mp4"))
+
+    def test_segmented_short_text(self):
+        # 只有一段时与普通模式相同
+        sig = build_text_task("你好", "m", "infer/a.wav", "v", None, 0, "spk", "infer/a.mp4", None, segmented=True)
+        self.assertEqual([t.task for t in sig.tasks], ["cosy_infer", "talking_head_infer"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import time
+import unittest
+
+from infra.cache import LRUCache
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(2)
+        expire_at = time.time() + 60
+        cache.set("a", 1, expire_at)
+        cache.set("b", 2, expire_at)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3, expire_at)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expire(self):
+        cache = LRUCache(2)
+        cache.set("a", 1, time.time() - 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_remove_if(self):
+        cache = LRUCache(10)
+        expire_at = time.time() + 60
+        for i in range(5):
+            cache.set(i, {"user_id": i % 2}, expire_at)
+        self.assertEqual(cache.remove_if(lambda v: v["user_id"] == 1), 2)
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+
+def _fake_modules(tmp: Path):
+    celery_app = types.SimpleNamespace(task=lambda **_: lambda f: f)
+    return {
+        "numpy": mock.MagicMock(),
+        "soundfile": mock.MagicMock(),
+        "mcelery": types.ModuleType("mcelery"),
+        "mcelery.cos": types.SimpleNamespace(
+            download_cos_file=lambda key: tmp / key,
+            get_local_path=lambda key: tmp / key,
+            upload_cos_file=mock.Mock(),
+        ),
+        "mcelery.infer": types.SimpleNamespace(celery_app=celery_app, register_infer_tasks=lambda: None),
+    }
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp()).resolve()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.dict(sys.modules, _fake_modules(self.tmp))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for directory in ("worker", "media"):
+            sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", directory))
+            self.addCleanup(sys.path.pop, 0)
+        for name in ("media_celery", "affinity"):
+            sys.modules.pop(name, None)
+        import media_celery
+
+        self.media_celery = media_celery
+
+    def test_concat_list(self):
+        listing = self.media_celery.concat_list(["/cos/infer/a.part0.mp4", "/cos/infer/it's.part1.mp4"])
+        # 单引号需要结束引用后转义
+        self.assertEqual(listing, "file '/cos/infer/a.part0.mp4'\nfile '/cos/infer/it'\\''s.part1.mp4'\n")
+
+    def test_mux(self):
+        listings = []
+
+        def run(cmd, **_):
+            listings.append(Path(cmd[cmd.index("-i") + 1]).read_text())
+            return subprocess.CompletedProcess(cmd, 0, "", "")
+
+        with mock.patch("subprocess.run", side_effect=run) as run_mock:
+            output = self.media_celery.mux_infer_task("a.wav", ["a.part0.mp4", "a.part1.mp4"], "a.mp4")
+        self.assertEqual(output, "a.mp4")
+        self.assertEqual(listings, [f"file '{self.tmp / 'a.part0.mp4'}'\nfile '{self.tmp / 'a.part1.mp4'}'\n"])
+        # 直接复制音视频流, 不重新编码
+        cmd = run_mock.call_args.args[0]
+        self.assertEqual(cmd[cmd.index("-c") + 1], "copy")
+        self.assertEqual(cmd[-1], str(self.tmp / "a.mp4"))
+        sys.modules["mcelery.cos"].upload_cos_file.assert_called_once_with("a.mp4")
+
+    def test_mux_failure(self):
+        failed = subprocess.CompletedProcess([], 1, "", "Invalid data found\n")
+        with mock.patch("subprocess.run", return_value=failed):
+            with self.assertRaisesRegex(Exception, "Invalid data found"):
+                self.media_celery.mux_infer_task("a.wav", ["a.part0.mp4"], "a.mp4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "worker"))
+
+from model_cache import ModelCache  # noqa: E402
+
+
+class _Body:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def get_raw_stream(self):
+        return io.BytesIO(self.data)
+
+
+class FakeCosClient:
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+        self.heads = 0
+        self.lock = threading.Lock()
+
+    def put(self, key: str, data: bytes):
+        self.objects[key] = data
+
+    def _etag(self, key: str) -> str:
+        return f'"{hashlib.md5(self.objects[key]).hexdigest()}"'
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        return {"ETag": self._etag(Key), "Content-Length": str(len(self.objects[Key]))}
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            self.gets += 1
+        # 让并发的请求有机会同时进入
+        time.sleep(0.05)
+        data = self.objects[Key]
+        return {"ETag": self._etag(Key), "Content-Length": str(len(data)), "Body": _Body(data)}
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.client = FakeCosClient()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_single_flight(self):
+        self.client.put("model/rvc/a.pth", b"weights")
+        cache = ModelCache(self.client, "bucket", self.dir.name, 1024)
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(cache.get("model/rvc/a.pth"))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.client.gets, 1)
+        self.assertEqual({p.read_bytes() for p in paths}, {b"weights"})
+        self.assertTrue(paths[0].name.endswith("a.pth"))
+
+    def test_revalidate(self):
+        self.client.put("model/cosy/a.wav", b"v1")
+        cache = ModelCache(self.client, "bucket", self.dir.name, 1024, revalidate_interval=0)
+        cache.get("model/cosy/a.wav")
+        cache.get("model/cosy/a.wav")
+        self.assertEqual((self.client.gets, self.client.heads), (1, 1))
+        self.client.put("model/cosy/a.wav", b"v2")
+        self.assertEqual(cache.get("model/cosy/a.wav").read_bytes(), b"v2")
+        self.assertEqual(self.client.gets, 2)
+
+    def test_evict_lru(self):
+        for name in "abc":
+            self.client.put(f"model/rvc/{name}.pth", name.encode() * 4)
+        cache = ModelCache(self.client, "bucket", self.dir.name, 10, min_age=0)
+        a = cache.get("model/rvc/a.pth")
+        b = cache.get("model/rvc/b.pth")
+        time.sleep(0.01)
+        # 再次使用 a, b 成为最久未使用的
+        cache.get("model/rvc/a.pth")
+        cache.get("model/rvc/c.pth")
+        self.assertTrue(a.exists())
+        self.assertFalse(b.exists())
+
+    def test_checksum_mismatch(self):
+        self.client.put("model/rvc/a.pth", b"weights")
+        self.client._etag = lambda key: '"0123456789abcdef0123456789abcdef"'
+        cache = ModelCache(self.client, "bucket", self.dir.name, 1024)
+        with self.assertRaises(Exception):
+            cache.get("model/rvc/a.pth")
+        self.assertEqual([p for p in os.listdir(self.dir.name) if not p.endswith(".lock")], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+import fake_celery  # noqa: F401
+from fake_redis import FakeRedis
+from models.task import Task
+from task import monitor
+from task.admission import done_key, pending_key
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        stages = {"a": "azure", "r": "rvc", "t": "talking_head"}
+        self.task = Task(id=7, user_id=3, celery_ids=list(stages), stages=stages)
+        self.tasks = mock.Mock()
+        self.tasks.objects.get_or_none = mock.AsyncMock(return_value=self.task)
+        self.set_durations = mock.AsyncMock()
+        for target, value in [
+            ("redis_cli", self.redis),
+            ("Task", self.tasks),
+            ("set_stage_durations", self.set_durations),
+        ]:
+            patcher = mock.patch.object(monitor, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        asyncio.run(monitor.track_tasks([self.task]))
+
+    def _handle(self, *events):
+        async def handle():
+            for event in events:
+                await monitor._handle(event)
+
+        asyncio.run(handle())
+
+    def _pending(self):
+        return set(self.redis.data.get(pending_key(3).encode(), {}))
+
+    def _sample(self, name: str, labels: dict) -> float:
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    def test_durations(self):
+        queue_labels, run_labels = {"stage": "rvc"}, {"stage": "rvc", "state": "SUCCESS"}
+        queue_sum = self._sample("mercury_stage_queue_duration_seconds_sum", queue_labels)
+        run_sum = self._sample("mercury_stage_run_duration_seconds_sum", run_labels)
+        run_count = self._sample("mercury_stage_run_duration_seconds_count", run_labels)
+        self._handle(
+            {"type": "task-sent", "uuid": "r", "timestamp": 100.0, "name": "rvc_infer"},
+            {"type": "task-started", "uuid": "r", "timestamp": 102.5},
+            {"type": "task-succeeded", "uuid": "r", "timestamp": 110.0},
+        )
+        self.assertEqual(self._sample("mercury_stage_queue_duration_seconds_sum", queue_labels) - queue_sum, 2.5)
+        self.assertEqual(self._sample("mercury_stage_run_duration_seconds_sum", run_labels) - run_sum, 7.5)
+        self.assertEqual(self._sample("mercury_stage_run_duration_seconds_count", run_labels) - run_count, 1)
+        self.set_durations.assert_awaited_once_with(7, "r", {"run": 7.5, "queue": 2.5})
+        # 计入该队列本分钟完成的 stage 数
+        self.assertEqual(self.redis.data[done_key("rvc_infer", 1).encode()], b"1")
+
+    def test_failure_releases_pending(self):
+        self.assertEqual(self._pending(), {b"a", b"r", b"t"})
+        # azure 失败后 rvc 和 talking_head 不会再发送
+        self._handle(
+            {"type": "task-started", "uuid": "a", "timestamp": 10.0},
+            {"type": "task-failed", "uuid": "a", "timestamp": 11.0},
+        )
+        self.assertEqual(self._pending(), set())
+        self.tasks.objects.get_or_none.assert_awaited_with(id=7)
+
+    def test_success_keeps_later_stages(self):
+        self._handle(
+            {"type": "task-started", "uuid": "a", "timestamp": 10.0},
+            {"type": "task-succeeded", "uuid": "a", "timestamp": 11.0},
+        )
+        self.assertEqual(self._pending(), {b"r", b"t"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+from task.text import split_sentences, chunk_text
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_split_sentences(self):
+        text = "今天天气很好。我们去散步吧！Price is 3.5 dollars. Really?"
+        self.assertEqual(
+            split_sentences(text),
+            ["今天天气很好。", "我们去散步吧！", "Price is 3.5 dollars.", "Really?"],
+        )
+
+    def test_chunk_text(self):
+        text = "今天天气很好。我们去散步吧！你觉得怎么样？"
+        self.assertEqual(chunk_text(text, 100), [text])
+        self.assertEqual(chunk_text(text, 14), ["今天天气很好。我们去散步吧！", "你觉得怎么样？"])
+        self.assertEqual(chunk_text("Hello world. This is a test.", 15), ["Hello world.", "This is a test."])
+
+    def test_chunk_long_sentence(self):
+        chunks = chunk_text("好的，没问题，那我们下午三点在门口见，不见不散。", 10)
+        self.assertEqual(chunks, ["好的，没问题，", "那我们下午三点在门口", "见，不见不散。"])
+        self.assertTrue(all(len(c) <= 10 for c in chunk_text("a" * 25, 10)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from task.cache import tts_cache_key, tts_cache_entry, entry_stages, usable_outputs
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        stages = {"a": "azure", "r": "rvc", "t": "talking_head", "s": "srt"}
+        self.entry = tts_cache_entry(stages, audio="infer/1.wav", video="infer/1.mp4", srt="infer/1.srt")
+
+    def test_key(self):
+        key = tts_cache_key("你好", "model", 1, "zh-CN-YunxiNeural (Male)", 0)
+        self.assertEqual(key, tts_cache_key("你好", "model", 1, "zh-CN-YunxiNeural (Male)", 0))
+        self.assertNotEqual(key, tts_cache_key("你好", "model", 1, "zh-CN-YunxiNeural (Male)", 2))
+
+    def test_entry(self):
+        self.assertEqual(self.entry["audio"], {"key": "infer/1.wav", "stages": {"a": "azure", "r": "rvc"}})
+        self.assertEqual(entry_stages(self.entry, ["audio", "srt"]), {"a": "azure", "r": "rvc", "s": "srt"})
+
+    def test_usable_outputs(self):
+        celery_states = {"a": "SUCCESS", "r": "SUCCESS", "t": "FAILURE", "s": "PENDING"}
+        self.assertEqual(set(usable_outputs(self.entry, celery_states)), {"audio", "srt"})
+
+        celery_states = {"a": "SUCCESS", "r": "REVOKED", "t": "PENDING", "s": "PENDING"}
+        self.assertEqual(usable_outputs(self.entry, celery_states), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import unittest
+
+from infra.cos import upload_stream
+from infra.multipart import MultipartFileReader
+
+
+class StubCosClient:
+    """
+    内存中的 COS 分块上传接口
+    """
+
+    def __init__(self, fail_part: int = 0):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.fail_part = fail_part
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Body, Key):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, Body, PartNumber, UploadId):
+        if PartNumber == self.fail_part:
+            raise Exception("part failed")
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Part"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(UploadId)
+
+
+async def _iter(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_small_file(self):
+        client = StubCosClient()
+        size = asyncio.run(upload_stream(client, "bucket", "k", _iter(b"x" * 10, 3), part_size=10))
+        self.assertEqual(size, 10)
+        self.assertEqual(client.objects["k"], b"x" * 10)
+        self.assertEqual(client.uploads, {})
+
+    def test_multipart(self):
+        client = StubCosClient()
+        data = bytes(range(256)) * 40
+        size = asyncio.run(upload_stream(client, "bucket", "k", _iter(data, 7), part_size=1000, concurrency=2))
+        self.assertEqual(size, len(data))
+        self.assertEqual(client.objects["k"], data)
+        self.assertEqual(client.uploads, {})
+
+    def test_abort(self):
+        client = StubCosClient(fail_part=2)
+        with self.assertRaises(Exception):
+            asyncio.run(upload_stream(client, "bucket", "k", _iter(b"x" * 5000, 100), part_size=1000))
+        self.assertNotIn("k", client.objects)
+        self.assertEqual(client.aborted, ["upload-0"])
+
+    def test_multipart_reader(self):
+        content = b"a\r\nb--" * 1000
+        body = (
+            b"--boundary\r\n"
+            b'Content-Disposition: form-data; name="other"\r\n\r\n'
+            b"value\r\n"
+            b"--boundary\r\n"
+            b'Content-Disposition: form-data; name="file"; filename="a.mp4"\r\n'
+            b"Content-Type: video/mp4\r\n\r\n" + content + b"\r\n--boundary--\r\n"
+        )
+
+        async def read():
+            reader = MultipartFileReader(_iter(body, 13), "multipart/form-data; boundary=boundary")
+            filename = await reader.open()
+            return filename, b"".join([chunk async for chunk in reader.chunks()])
+
+        self.assertEqual(asyncio.run(read()), ("a.mp4", content))
+
+    def test_multipart_reader_missing_file(self):
+        body = b'--boundary\r\nContent-Disposition: form-data; name="other"\r\n\r\nvalue\r\n--boundary--\r\n'
+
+        async def read():
+            await MultipartFileReader(_iter(body, 13), "multipart/form-data; boundary=boundary").open()
+
+        with self.assertRaises(ValueError):
+            asyncio.run(read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import io
+import struct
+import unittest
+import wave
+
+from infra.wav import parse_wav_header, streaming_wav_header
+
+
+def _wav(frames: bytes, rate: int = 16000) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(frames)
+    return buf.getvalue()
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_parse_header(self):
+        data = _wav(b"\x01\x02" * 100)
+        fmt, offset, size = parse_wav_header(data)
+        self.assertEqual(size, 200)
+        self.assertEqual(data[offset : offset + size], b"\x01\x02" * 100)
+        self.assertEqual(struct.unpack("<I", fmt[4:8])[0], 16000)
+        # 不完整的头部需要更多字节
+        self.assertIsNone(parse_wav_header(data[:20]))
+        with self.assertRaises(ValueError):
+            parse_wav_header(b"ID3" + b"\x00" * 20)
+
+    def test_skip_other_chunks(self):
+        data = _wav(b"\x00\x00" * 10)
+        # 在 fmt 和 data 之间插入奇数长度的 LIST chunk
+        pos = data.index(b"data")
+        data = data[:pos] + b"LIST" + struct.pack("<I", 3) + b"abc\x00" + data[pos:]
+        _, offset, size = parse_wav_header(data)
+        self.assertEqual(data[offset - 8 : offset - 4], b"data")
+        self.assertEqual(size, 20)
+
+    def test_streaming_header(self):
+        frames = b"\x01\x02" * 50
+        fmt, _, _ = parse_wav_header(_wav(frames))
+        stream = streaming_wav_header(fmt) + frames + frames
+        # 长度未知的头部仍可以被解析, 拼接后的数据格式不变
+        fmt2, offset, _ = parse_wav_header(stream)
+        self.assertEqual(fmt2, fmt)
+        self.assertEqual(stream[offset:], frames * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from infra.webhook import WebhookSender
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # 依次返回的状态码, 用完后返回 200
+    statuses = []
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append(json.loads(body))
+        status = self.statuses.pop(0) if self.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        StubHandler.statuses = []
+        StubHandler.received = []
+        self.server = HTTPServer(("127.0.0.1", 0), StubHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/callback"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _send(self, max_attempts: int):
+        async def run():
+            sender = WebhookSender(concurrency=2, max_attempts=max_attempts, backoff=0.01, timeout=2)
+            await sender.start()
+            try:
+                done = await sender.send(self.url, {"id": 1, "status": 2})
+                return await asyncio.wait_for(done, 5)
+            finally:
+                await sender.stop()
+
+        return asyncio.run(run())
+
+    def test_retry_until_delivered(self):
+        StubHandler.statuses = [500, 503]
+        self.assertTrue(self._send(max_attempts=3))
+        self.assertEqual(len(StubHandler.received), 3)
+        self.assertEqual(StubHandler.received[-1], {"id": 1, "status": 2})
+
+    def test_give_up(self):
+        StubHandler.statuses = [500, 500, 500]
+        self.assertFalse(self._send(max_attempts=2))
+        self.assertEqual(len(StubHandler.received), 2)
+
+    def test_client_error_not_retried(self):
+        StubHandler.statuses = [404]
+        self.assertFalse(self._send(max_attempts=3))
+        self.assertEqual(len(StubHandler.received), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""
+GPU worker (cosy / rvc / talking_head) 的亲和路由, 与 src/task/affinity.py 配合.
+worker 除共享队列外还消费自己的队列 {stage}_infer.{worker 名}, 并把最近使用的模型写入 broker 所在的 redis,
+API 和 worker 在发送 task 时据此把同一模型的任务发送到已加载该模型的 worker, 没有时仍发送到共享队列.
+
+在 GPU worker 的 celery app 模块中调用 (同时开启发送时的路由):
+    from affinity import setup_affinity
+    setup_affinity("talking_head")
+
+其他会发送 chain 中之后的 task 的 worker (azure / media) 只开启路由:
+    from affinity import setup_affinity_routing
+    setup_affinity_routing()
+"""
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import redis
+from celery import Celery
+from celery.app.routes import Router
+from celery.signals import celeryd_after_setup, task_prerun, worker_ready, worker_shutdown
+
+logger = logging.getLogger(__name__)
+
+# worker 同时保留的模型数, 与 worker 中模型的缓存数量一致
+AFFINITY_WARM_MODELS = int(os.getenv("AFFINITY_WARM_MODELS", 4))
+# 需要小于 API 的 AFFINITY_WORKER_TTL
+AFFINITY_HEARTBEAT_INTERVAL = float(os.getenv("AFFINITY_HEARTBEAT_INTERVAL", 10))
+# 以下与 API 一致, 见 src/task/affinity.py
+AFFINITY_WORKER_TTL = int(os.getenv("AFFINITY_WORKER_TTL", 30))
+AFFINITY_REFRESH_INTERVAL = float(os.getenv("AFFINITY_REFRESH_INTERVAL", 5))
+AFFINITY_MAX_DEPTH = int(os.getenv("AFFINITY_MAX_DEPTH", 2))
+
+_warm_key = "mercury_warm"
+# kombu redis transport 按优先级把一个队列分为多个 list
+_priority_keys = ("", "\x06\x163", "\x06\x166", "\x06\x169")
+
+# stage -> 模型参数的位置 (从后往前数), 与 src/task/affinity.py 一致
+affinity_args = {
+    "cosy": -2,  # prompt_wav_cos
+    "rvc": -3,  # model_cos
+    "talking_head": -2,  # speaker
+}
+# celery task name -> stage
+_affinity_tasks = {f"{stage}_infer": stage for stage in affinity_args}
+
+
+def index_key(stage: str) -> str:
+    """
+    在线的 worker (zset): worker 名 -> 最近一次心跳时间
+    """
+    return f"{_warm_key}_{stage}"
+
+
+class AffinityRouter(Router):
+    """
+    发送 task 时 (包括 worker 发送的 chain 中之后的 task) 把需要加载模型的 task 路由到已加载该模型且队列最短的
+    worker 的队列, 规则与 API 相同. worker 状态每 AFFINITY_REFRESH_INTERVAL 秒从 redis 读取一次,
+    读取失败时使用共享队列
+    """
+
+    def __init__(self, app: Celery, client: redis.Redis):
+        super().__init__(app.amqp.routes, app.amqp.queues, app.conf.task_create_missing_queues, app=app)
+        self.client = client
+        self.lock = threading.Lock()
+        # stage -> 模型 -> 已加载该模型的 worker 队列
+        self.warm = {}
+        # worker 队列 -> 长度, 两次刷新之间按路由的任务数累加
+        self.depths = {}
+        self.expires = 0.0
+
+    def _refresh(self):
+        with self.client.pipeline(transaction=False) as pipe:
+            for stage in affinity_args:
+                pipe.zrangebyscore(index_key(stage), time.time() - AFFINITY_WORKER_TTL, "+inf")
+            workers = {stage: [w.decode() for w in ws] for stage, ws in zip(affinity_args, pipe.execute())}
+            for stage, stage_workers in workers.items():
+                for worker in stage_workers:
+                    pipe.zrange(f"{index_key(stage)}_{worker}", 0, -1)
+            models = iter(pipe.execute())
+            warm, queues = {}, []
+            for stage, stage_workers in workers.items():
+                warm[stage] = {}
+                for worker in stage_workers:
+                    queue = f"{stage}_infer.{worker}"
+                    queues.append(queue)
+                    for model in next(models):
+                        warm[stage].setdefault(model.decode(), []).append(queue)
+            for queue in queues:
+                for suffix in _priority_keys:
+                    pipe.llen(f"{queue}{suffix}")
+            lengths = pipe.execute()
+        n = len(_priority_keys)
+        self.depths = {queue: sum(lengths[i * n : (i + 1) * n]) for i, queue in enumerate(queues)}
+        self.warm = warm
+
+    def affinity_queue(self, stage: str, model: str) -> Optional[str]:
+        """
+        已加载该模型且队列最短的 worker 队列, 没有或都已满时返回 None (使用共享队列)
+        """
+        with self.lock:
+            if time.monotonic() >= self.expires:
+                self.expires = time.monotonic() + AFFINITY_REFRESH_INTERVAL
+                try:
+                    self._refresh()
+                except Exception as e:
+                    logger.error(f"affinity refresh error: {type(e).__name__}: {e}")
+                    self.warm = {}
+            candidates = self.warm.get(stage, {}).get(model)
+            if not candidates:
+                return None
+            queue = min(candidates, key=lambda q: self.depths.get(q, 0))
+            if self.depths.get(queue, 0) >= AFFINITY_MAX_DEPTH:
+                return None
+            self.depths[queue] = self.depths.get(queue, 0) + 1
+            return queue
+
+    def route(self, options, name, args=(), kwargs=None, task_type=None):
+        stage = _affinity_tasks.get(name)
+        if stage is not None:
+            queue = self.affinity_queue(stage, args[affinity_args[stage]])
+            if queue is not None:
+                # 覆盖 task 注册时的共享队列
+                options = dict(options, queue=queue)
+        return super().route(options, name, args, kwargs, task_type)
+
+
+def setup_affinity_routing(redis_url: Optional[str] = None):
+    """
+    worker 启动后发送 task 时使用亲和路由, AFFINITY_MAX_DEPTH 为 0 时不开启
+    :param redis_url: 默认为 CELERY_BROKER
+    """
+
+    @celeryd_after_setup.connect(weak=False)
+    def install_router(sender, instance, **_):
+        if not AFFINITY_MAX_DEPTH:
+            return
+        client = redis.Redis.from_url(redis_url or os.environ["CELERY_BROKER"])
+        instance.app.amqp.router = AffinityRouter(instance.app, client)
+
+
+def setup_affinity(stage: str, redis_url: Optional[str] = None):
+    """
+    :param stage: worker 执行的 stage
+    :param redis_url: 默认为 CELERY_BROKER
+    """
+    client = redis.Redis.from_url(redis_url or os.environ["CELERY_BROKER"])
+    task_name = f"{stage}_infer"
+    stop = threading.Event()
+    # chain 中之后的 task (例如 rvc 之后的 talking_head) 由本 worker 发送
+    setup_affinity_routing(redis_url)
+
+    @celeryd_after_setup.connect(weak=False)
+    def add_worker_queue(sender, instance, **_):
+        instance.app.amqp.queues.select_add(f"{task_name}.{sender}")
+
+    @task_prerun.connect(weak=False)
+    def record_model(task=None, args=None, **_):
+        if task is None or task.name != task_name:
+            return
+        key = f"{index_key(stage)}_{task.request.hostname}"
+        try:
+            with client.pipeline(transaction=False) as pipe:
+                pipe.zadd(key, {args[affinity_args[stage]]: time.time()})
+                pipe.zremrangebyrank(key, 0, -AFFINITY_WARM_MODELS - 1)
+                pipe.execute()
+        except Exception as e:
+            logger.error(f"record warm model error: {type(e).__name__}: {e}")
+
+    def heartbeat(hostname: str):
+        while not stop.is_set():
+            try:
+                client.zadd(index_key(stage), {hostname: time.time()})
+            except Exception as e:
+                logger.error(f"affinity heartbeat error: {type(e).__name__}: {e}")
+            stop.wait(AFFINITY_HEARTBEAT_INTERVAL)
+        client.zrem(index_key(stage), hostname)
+
+    @worker_ready.connect(weak=False)
+    def start_heartbeat(sender, **_):
+        threading.Thread(target=heartbeat, args=(sender.hostname,), daemon=True).start()
+
+    @worker_shutdown.connect(weak=False)
+    def stop_heartbeat(**_):
+        stop.set()
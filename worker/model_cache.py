@@ -0,0 +1,211 @@
+"""
+GPU worker 本地的模型文件缓存 (rvc 的 .index / .pth, cosy 的 .lab / .wav 等), 代替直接读写共享的 ./cos 目录:
+- 总大小不超过 max_bytes, 按最近使用时间淘汰
+- 下载到临时文件, 校验后 rename, 不会读到不完整的文件
+- 同一个 key 同时只有一个下载 (文件锁, 对 prefork 的多个子进程同样有效)
+- 超过 revalidate_interval 后通过 HEAD 比较 ETag, 对象更新时重新下载
+
+worker 中使用:
+    from model_cache import download_model_file
+    path = download_model_file("model/rvc/xxx.pth")
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "/cos/model_cache")
+MODEL_CACHE_MAX_BYTES = int(os.getenv("MODEL_CACHE_MAX_BYTES", 50 * 1024 * 1024 * 1024))
+# 距上次校验超过这个时间 (秒) 时向 COS 确认 ETag
+MODEL_CACHE_REVALIDATE = float(os.getenv("MODEL_CACHE_REVALIDATE", 300))
+# 最近这段时间 (秒) 内使用过的文件不淘汰, 避免刚返回的路径在加载前被删除
+MODEL_CACHE_MIN_AGE = float(os.getenv("MODEL_CACHE_MIN_AGE", 60))
+
+_chunk_size = 1024 * 1024
+
+# 每个模型在 COS 中的文件, 与 src/task/infer.py 中的 rvc_cos_helper / cosy_cos_helper 一致
+model_keys = {
+    "rvc": ["model/rvc/{name}.index", "model/rvc/{name}.pth"],
+    "cosy": ["model/cosy/{name}.lab", "model/cosy/{name}.wav"],
+}
+
+
+@contextmanager
+def _flock(path: Path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_json(path: Path, data: Dict[str, Any]):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
+
+
+class ModelCache:
+    def __init__(
+        self,
+        client: Any,
+        bucket: str,
+        root: str = MODEL_CACHE_DIR,
+        max_bytes: int = MODEL_CACHE_MAX_BYTES,
+        revalidate_interval: float = MODEL_CACHE_REVALIDATE,
+        min_age: float = MODEL_CACHE_MIN_AGE,
+    ):
+        """
+        :param client: qcloud_cos.CosS3Client 或接口相同的对象
+        """
+        self.client = client
+        self.bucket = bucket
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.revalidate_interval = revalidate_interval
+        self.min_age = min_age
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        # 保留文件名, 加载模型的代码可能根据后缀判断格式
+        return self.root / f"{hashlib.sha256(key.encode()).hexdigest()[:16]}_{os.path.basename(key)}"
+
+    @staticmethod
+    def _meta_path(path: Path) -> Path:
+        return path.with_name(f"{path.name}.meta")
+
+    def _valid_entry(self, path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            entry = json.loads(self._meta_path(path).read_text())
+        except (OSError, ValueError):
+            return None
+        if not path.exists() or path.stat().st_size != entry["size"]:
+            return None
+        return entry
+
+    def get(self, key: str) -> Path:
+        """
+        :return: 本地文件路径, 未缓存或已过期时先下载
+        """
+        path = self._path(key)
+        entry = self._valid_entry(path)
+        if entry is not None and time.time() - entry["checked_at"] < self.revalidate_interval:
+            os.utime(self._meta_path(path))
+            return path
+
+        with _flock(path.with_name(f"{path.name}.lock")):
+            # 等待锁期间可能已被其他进程下载
+            entry = self._valid_entry(path)
+            if entry is not None and time.time() - entry["checked_at"] >= self.revalidate_interval:
+                etag = self.client.head_object(Bucket=self.bucket, Key=key)["ETag"]
+                if etag == entry["etag"]:
+                    entry["checked_at"] = time.time()
+                    _write_json(self._meta_path(path), entry)
+                else:
+                    logger.info(f"model file {key} changed, etag {entry['etag']} -> {etag}")
+                    entry = None
+            if entry is None:
+                self._download(key, path)
+            else:
+                os.utime(self._meta_path(path))
+        self._evict()
+        return path
+
+    def _download(self, key: str, path: Path):
+        start = time.time()
+        resp = self.client.get_object(Bucket=self.bucket, Key=key)
+        etag = resp["ETag"]
+        raw = resp["Body"].get_raw_stream()
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        md5 = hashlib.md5()
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                while True:
+                    data = raw.read(_chunk_size)
+                    if not data:
+                        break
+                    md5.update(data)
+                    size += len(data)
+                    f.write(data)
+            # 分块上传的对象 ETag 不是 md5 (带有 "-"), 只校验大小
+            expected_size = int(resp.get("Content-Length", size))
+            if size != expected_size:
+                raise Exception(f"model file {key} size mismatch, expected {expected_size}, got {size}")
+            if "-" not in etag and md5.hexdigest() != etag.strip('"'):
+                raise Exception(f"model file {key} checksum mismatch, etag {etag}, md5 {md5.hexdigest()}")
+            os.replace(tmp, path)
+        finally:
+            raw.close()
+            tmp.unlink(missing_ok=True)
+        _write_json(self._meta_path(path), {"key": key, "size": size, "etag": etag, "checked_at": time.time()})
+        logger.info(f"model file {key} downloaded, {size} bytes in {time.time() - start:.1f}s")
+
+    def _entries(self) -> List[Path]:
+        """
+        按最近使用时间排序的缓存文件
+        """
+        metas = []
+        for meta in self.root.glob("*.meta"):
+            try:
+                metas.append((meta.stat().st_mtime, meta))
+            except FileNotFoundError:
+                continue
+        return [meta.with_name(meta.name.removesuffix(".meta")) for _, meta in sorted(metas)]
+
+    def _evict(self):
+        with _flock(self.root / ".evict.lock"):
+            entries = [(path, path.stat().st_size) for path in self._entries() if path.exists()]
+            total = sum(size for _, size in entries)
+            now = time.time()
+            for path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                meta = self._meta_path(path)
+                if now - meta.stat().st_mtime < self.min_age:
+                    break
+                meta.unlink(missing_ok=True)
+                path.unlink(missing_ok=True)
+                total -= size
+                logger.info(f"model file {path.name} evicted, {size} bytes")
+
+    def prewarm(self, keys: Iterable[str]) -> int:
+        """
+        下载 keys 中的文件, 不存在或下载失败的跳过
+        :return: 成功的数量
+        """
+        n = 0
+        for key in keys:
+            try:
+                self.get(key)
+                n += 1
+            except Exception as e:
+                logger.warning(f"prewarm {key} skipped: {type(e).__name__}: {e}")
+        return n
+
+
+_default: Optional[ModelCache] = None
+
+
+def default_cache() -> ModelCache:
+    global _default
+    if _default is None:
+        from mcelery.cos import cos_bucket, cos_client
+
+        _default = ModelCache(cos_client, cos_bucket)
+    return _default
+
+
+def download_model_file(key: str) -> Path:
+    """
+    代替 mcelery.cos.download_cos_file 下载模型文件
+    """
+    return default_cache().get(key)